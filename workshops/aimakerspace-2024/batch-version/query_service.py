@@ -0,0 +1,475 @@
+"""Long-running HTTP query service around the retriever pipeline.
+
+`report_generator.py` answers one question and exits, rebuilding the document
+store every time. The service loads the store once, keeps it and the
+normalized embedding matrix of its documents in memory, and answers
+questions over HTTP:
+
+    python query_service.py --port 8000
+    curl -s localhost:8000/query -d '{"question": "What happened to Apple?"}'
+    curl -s localhost:8000/stats
+
+Questions arriving within `batch_window` seconds of each other are coalesced:
+their embeddings are computed in one embedding request and their vector
+searches run as a single matrix product against the document matrix. Packing,
+prompt building and generation then run per question in a thread pool,
+bounded by `generation_concurrency`. At most `max_in_flight` questions are
+accepted at once, others get a 503 right away, and a question that takes
+longer than `timeout` seconds gets a 504.
+
+Every answer comes with the seconds spent in each stage: `queue` waiting for
+its batch, `embed`, `search`, `cache` lookup, `generation_wait` for a free
+generator, `pack`, `prompt`, `generate` and `total`, and the `batch_size`
+it was embedded in.
+
+With `--segments data/segments` the service searches the segment index the
+stream version publishes to instead of the archived documents, so documents
+become answerable a fraction of a second after they were embedded.
+
+A question can carry a time range, `"since"` and `"until"` as ISO 8601
+timestamps or epoch seconds, and is then answered from the documents whose
+`updated_at` (or `created_at`) falls within it. The segment index only opens
+the segments of that range.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document
+
+from rag_common.query_cache import CachedTextEmbedder, SemanticAnswerCache, document_store_validator
+from rag_common.segment_index import SegmentReader, Timestamp, document_time, to_epoch
+
+logger = logging.getLogger(__name__)
+
+# Largest request body accepted
+MAX_BODY_BYTES = 64 * 1024
+
+STATUS_TEXT = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable",
+               504: "Gateway Timeout"}
+
+
+class ServiceBusy(Exception):
+    """Raised when `max_in_flight` questions are already being answered."""
+
+
+def embed_batch(text_embedder: Any, texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts with one request to the embedding API.
+
+    Unwraps a `CachedTextEmbedder`, whose cache is read and filled, and calls
+    the OpenAI client of an `OpenAITextEmbedder` with all uncached texts at
+    once. Other embedders are run text by text.
+    """
+    cache = None
+    if isinstance(text_embedder, CachedTextEmbedder):
+        cache, text_embedder = text_embedder.cache, text_embedder.embedder
+    embeddings: List[Optional[List[float]]] = [cache.get(text) if cache else None for text in texts]
+    missing = sorted({text for text, embedding in zip(texts, embeddings) if embedding is None})
+    if missing:
+        if hasattr(text_embedder, "model") and hasattr(text_embedder, "client"):
+            if text_embedder.client is None:
+                text_embedder.warm_up()
+            kwargs = {"dimensions": text_embedder.dimensions} if getattr(text_embedder, "dimensions", None) else {}
+            response = text_embedder.client.embeddings.create(
+                model=text_embedder.model,
+                input=[f"{text_embedder.prefix}{text}{text_embedder.suffix}" for text in missing],
+                **kwargs,
+            )
+            computed = dict(zip(missing, (item.embedding for item in response.data)))
+        else:
+            computed = {text: text_embedder.run(text=text)["embedding"] for text in missing}
+        for text, embedding in computed.items():
+            if cache:
+                cache.put(text, embedding)
+        embeddings = [embedding if embedding is not None else computed[text]
+                      for text, embedding in zip(texts, embeddings)]
+    return embeddings
+
+
+class EmbeddingMatrix:
+    """Normalized embeddings of the documents of a store, for batched cosine search."""
+
+    def __init__(self, document_store: Any):
+        self.document_store = document_store
+        self.documents: List[Document] = []
+        self.matrix = np.zeros((0, 0), dtype=np.float32)
+        self.times = np.zeros(0, dtype=np.float64)
+        self._count = -1
+        self._lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Reload the documents if the number of documents in the store changed."""
+        count = self.document_store.count_documents()
+        if count == self._count and not force:
+            return False
+        documents = [document for document in self.document_store.filter_documents()
+                     if document.embedding is not None]
+        matrix = np.asarray([document.embedding for document in documents], dtype=np.float32)
+        if len(documents):
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        times = np.array([document_time(document.meta) or np.nan for document in documents], dtype=np.float64)
+        with self._lock:
+            self.documents, self.matrix, self.times, self._count = documents, matrix, times, count
+        logger.info(f"Loaded {len(documents)} document embeddings")
+        return True
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, queries: np.ndarray, top_k: int, since: Timestamp = None,
+               until: Timestamp = None) -> List[List[Document]]:
+        """The `top_k` most similar documents of every row of `queries`, among those of `[since, until)`."""
+        with self._lock:
+            documents, matrix, times = self.documents, self.matrix, self.times
+        since, until = to_epoch(since), to_epoch(until)
+        matching = np.ones(len(documents), dtype=bool)
+        if since is not None:
+            matching &= times >= since
+        if until is not None:
+            matching &= times < until
+        if not matching.any():
+            return [[] for _ in range(len(queries))]
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = queries @ matrix.T
+        scores[:, ~matching] = -np.inf
+        k = min(top_k, int(matching.sum()))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for row, candidates in enumerate(top):
+            ranked = candidates[np.argsort(-scores[row, candidates])]
+            results.append([dataclasses.replace(documents[i], score=float(scores[row, i])) for i in ranked])
+        return results
+
+
+@dataclass
+class _Pending:
+    question: str
+    future: asyncio.Future
+    since: Optional[float] = None
+    until: Optional[float] = None
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class QueryService:
+    """Answer questions with a retriever pipeline, coalescing concurrent ones."""
+
+    def __init__(
+        self,
+        pipeline: Any,
+        document_store: Any,
+        answer_cache: Optional[SemanticAnswerCache] = None,
+        batch_window: float = 0.01,
+        max_batch: int = 32,
+        max_in_flight: int = 64,
+        generation_concurrency: int = 8,
+        timeout: float = 30.0,
+        top_k: Optional[int] = None,
+        index: Any = None,
+    ):
+        """
+        :param pipeline: Retriever pipeline named like `build_retriever_pipeline`
+            names it, its retriever is replaced by the in-memory matrix search.
+        :param document_store: Store the retriever reads from.
+        :param answer_cache: SemanticAnswerCache, no answer caching if None.
+        :param batch_window: Seconds a batch waits for more questions after
+            its first one arrived.
+        :param max_batch: Most questions embedded and searched together.
+        :param max_in_flight: Most questions accepted at once.
+        :param generation_concurrency: Most answers generated at once.
+        :param timeout: Seconds after which a question is answered with an error.
+        :param top_k: Documents retrieved per question, by default the `top_k`
+            of the pipeline retriever.
+        :param index: Index searched instead of an `EmbeddingMatrix` of
+            `document_store`, e.g. a `SegmentReader`, with `refresh`, `search`
+            and `len`.
+        """
+        self.pipeline = pipeline
+        self.answer_cache = answer_cache
+        self.validate = document_store_validator(document_store)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.top_k = top_k or getattr(pipeline.get_component("retriever"), "top_k", 10)
+        self.index = index if index is not None else EmbeddingMatrix(document_store)
+        self.stats = {"requests": 0, "answered": 0, "cached": 0, "rejected": 0, "timeouts": 0, "errors": 0,
+                      "batches": 0, "batched_questions": 0}
+        self._generation_concurrency = generation_concurrency
+        self._in_flight = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._generation: Optional[asyncio.Semaphore] = None
+        # One thread embeds and searches the batches, the others generate
+        self._batch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="query-batch")
+        self._executor = ThreadPoolExecutor(max_workers=generation_concurrency, thread_name_prefix="query-answer")
+        self._batcher: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._generation = asyncio.Semaphore(self._generation_concurrency)
+        await asyncio.get_running_loop().run_in_executor(self._batch_executor, self.index.refresh)
+        self._batcher = asyncio.create_task(self._run_batches())
+
+    async def close(self) -> None:
+        if self._batcher is not None:
+            self._batcher.cancel()
+        self._batch_executor.shutdown(wait=False)
+        self._executor.shutdown(wait=False)
+
+    async def answer(self, question: str, since: Timestamp = None, until: Timestamp = None) -> Dict[str, Any]:
+        """
+        Answer a question from the documents of `[since, until)`, all of them
+        by default. Answers of questions with a time range are not cached.
+
+        :return: `{"answer", "cached", "documents", "timings"}`
+        :raises ServiceBusy: When `max_in_flight` questions are being answered.
+        :raises asyncio.TimeoutError: When the answer took longer than `timeout`.
+        """
+        self.stats["requests"] += 1
+        if self._in_flight >= self.max_in_flight:
+            self.stats["rejected"] += 1
+            raise ServiceBusy(f"{self._in_flight} questions in flight")
+        self._in_flight += 1
+        try:
+            # Threads already running keep going after a timeout, their
+            # result is dropped
+            result = await asyncio.wait_for(self._answer(question, to_epoch(since), to_epoch(until)), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self._in_flight -= 1
+        self.stats["answered"] += 1
+        self.stats["cached"] += result["cached"]
+        return result
+
+    async def _answer(self, question: str, since: Optional[float], until: Optional[float]) -> Dict[str, Any]:
+        start = time.perf_counter()
+        pending = _Pending(question, asyncio.get_running_loop().create_future(), since, until)
+        await self._queue.put(pending)
+        embedding, documents, timings = await pending.future
+        cache = self.answer_cache if since is None and until is None else None
+
+        if cache is not None:
+            lookup = time.perf_counter()
+            replies = cache.lookup(embedding, validate=self.validate)
+            timings["cache"] = time.perf_counter() - lookup
+            if replies is not None:
+                timings["total"] = time.perf_counter() - start
+                return {"answer": replies[0], "cached": True, "documents": [], "timings": timings}
+
+        waiting = time.perf_counter()
+        async with self._generation:
+            timings["generation_wait"] = time.perf_counter() - waiting
+            answer, sources = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._generate, question, embedding, documents, timings)
+        if cache is not None:
+            cache.store(embedding, [answer], sources)
+        timings["total"] = time.perf_counter() - start
+        return {"answer": answer, "cached": False, "documents": [document.id for document in sources],
+                "timings": timings}
+
+    async def _run_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # Questions that timed out while queued are not embedded
+            batch = [pending for pending in batch if not pending.future.done()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            try:
+                embeddings, results, timings = await loop.run_in_executor(
+                    self._batch_executor, self._embed_and_search, batch)
+            except Exception as e:
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["batched_questions"] += len(batch)
+            for pending, embedding, documents in zip(batch, embeddings, results):
+                if not pending.future.done():
+                    pending.future.set_result(
+                        (embedding, documents, {"queue": started - pending.enqueued, **timings}))
+
+    def _embed_and_search(self, batch: List[_Pending]) -> Tuple[List[List[float]], List[List[Document]], Dict]:
+        start = time.perf_counter()
+        embeddings = embed_batch(self.pipeline.get_component("text_embedder"),
+                                 [pending.question for pending in batch])
+        embedded = time.perf_counter()
+        self.index.refresh()
+        # One search per distinct time range of the batch
+        ranges: Dict[Tuple[Optional[float], Optional[float]], List[int]] = {}
+        for i, pending in enumerate(batch):
+            ranges.setdefault((pending.since, pending.until), []).append(i)
+        queries = np.asarray(embeddings, dtype=np.float32)
+        results: List[List[Document]] = [[] for _ in batch]
+        for (since, until), rows in ranges.items():
+            kwargs = {"since": since, "until": until} if since is not None or until is not None else {}
+            for i, documents in zip(rows, self.index.search(queries[rows], self.top_k, **kwargs)):
+                results[i] = documents
+        timings = {"embed": embedded - start, "search": time.perf_counter() - embedded,
+                   "batch_size": len(batch)}
+        return embeddings, results, timings
+
+    def _generate(self, question: str, embedding: List[float], documents: List[Document],
+                  timings: Dict[str, float]) -> Tuple[str, List[Document]]:
+        start = time.perf_counter()
+        template_variables: Dict[str, Any] = {"question": question, "documents": documents}
+        if "context_packer" in self.pipeline.graph.nodes:
+            packed = self.pipeline.get_component("context_packer").run(documents=documents,
+                                                                       query_embedding=embedding)
+            documents = packed["documents"]
+            template_variables.update(documents=documents, groups=packed["groups"])
+        packed_at = time.perf_counter()
+        prompt = self.pipeline.get_component("prompt_builder").run(**template_variables)["prompt"]
+        prompted = time.perf_counter()
+        replies = self.pipeline.get_component("llm").run(prompt=prompt)["replies"]
+        timings.update(pack=packed_at - start, prompt=prompted - packed_at, generate=time.perf_counter() - prompted)
+        return replies[0] if replies else "", documents
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Counters, the mean batch size and the current load."""
+        batches = self.stats["batches"]
+        return {**self.stats, "in_flight": self._in_flight, "documents": len(self.index),
+                "mean_batch_size": self.stats["batched_questions"] / batches if batches else 0.0}
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+        await writer.drain()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            status, payload = await self._route(reader)
+            await self._respond(writer, status, payload)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, reader: asyncio.StreamReader) -> Tuple[int, Dict[str, Any]]:
+        try:
+            method, path, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+        except ValueError:
+            return 400, {"error": "Malformed request line"}
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        path = path.split("?", 1)[0]
+
+        if path == "/stats":
+            return 200, self.snapshot()
+        if path != "/query":
+            return 404, {"error": f"Unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            return 400, {"error": "Malformed Content-Length"}
+        if length < 0:
+            return 400, {"error": "Malformed Content-Length"}
+        if length > MAX_BODY_BYTES:
+            return 413, {"error": f"Body larger than {MAX_BODY_BYTES} bytes"}
+        try:
+            body = json.loads(await reader.readexactly(length))
+            question = body["question"]
+            since, until = to_epoch(body.get("since")), to_epoch(body.get("until"))
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": 'Send a JSON body like {"question": "...", "since": "2024-05-06T20:00:00Z"}'}
+        if not isinstance(question, str) or not question.strip():
+            return 400, {"error": "The question must be a non-empty string"}
+
+        try:
+            return 200, await self.answer(question, since, until)
+        except ServiceBusy as e:
+            return 503, {"error": str(e)}
+        except asyncio.TimeoutError:
+            return 504, {"error": f"No answer within {self.timeout} seconds"}
+        except Exception as e:
+            logger.exception(f"Failed to answer {question!r}")
+            return 500, {"error": repr(e)}
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8000) -> None:
+        """Serve until cancelled."""
+        await self.start()
+        server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"Answering questions on http://{host}:{port}/query")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+
+def main():
+    from dotenv import load_dotenv
+    from haystack.document_stores.in_memory import InMemoryDocumentStore
+    from rag_pipelines import build_retriever_pipeline
+    from report_generator import build_document_store
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch-window", type=float, default=0.01)
+    parser.add_argument("--max-batch", type=int, default=32)
+    parser.add_argument("--max-in-flight", type=int, default=64)
+    parser.add_argument("--generation-concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--segments", help="Directory of a segment index written by the stream version, "
+                                           "searched live instead of the archived documents")
+    parser.add_argument("--hot-hours", type=float, help="Hours of segments kept mapped, older ones are only "
+                                                        "opened by questions reaching back to them")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(".env")
+    if args.segments:
+        # The pipeline retriever is not used, the service searches the segments
+        index = document_store = SegmentReader(
+            args.segments, hot_window=args.hot_hours * 3600 if args.hot_hours else None)
+        pipeline = build_retriever_pipeline(InMemoryDocumentStore(), os.environ.get("OPENAI_API_KEY"))
+    else:
+        index, document_store = None, build_document_store()
+        pipeline = build_retriever_pipeline(document_store, os.environ.get("OPENAI_API_KEY"))
+    service = QueryService(pipeline, document_store, SemanticAnswerCache(threshold=0.95, ttl=15 * 60), index=index,
+                           batch_window=args.batch_window, max_batch=args.max_batch,
+                           max_in_flight=args.max_in_flight, generation_concurrency=args.generation_concurrency,
+                           timeout=args.timeout)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,11 @@
 
 from haystack import Pipeline
 from haystack.components.embedders import OpenAIDocumentEmbedder
-from haystack.components.preprocessors import DocumentCleaner
-from haystack.components.preprocessors import DocumentSplitter
 from haystack.components.writers import DocumentWriter
 from pathlib import Path
 from haystack.document_stores.types import DuplicatePolicy
 from haystack.utils import Secret
 from haystack_integrations.components.converters.unstructured import UnstructuredFileConverter
-from haystack.components.fetchers import LinkContentFetcher
 from haystack.components.converters import HTMLToDocument
 from haystack.document_stores.in_memory import InMemoryDocumentStore 
 
@@ -24,11 +21,66 @@ from haystack.dataclasses import ByteStream
 from dotenv import load_dotenv
 import os
 import json 
+import time
+import requests
+from rag_common.fetch_cache import get_cache
+from rag_common.query_cache import CachedTextEmbedder, EmbeddingLRUCache
+from rag_common.token_chunker import TokenChunker
+from rag_common.text_cleaner import DocumentTextCleaner
+from rag_common.context_packer import ContextPacker
 
 load_dotenv(".env")
 api_key = os.environ.get("news_api")
 open_ai_key = os.environ.get("OPENAI_API_KEY")
 
+# "Loading..." placeholders and dashed rules left over from the article pages
+NOISE_PATTERNS = [r"(?i:\bloading\b\s*\.*)", r"(?:--\s*-\s*)+"]
+
+
+@component
+class CachedLinkContentFetcher:
+    """
+    Fetch the content of URLs through the shared on-disk fetch cache.
+    Takes the place of LinkContentFetcher so articles fetched by an earlier run
+    are revalidated instead of downloaded again.
+    """
+    def __init__(self, retry_attempts: int = 2, timeout: int = 3):
+        """
+        :param retry_attempts: Number of retries after a failed fetch.
+        :param timeout: Timeout in seconds of each request.
+        """
+        self.retry_attempts = retry_attempts
+        self.timeout = timeout
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        }
+
+    @component.output_types(streams=List[ByteStream])
+    def run(self, urls: List[str]):
+        streams = []
+        for url in urls:
+            response = self._get(url)
+            content_type = response.headers.get("Content-Type", "text/html").split(";")[0].strip()
+            stream = ByteStream(data=response.content, meta={"content_type": content_type, "url": url},
+                                mime_type=content_type)
+            streams.append(stream)
+        return {"streams": streams}
+
+    def _get(self, url: str):
+        error = None
+        for attempt in range(self.retry_attempts + 1):
+            if attempt:
+                time.sleep(2 ** attempt)
+            try:
+                response = get_cache().get(url, headers=self.headers, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response
+                error = f"status code {response.status_code}"
+            except requests.RequestException as e:
+                error = e
+        raise RuntimeError(f"Failed to fetch {url}: {error}")
+
 
 class JSONLReader():
     def __init__(self, metadata_fields=None, link_keyword='url'):
@@ -41,18 +93,10 @@ class JSONLReader():
         self.metadata_fields = metadata_fields or []
         self.link_keyword = link_keyword
         
-        # Set up cleaning mechanism
-        regex_pattern = r"(?i)\bloading\s*\.*\s*|(\s*--\s*-\s*)+"
-
-        fetcher = LinkContentFetcher(retry_attempts=3, timeout=10)
+        fetcher = CachedLinkContentFetcher(retry_attempts=3, timeout=10)
         converter = HTMLToDocument()
-        document_cleaner = DocumentCleaner(
-                            remove_empty_lines=True,
-                            remove_extra_whitespaces=True,
-                            remove_repeated_substrings=False,
-                            remove_substrings=None,  
-                            remove_regex=regex_pattern
-                        )
+        # Set up cleaning mechanism, paragraphs are kept for the chunker
+        document_cleaner = DocumentTextCleaner(noise_patterns=NOISE_PATTERNS, keep_paragraphs=True)
 
         # Initialize pipeline
         self.pipeline = Pipeline()
@@ -97,6 +141,9 @@ class JSONLReader():
                         metadata = {field: data.get(field) for field in self.metadata_fields if field in data}
                         # Assume a pipeline fetches and processes this URL
                         doc = self.pipeline.run({"fetcher": {"urls": [url]}})
+                        # The cleaner drops pages that are only markup or noise
+                        if not doc['cleaner']['documents']:
+                            continue
                         document = doc['cleaner']['documents'][0].content
 
                         # Create a document with fetched content and extracted metadata
@@ -120,7 +167,7 @@ class JSONLReader():
 
 def build_indexing_pipeline(document_store):
 
-    document_splitter = DocumentSplitter(split_by="passage")
+    document_splitter = TokenChunker(max_tokens=512, overlap_tokens=64)
                                                                     
     document_embedder = OpenAIDocumentEmbedder(api_key=Secret.from_token(open_ai_key))
 
@@ -138,18 +185,24 @@ def build_indexing_pipeline(document_store):
 
 
 
-def build_retriever_pipeline(document_store, open_ai_key):
+def build_retriever_pipeline(document_store, open_ai_key, embedding_cache=None, context_tokens=3000):
     """
     Create a pipeline for retrieving documents from the document store.
     
     :param document_store: DocumentStore to read the documents from.
     :param open_ai_key: OpenAI API key.
+    :param embedding_cache: EmbeddingLRUCache for the query embeddings, shared
+        between pipelines if given.
+    :param context_tokens: Token budget of the documents in the prompt.
     
     :return: Pipeline for retrieving documents.
     """
 
-    text_embedder = OpenAITextEmbedder(api_key = Secret.from_token(open_ai_key))
-    retriever = InMemoryEmbeddingRetriever(document_store)
+    text_embedder = CachedTextEmbedder(OpenAITextEmbedder(api_key = Secret.from_token(open_ai_key)),
+                                       cache=embedding_cache or EmbeddingLRUCache())
+    # More candidates than fit the prompt, the packer picks the diverse ones
+    retriever = InMemoryEmbeddingRetriever(document_store, top_k=20, return_embedding=True)
+    context_packer = ContextPacker(max_tokens=context_tokens, meta_fields=())
     generator = OpenAIGenerator(api_key = Secret.from_token(open_ai_key), 
         model="gpt-3.5-turbo")
 
@@ -158,8 +211,11 @@ def build_retriever_pipeline(document_store, open_ai_key):
     answering the question below.
 
     Context:
-    {% for document in documents %}
-        {{ document.content }} symbols: {{ doc.meta['symbols'] }}
+    {% for group in groups %}
+        symbols: {{ group.symbol }} url: {{ group.url }}
+        {% for document in group.documents %}
+        {{ document.content }}
+        {% endfor %}
     {% endfor %}
 
     Question: {{question}}
@@ -174,12 +230,15 @@ def build_retriever_pipeline(document_store, open_ai_key):
     # Add components
     retriever_pipeline.add_component("text_embedder", text_embedder)
     retriever_pipeline.add_component("retriever", retriever)
+    retriever_pipeline.add_component("context_packer", context_packer)
     retriever_pipeline.add_component("prompt_builder", prompt_builder)
     retriever_pipeline.add_component("llm", generator)
 
     # Connect components to one another
     retriever_pipeline.connect("text_embedder.embedding", "retriever.query_embedding")
-    retriever_pipeline.connect("retriever", "prompt_builder.documents")
+    retriever_pipeline.connect("retriever", "context_packer.documents")
+    retriever_pipeline.connect("text_embedder.embedding", "context_packer.query_embedding")
+    retriever_pipeline.connect("context_packer.groups", "prompt_builder.groups")
     retriever_pipeline.connect("prompt_builder", "llm")
 
     return retriever_pipeline
\ No newline at end of file
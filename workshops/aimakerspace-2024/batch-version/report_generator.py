@@ -2,28 +2,54 @@ from dotenv import load_dotenv
 import os
 from rag_pipelines import JSONLReader, build_retriever_pipeline, build_indexing_pipeline
 from haystack.document_stores.in_memory import InMemoryDocumentStore 
+from rag_common.query_cache import SemanticAnswerCache, document_store_validator
+from rag_common.document_archive import ArchiveWriter, archive_files, restore_document_store
+from rag_common.streaming_answers import AnswerTimer, stream_pipeline_answer
+
+# Embedded documents of a previous run, reloaded instead of embedded again
+ARCHIVE_PATH = os.environ.get("DOCUMENT_ARCHIVE", "data/archive")
+
+
+def build_document_store(archive_path=ARCHIVE_PATH):
+    """In-memory document store restored from the archive, or indexed and archived."""
+    document_store = InMemoryDocumentStore(embedding_similarity_function="cosine")
+    if archive_files(archive_path):
+        restore_document_store(document_store, archive_path)
+    else:
+        # Data extraction
+        converter = JSONLReader(metadata_fields=['cik','form_type','link',"url", 'headline', 'symbols'], \
+            link_keyword='url')
+        documents = converter.run(sources=["./data/news_out.jsonl"])
+
+        # Data indexing
+        indexing_pipeline = build_indexing_pipeline(document_store)
+
+        result = indexing_pipeline.run({"splitter": {"documents": documents}}, include_outputs_from={"embedder"})
+        archive = ArchiveWriter(archive_path)
+        archive.write(result["embedder"]["documents"])
+        archive.close()
+    return document_store
+
 
 if __name__ == "__main__":
 
     load_dotenv(".env")
     open_ai_key = os.environ.get("OPENAI_API_KEY")
 
-    # Data extraction
-    # Data indexing
-    converter = JSONLReader(metadata_fields=['cik','form_type','link',"url", 'headline', 'symbols'], \
-        link_keyword='url')
-    documents = converter.run(sources=["./data/news_out.jsonl"])
-
-    # Data indexing
-    document_store = InMemoryDocumentStore(embedding_similarity_function="cosine")
-    indexing_pipeline = build_indexing_pipeline(document_store)
-
-    indexing_pipeline.run({"splitter": {"documents": documents}})
+    document_store = build_document_store()
 
     # Retriever pipeline
     retriever = build_retriever_pipeline(document_store, open_ai_key)
+    answer_cache = SemanticAnswerCache(threshold=0.95, ttl=15 * 60)
     question = "What can you tell me about the information you have"
-    response = retriever.run({"text_embedder": {"text": question}, "prompt_builder": {"question": question}})
+    # Print the report as it is generated, OPENAI_BASE_URL can point at
+    # `python -m rag_common.chat_stub_server` to run offline
+    timer = AnswerTimer()
+    for token in stream_pipeline_answer(retriever, question, timer, answer_cache,
+                                        validate=document_store_validator(document_store)):
+        print(token, end="", flush=True)
+    print()
+    print(f"Time to first token: {timer.time_to_first_token:.2f}s, total: {timer.total:.2f}s ({timer})")
 
 
     
@@ -0,0 +1,37 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from query_service import QueryService
+
+
+def route(request: bytes):
+    pipeline = SimpleNamespace(get_component=lambda name: SimpleNamespace(top_k=5))
+    service = QueryService(pipeline, InMemoryDocumentStore())
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(request)
+        reader.feed_eof()
+        return await service._route(reader)
+
+    try:
+        return asyncio.run(run())
+    finally:
+        asyncio.run(service.close())
+
+
+@pytest.mark.parametrize("length", [b"abc", b"-1"])
+def test_malformed_content_length_is_a_bad_request(length):
+    status, body = route(b"POST /query HTTP/1.1\r\nContent-Length: " + length + b"\r\n\r\n{}")
+
+    assert status == 400
+    assert "Content-Length" in body["error"]
+
+
+def test_body_without_a_question_is_a_bad_request():
+    status, _ = route(b"POST /query HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}")
+
+    assert status == 400
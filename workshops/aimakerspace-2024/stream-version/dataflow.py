@@ -1,20 +1,18 @@
 from bytewax import operators as op
 from bytewax.dataflow import Dataflow
 from bytewax import operators as op
-from bytewax.connectors.stdio import StdOutSink
-from bytewax.connectors.files import FileSource
+from rag_common.compressed_jsonl import CompressedFileSource
+from rag_common.document_archive import DocumentArchiveSink
+from rag_common.segment_index import SegmentSink
 from bytewax.testing import run_main
 
 from haystack import Pipeline
 from haystack.components.embedders import OpenAIDocumentEmbedder
-from haystack.components.preprocessors import DocumentCleaner
-from haystack.components.preprocessors import DocumentSplitter
 from haystack.components.writers import DocumentWriter
 from pathlib import Path
 from haystack.document_stores.types import DuplicatePolicy
 from haystack.utils import Secret
 from haystack_integrations.components.converters.unstructured import UnstructuredFileConverter
-from haystack.components.fetchers import LinkContentFetcher
 from haystack.components.converters import HTMLToDocument
 from haystack.document_stores.in_memory import InMemoryDocumentStore 
 from haystack.components.embedders import AzureOpenAIDocumentEmbedder
@@ -25,10 +23,58 @@ from haystack.dataclasses import ByteStream
 from dotenv import load_dotenv
 import os
 import json 
+import requests
+from rag_common.fetch_cache import get_cache
+from rag_common.token_chunker import TokenChunker
+from rag_common.text_cleaner import DocumentTextCleaner
+from rag_common.near_duplicates import CanonicalEmbeddings, NearDuplicateFilter
+from rag_common.retry_queue import RetryQueue, RetrySource
 
 load_dotenv(".env")
 open_ai_key = os.environ.get("OPENAI_API_KEY")
 
+# "Loading..." placeholders and dashed rules left over from the article pages
+NOISE_PATTERNS = [r"(?i:\bloading\b\s*\.*)", r"(?:--\s*-\s*)+"]
+
+
+@component
+class CachedLinkContentFetcher:
+    """
+    Fetch the content of URLs through the shared on-disk fetch cache.
+    Takes the place of LinkContentFetcher so articles fetched by an earlier run
+    are revalidated instead of downloaded again. A failed fetch raises, the
+    event is retried later by the retry queue of the dataflow.
+    """
+    def __init__(self, timeout: int = 3):
+        """
+        :param timeout: Timeout in seconds of each request.
+        """
+        self.timeout = timeout
+        self.headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36",
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        }
+
+    @component.output_types(streams=List[ByteStream])
+    def run(self, urls: List[str]):
+        streams = []
+        for url in urls:
+            response = self._get(url)
+            content_type = response.headers.get("Content-Type", "text/html").split(";")[0].strip()
+            stream = ByteStream(data=response.content, meta={"content_type": content_type, "url": url},
+                                mime_type=content_type)
+            streams.append(stream)
+        return {"streams": streams}
+
+    def _get(self, url: str):
+        try:
+            response = get_cache().get(url, headers=self.headers, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise RuntimeError(f"Failed to fetch {url}: {e}") from e
+        if response.status_code != 200:
+            raise RuntimeError(f"Failed to fetch {url}: status code {response.status_code}")
+        return response
+
 def safe_deserialize(data):
     try:
         # Attempt to load the JSON data
@@ -75,20 +121,14 @@ class JSONLReader:
         self.metadata_fields = metadata_fields or []
         self.embedding_flag = embedding_flag
         
-        # Set up cleaning mechanism
-        regex_pattern = r"(?i)\bloading\s*\.*\s*|(\s*--\s*-\s*)+"
-
-        fetcher = LinkContentFetcher(retry_attempts=3, timeout=10)
+        fetcher = CachedLinkContentFetcher(timeout=10)
         converter = HTMLToDocument()
-        document_cleaner = DocumentCleaner(
-                            remove_empty_lines=True,
-                            remove_extra_whitespaces=True,
-                            remove_repeated_substrings=False,
-                            remove_substrings=None,  
-                            remove_regex=regex_pattern
-                        )
-        
-        document_splitter = DocumentSplitter(split_by="passage")        
+        # Set up cleaning mechanism, paragraphs are kept for the chunker
+        document_cleaner = DocumentTextCleaner(noise_patterns=NOISE_PATTERNS, keep_paragraphs=True)
+        document_splitter = TokenChunker(max_tokens=512, overlap_tokens=64)
+        # Near duplicates of recent chunks are linked to them instead of embedded
+        near_duplicate_filter = NearDuplicateFilter()
+        canonical_embeddings = CanonicalEmbeddings()
         document_embedder = OpenAIDocumentEmbedder(api_key=Secret.from_token(open_ai_key))                                                   
 
         # Initialize pipeline
@@ -99,13 +139,18 @@ class JSONLReader:
         self.pipeline.add_component("converter", converter)
         self.pipeline.add_component("cleaner", document_cleaner)
         self.pipeline.add_component("splitter", document_splitter)
+        self.pipeline.add_component("dedup", near_duplicate_filter)
         self.pipeline.add_component("embedder", document_embedder)
+        self.pipeline.add_component("canonical", canonical_embeddings)
 
         # Connect components
         self.pipeline.connect("fetcher", "converter")
         self.pipeline.connect("converter", "cleaner")
         self.pipeline.connect("cleaner", "splitter")
-        self.pipeline.connect("splitter", "embedder")
+        self.pipeline.connect("splitter", "dedup")
+        self.pipeline.connect("dedup.documents", "embedder")
+        self.pipeline.connect("embedder.documents", "canonical.documents")
+        self.pipeline.connect("dedup.duplicates", "canonical.duplicates")
 
     @component.output_types(documents=List[Document])
     def run(self, event: List[Union[str, Path, ByteStream]]):
@@ -113,7 +158,7 @@ class JSONLReader:
         Process each source file, read URLs and their associated metadata,
         fetch HTML content using a pipeline, and convert to Haystack Documents.
         :param sources: File paths or ByteStreams to process.
-        :return: A list of Haystack Documents.
+        :return: A list of Haystack Documents, one per chunk.
         """
 
         # Extract URL and modify it if necessary
@@ -126,21 +171,20 @@ class JSONLReader:
         # Assume a pipeline fetches and processes this URL
         doc = self.pipeline.run({"fetcher": {"urls": [url]}})
         print(doc)
-        document_obj = doc['embedder']['documents'][0]
-        content = document_obj.content
-        additional_metadata = document_obj.meta
-
-        if self.embedding_flag:
-            embedding = document_obj.embedding
-            # Safely access the embedding metadata
-            embedding_metadata = doc.get('embedder', {}).get('meta', {})
-            metadata.update(embedding_metadata) 
-            document = Document(id=document_obj.id, content=content, meta=metadata, embedding=embedding)
-
-        metadata.update(additional_metadata)
-         # Merge embedding metadata
-        document = Document(id=document_obj.id, content=content, meta=metadata)
-        return document
+        # Safely access the embedding metadata
+        embedding_metadata = doc.get('embedder', {}).get('meta', {})
+
+        documents = []
+        # Near duplicates have the embedding and, in duplicate_of, the id of their canonical chunk
+        for document_obj in doc['canonical']['documents'] + doc['canonical']['duplicates']:
+            chunk_metadata = {**metadata, **document_obj.meta}
+            if self.embedding_flag:
+                chunk_metadata.update(embedding_metadata)
+                documents.append(Document(id=document_obj.id, content=document_obj.content, meta=chunk_metadata,
+                                          embedding=document_obj.embedding))
+            else:
+                documents.append(Document(id=document_obj.id, content=document_obj.content, meta=chunk_metadata))
+        return documents
     
     def document_to_dict(self, document: Document, ) -> Dict:
         """
@@ -168,22 +212,38 @@ class JSONLReader:
 
     
 
-jsonl_reader = JSONLReader(metadata_fields=['symbols', 'headline', 'url'],
+jsonl_reader = JSONLReader(metadata_fields=['symbols', 'headline', 'url', 'created_at', 'updated_at'],
                            
                            open_ai_key=open_ai_key,
-                           embedding_flag=False)
+                           embedding_flag=True)
 
 def process_event(event):
     """Wrapper to handle the processing of each event."""
     if event:
-        document = jsonl_reader.run(event)
-        return jsonl_reader.document_to_dict(document)
-    return None
+        documents = jsonl_reader.run(event)
+        return [jsonl_reader.document_to_dict(document) for document in documents]
+    return []
+
 
+# Articles whose fetch or embedding fails are retried with a growing delay
+# while the next ones are processed, and written to the dead-letter file
+# after the last attempt. The retries end two minutes after the last
+# article so the dataflow can finish
+retries = RetryQueue(dead_letter_path="data/dead_letter.jsonl", idle_timeout=120.0)
 
 flow = Dataflow("rag-pipeline")
-input_data = op.input("input", flow, FileSource("data/news_out.jsonl"))
+input_data = op.input("input", flow, CompressedFileSource("data/news_out.jsonl"))
 deserialize_data = op.map("deserialize", input_data, safe_deserialize)
-extract_html = op.map("extract_html", deserialize_data, process_event)
-
-op.output("output", extract_html, StdOutSink())
+retried = op.input("retries", flow, RetrySource(retries))
+events = op.merge("with_retries", deserialize_data, retried)
+extract_html = op.flat_map("extract_html", events, retries.guard(process_event))
+
+# Documents, metadata and embeddings are archived as Parquet, a store can be
+# rebuilt from them with document_archive.restore_document_store
+op.output("output", extract_html, DocumentArchiveSink("data/archive"))
+
+# Every batch is also published to the segment index the batch version query
+# service searches live: python query_service.py --segments ../stream-version/data/segments
+# Segments are bucketed by hour of updated_at, compacted every minute and,
+# with a ttl in seconds, deleted once they are older
+op.output("live_index", extract_html, SegmentSink("data/segments", bucket_seconds=3600, ttl=None))
@@ -0,0 +1,5 @@
+"""Modules shared by the workshop pipelines.
+
+Installed once with `pip install -e workshops/common` and imported as
+`rag_common.<module>` from every workshop.
+"""
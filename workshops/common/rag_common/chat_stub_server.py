@@ -0,0 +1,198 @@
+"""Local stand-in for the OpenAI and Azure OpenAI chat and embedding APIs.
+
+Serves `/v1/chat/completions` and `/v1/embeddings`, and the Azure paths
+`/openai/deployments/<name>/chat/completions` and `.../embeddings`, with
+the request and response format of the real APIs, including server-sent
+events for `"stream": true`. Answers are made of the sentences of the prompt
+that share the most words with the question, emitted word by word after a
+configurable delay, so streaming, time-to-first-token and the retriever
+pipelines can be tried without network access or an API key. Embeddings come
+from the HashingEmbedder.
+
+    python -m rag_common.chat_stub_server --port 8800 --first-token-delay 0.3 --token-delay 0.02
+
+    OPENAI_BASE_URL=http://127.0.0.1:8800/v1 OPENAI_API_KEY=stub python report_generator.py
+    AzureOpenAI(azure_endpoint="http://127.0.0.1:8800", api_key="stub", api_version="2023-10-01-preview")
+"""
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .local_embedder import HashingEmbedder
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+")
+
+
+def stub_answer(messages: List[Dict[str, Any]], max_words: int = 120) -> str:
+    """The prompt sentences sharing the most words with the last line of the prompt."""
+    prompt = "\n".join(str(message.get("content") or "") for message in messages)
+    lines = [line for line in prompt.splitlines() if line.strip()]
+    question = set(WORD_PATTERN.findall(lines[-1].lower())) if lines else set()
+    sentences = [sentence.strip() for sentence in SENTENCE_PATTERN.split(" ".join(lines[:-1])) if sentence.strip()]
+    ranked = sorted(sentences, key=lambda sentence: -len(question & set(WORD_PATTERN.findall(sentence.lower()))))
+    words = " ".join(ranked[:5]).split()[:max_words]
+    return " ".join(words) if words else "I could not find any information about that."
+
+
+class StubServer:
+    """A chat completion and embedding server running in a background thread."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8800, first_token_delay: float = 0.3,
+                 token_delay: float = 0.02, dimensions: int = 1536):
+        """
+        :param port: Port to listen on, 0 picks a free one.
+        :param first_token_delay: Seconds before the first token, like the
+            prompt processing of a real model.
+        :param token_delay: Seconds between two streamed tokens.
+        :param dimensions: Dimensions of the embeddings.
+        """
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.embedder = HashingEmbedder(dimensions=dimensions)
+        server = self
+
+        class Handler(_Handler):
+            stub = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True, name="chat-stub-server")
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "StubServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    stub: StubServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _model(self, body: Dict[str, Any]) -> str:
+        match = re.search(r"/deployments/([^/]+)/", self.path)
+        return body.get("model") or (match.group(1) if match else "stub")
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body", "type": "invalid_request_error"}})
+            return
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/chat/completions"):
+            self._chat(body)
+        elif path.endswith("/embeddings"):
+            self._embeddings(body)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}})
+
+    def _embeddings(self, body: Dict[str, Any]) -> None:
+        texts = body.get("input")
+        texts = [texts] if isinstance(texts, str) else list(texts or [])
+        vectors = self.stub.embedder.embed([str(text) for text in texts])
+        tokens = sum(len(str(text).split()) for text in texts)
+        self._send_json(200, {
+            "object": "list",
+            "model": self._model(body),
+            "data": [{"object": "embedding", "index": i, "embedding": vector.tolist()}
+                     for i, vector in enumerate(vectors)],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def _chat(self, body: Dict[str, Any]) -> None:
+        messages = body.get("messages") or []
+        answer = stub_answer(messages, max_words=int(body.get("max_tokens") or 120))
+        prompt_tokens = sum(len(str(message.get("content") or "").split()) for message in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(answer.split()),
+                 "total_tokens": prompt_tokens + len(answer.split())}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = self._model(body)
+        time.sleep(self.stub.first_token_delay)
+        if not body.get("stream"):
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer},
+                             "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for delta, finish_reason in self._deltas(answer):
+            self._event({
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            })
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _deltas(self, answer: str) -> Iterator[Tuple[Dict[str, str], Optional[str]]]:
+        yield {"role": "assistant", "content": ""}, None
+        for i, word in enumerate(answer.split(" ")):
+            if i:
+                time.sleep(self.stub.token_delay)
+            yield {"content": word if i == 0 else f" {word}"}, None
+        yield {}, "stop"
+
+    def _event(self, payload: Dict[str, Any]) -> None:
+        self._write_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--first-token-delay", type=float, default=0.3)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    args = parser.parse_args()
+    server = StubServer(args.host, args.port, args.first_token_delay, args.token_delay)
+    print(f"Serving OpenAI compatible chat completions and embeddings on {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
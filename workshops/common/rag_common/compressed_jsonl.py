@@ -0,0 +1,192 @@
+"""Line sources for plain, gzip and zstd compressed JSONL files.
+
+Archives are decompressed as a stream while they are read, so they stay
+compressed on disk and no separate decompression step is needed. The
+position of a compressed file is a checkpoint in the compressed stream:
+the byte offset of the gzip member or zstd frame holding the next line and
+the number of lines of that member already read. A resumed partition seeks
+to the member and decompresses only the lines it skips, so resuming costs at
+most one member. `write_jsonl_archive` writes archives with a new member
+every `lines_per_member` lines to keep that cost small. Single member
+archives, as written by `gzip` or `zstd`, work too, but resume from the
+start of the file.
+
+Compression is detected from the magic bytes of the file. Zstd needs the
+`zstandard` package.
+"""
+import gzip
+import zlib
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from bytewax.connectors.files import FileSource, _FileSourcePartition, _get_path_dev
+from bytewax.inputs import StatefulSourcePartition, batch
+from typing_extensions import override
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Compressed bytes read at once
+READ_SIZE = 1 << 20
+
+# Position in a compressed file: offset of the member holding the next line
+# and the lines of that member before it
+Checkpoint = Tuple[int, int]
+
+
+def detect_compression(path: Union[Path, str]) -> Optional[str]:
+    """`"gzip"`, `"zstd"` or None for a plain file."""
+    with open(path, "rb") as file:
+        magic = file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def _decompressor(compression: str):
+    """Decompressor of a single gzip member or zstd frame."""
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("Reading zstd archives needs the zstandard package: pip install zstandard") from e
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def _members(file: BinaryIO, compression: str, offset: int) -> Iterator[Tuple[int, bytes]]:
+    """Decompressed blocks with the offset of the member they belong to."""
+    file.seek(offset)
+    decompressor = _decompressor(compression)
+    member = offset
+    data = b""
+    while True:
+        if not data:
+            data = file.read(READ_SIZE)
+            if not data:
+                return
+            offset += len(data)
+        block = decompressor.decompress(data)
+        if block:
+            yield member, block
+        if not decompressor.eof:
+            data = b""
+            continue
+        # The member ended, what is left of the read starts the next one
+        data = decompressor.unused_data
+        member = offset - len(data)
+        decompressor = _decompressor(compression)
+
+
+class _CompressedFileSourcePartition(StatefulSourcePartition[str, Checkpoint]):
+    def __init__(self, path: Path, batch_size: int, resume_state: Optional[Checkpoint], compression: str):
+        self._f = open(path, "rb")
+        self._compression = compression
+        self._checkpoint: Checkpoint = resume_state or (0, 0)
+        self._batcher = batch(self._lines(), batch_size)
+
+    def _lines(self) -> Iterator[str]:
+        member, skip = self._checkpoint
+        current, count, pending = member, 0, b""
+        for member, block in _members(self._f, self._compression, member):
+            if member != current:
+                current, count = member, 0
+            lines = (pending + block).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                count += 1
+                if skip:
+                    skip -= 1
+                    continue
+                # Set before the line is handed out, a snapshot after it
+                # resumes at the next line
+                self._checkpoint = (current, count)
+                yield line.decode("utf-8").rstrip("\r")
+        if pending:
+            self._checkpoint = (current, count + 1)
+            yield pending.decode("utf-8").rstrip("\r")
+
+    @override
+    def next_batch(self) -> List[str]:
+        return next(self._batcher)
+
+    @override
+    def snapshot(self) -> Checkpoint:
+        return self._checkpoint
+
+    @override
+    def close(self) -> None:
+        self._f.close()
+
+
+def open_partition(path: Path, batch_size: int, resume_state) -> StatefulSourcePartition:
+    """Partition reading a plain or compressed file, resuming at `resume_state`."""
+    compression = detect_compression(path)
+    if compression is None:
+        return _FileSourcePartition(path, batch_size, resume_state)
+    return _CompressedFileSourcePartition(path, batch_size, resume_state, compression)
+
+
+class CompressedFileSource(FileSource):
+    """Read a plain, gzip or zstd compressed file line-by-line."""
+
+    def __init__(
+        self,
+        path: Union[Path, str],
+        batch_size: int = 1000,
+        get_fs_id: Callable[[Path], str] = _get_path_dev,
+    ):
+        """Init.
+
+        :arg path: Path to the file, compressed or not.
+
+        :arg batch_size: Number of lines to read per batch. Defaults
+            to 1000.
+
+        :arg get_fs_id: See {py:obj}`bytewax.connectors.files.FileSource`.
+
+        """
+        super().__init__(path, batch_size, get_fs_id)
+
+    @override
+    def build_part(
+        self, step_id: str, for_part: str, resume_state: Optional[Union[int, Checkpoint]]
+    ) -> StatefulSourcePartition:
+        _fs_id, path = for_part.split("::", 1)
+        assert path == str(self._path), "Can't resume reading from different file"
+        return open_partition(self._path, self._batch_size, resume_state)
+
+
+def write_jsonl_archive(path: Union[Path, str], lines: Iterable[str], compression: str = "gzip",
+                        lines_per_member: int = 10000, level: int = 6) -> int:
+    """
+    Write lines to a compressed archive, starting a new gzip member or zstd
+    frame every `lines_per_member` lines so readers can resume quickly.
+
+    :return: Number of lines written.
+    """
+    if compression == "zstd":
+        _decompressor("zstd")
+        import zstandard
+        compress = zstandard.ZstdCompressor(level=level).compress
+    elif compression == "gzip":
+        def compress(data: bytes) -> bytes:
+            return gzip.compress(data, compresslevel=level, mtime=0)
+    else:
+        raise ValueError(f"Unknown compression {compression!r}, use gzip or zstd")
+
+    written = 0
+    member: List[str] = []
+    with open(path, "wb") as file:
+        for line in lines:
+            member.append(line.rstrip("\n"))
+            if len(member) == lines_per_member:
+                file.write(compress(("\n".join(member) + "\n").encode("utf-8")))
+                written += len(member)
+                member = []
+        if member:
+            file.write(compress(("\n".join(member) + "\n").encode("utf-8")))
+            written += len(member)
+    return written
@@ -0,0 +1,222 @@
+"""Token budgeted assembly of the retrieved context of a prompt.
+
+The prompt templates used to render every retrieved document verbatim. A
+Benzinga story retrieved together with its three updates, or a few long SEC
+chunks, make the prompt large, slow and expensive without adding information.
+`ContextPacker` sits between the retriever and the PromptBuilder:
+
+1. Maximal marginal relevance picks documents that are relevant to the query
+   and unlike the ones already picked, near duplicates are dropped outright.
+2. The picked documents are packed into `max_tokens` tokens, a document that
+   no longer fits is cut at a sentence when enough of the budget is left.
+3. The documents are grouped by symbol and source url, so the template
+   prints the symbol and url of a group once instead of for every chunk.
+
+The tokens of the retrieved documents, of the packed ones and the
+difference are reported for every query in the `stats` output.
+"""
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from haystack import Document, component
+
+from .token_chunker import SENTENCE_BREAK, TokenCounter
+
+logger = logging.getLogger(__name__)
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Dimensions of the hashed term vectors used when documents have no embedding
+LEXICAL_DIMENSIONS = 4096
+
+
+def _first(value: Any) -> Optional[str]:
+    if isinstance(value, (list, tuple)):
+        return str(value[0]) if value else None
+    return str(value) if value else None
+
+
+def lexical_vectors(texts: Sequence[str], dimensions: int = LEXICAL_DIMENSIONS) -> np.ndarray:
+    """Normalized hashed term counts of texts, similar for near-duplicate texts."""
+    vectors = np.zeros((len(texts), dimensions), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in WORD_PATTERN.findall(text.lower()):
+            vectors[row, int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "little")
+                    % dimensions] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def maximal_marginal_relevance(relevance: np.ndarray, similarity: np.ndarray, diversity: float,
+                               duplicate_threshold: float) -> Tuple[List[int], List[int]]:
+    """
+    Order candidates by maximal marginal relevance.
+
+    :param relevance: Relevance of every candidate to the query, in [0, 1].
+    :param similarity: Pairwise similarity of the candidates.
+    :param diversity: Weight of the novelty, 0 ranks by relevance only.
+    :param duplicate_threshold: Candidates at least this similar to a picked one are dropped.
+    :return: The picked candidates in order and the dropped duplicates.
+    """
+    picked: List[int] = []
+    duplicates: List[int] = []
+    remaining = list(range(len(relevance)))
+    closest = np.full(len(relevance), -np.inf if len(relevance) else 0.0)
+    while remaining:
+        redundancy = np.where(np.isinf(closest[remaining]), 0.0, closest[remaining])
+        scores = (1 - diversity) * relevance[remaining] - diversity * redundancy
+        best = remaining.pop(int(np.argmax(scores)))
+        if picked and closest[best] >= duplicate_threshold:
+            duplicates.append(best)
+            continue
+        picked.append(best)
+        closest = np.maximum(closest, similarity[best])
+    return picked, duplicates
+
+
+@component
+class ContextPacker:
+    """
+    Select, pack and group retrieved documents for a prompt, see the module
+    docstring. Connect the retriever to `documents` and, optionally, the
+    query embedding to `query_embedding`. The template can render the
+    `documents` in order or iterate over the `groups`, each with a `symbol`,
+    a `url` and its `documents`.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 3000,
+        diversity: float = 0.3,
+        duplicate_threshold: float = 0.95,
+        meta_fields: Iterable[str] = ("headline", "summary"),
+        group_fields: Tuple[str, str] = ("symbols", "url"),
+        min_tokens: int = 64,
+        counter: Optional[TokenCounter] = None,
+    ):
+        """
+        :param max_tokens: Token budget of the packed documents.
+        :param diversity: MMR trade-off, 0 keeps the retrieval order, higher
+            values prefer documents unlike those already picked.
+        :param duplicate_threshold: Cosine similarity from which a document is
+            a near duplicate of a picked one and dropped.
+        :param meta_fields: Metadata fields the template renders next to the
+            content, counted in the budget.
+        :param group_fields: Metadata fields of the symbol and source url of
+            a document.
+        :param min_tokens: Smallest part of the budget a cut document is
+            packed into.
+        :param counter: Token counter, by default the approximate one.
+        """
+        self.max_tokens = max_tokens
+        self.diversity = diversity
+        self.duplicate_threshold = duplicate_threshold
+        self.meta_fields = tuple(meta_fields)
+        self.group_fields = group_fields
+        self.min_tokens = min_tokens
+        self.counter = counter or TokenCounter()
+        self.totals = {"queries": 0, "tokens_retrieved": 0, "tokens_packed": 0, "tokens_saved": 0,
+                       "duplicates": 0}
+        # One packer serves the queries of all threads of a service
+        self._lock = threading.Lock()
+
+    def _rendered(self, document: Document) -> str:
+        fields = [str(document.meta[field]) for field in self.meta_fields if document.meta.get(field)]
+        return " ".join([document.content or ""] + fields)
+
+    def _group_key(self, document: Document) -> Tuple[Optional[str], Optional[str]]:
+        symbol_field, url_field = self.group_fields
+        return _first(document.meta.get(symbol_field)), document.meta.get(url_field)
+
+    def _relevance(self, documents: List[Document], query_embedding: Optional[List[float]],
+                   embeddings: Optional[np.ndarray]) -> np.ndarray:
+        if query_embedding is not None and embeddings is not None:
+            relevance = embeddings @ _normalize(np.asarray(query_embedding, dtype=np.float32))
+        elif all(document.score is not None for document in documents):
+            relevance = np.array([document.score for document in documents], dtype=np.float32)
+        else:
+            # Retrieval order
+            relevance = -np.arange(len(documents), dtype=np.float32)
+        spread = relevance.max() - relevance.min()
+        return (relevance - relevance.min()) / spread if spread else np.ones(len(documents), dtype=np.float32)
+
+    def _truncate(self, document: Document, budget: int) -> Optional[Document]:
+        """The document cut after the last sentence that fits the budget."""
+        overhead = self.counter(self._rendered(Document(content="", meta=document.meta)))
+        kept, used = [], overhead
+        for sentence in SENTENCE_BREAK.split(document.content or ""):
+            tokens = self.counter(sentence)
+            if used + tokens > budget:
+                break
+            kept.append(sentence)
+            used += tokens
+        if not kept:
+            return None
+        return Document(id=document.id, content=" ".join(kept), meta={**document.meta, "truncated": True},
+                        score=document.score, embedding=document.embedding)
+
+    @component.output_types(documents=List[Document], groups=List[Dict[str, Any]], stats=Dict[str, int])
+    def run(self, documents: List[Document], query_embedding: Optional[List[float]] = None):
+        if not documents:
+            return {"documents": [], "groups": [], "stats": {"retrieved": 0, "packed": 0, "duplicates": 0,
+                                                            "tokens_retrieved": 0, "tokens_packed": 0,
+                                                            "tokens_saved": 0}}
+        tokens = [self.counter(self._rendered(document)) for document in documents]
+        embeddings = None
+        if all(document.embedding is not None for document in documents):
+            embeddings = _normalize(np.asarray([document.embedding for document in documents], dtype=np.float32))
+            similarity = embeddings @ embeddings.T
+        else:
+            vectors = lexical_vectors([document.content or "" for document in documents])
+            similarity = vectors @ vectors.T
+        relevance = self._relevance(documents, query_embedding, embeddings)
+        order, duplicates = maximal_marginal_relevance(relevance, similarity, self.diversity,
+                                                       self.duplicate_threshold)
+
+        packed: List[Tuple[int, Document]] = []
+        budget = self.max_tokens
+        for index in order:
+            if tokens[index] <= budget:
+                packed.append((index, documents[index]))
+                budget -= tokens[index]
+            elif budget >= self.min_tokens:
+                truncated = self._truncate(documents[index], budget)
+                if truncated is not None:
+                    packed.append((index, truncated))
+                    budget -= self.counter(self._rendered(truncated))
+
+        # Groups in the order of their most relevant document, documents of a
+        # group in the order they were picked
+        groups: "OrderedDict[Tuple[Optional[str], Optional[str]], List[Document]]" = OrderedDict()
+        for _, document in packed:
+            groups.setdefault(self._group_key(document), []).append(document)
+        grouped = [{"symbol": symbol, "url": url, "documents": members}
+                   for (symbol, url), members in groups.items()]
+
+        tokens_retrieved = sum(tokens)
+        tokens_packed = self.max_tokens - budget
+        stats = {
+            "retrieved": len(documents),
+            "packed": len(packed),
+            "duplicates": len(duplicates),
+            "tokens_retrieved": tokens_retrieved,
+            "tokens_packed": tokens_packed,
+            "tokens_saved": tokens_retrieved - tokens_packed,
+        }
+        with self._lock:
+            self.totals["queries"] += 1
+            for key in ("tokens_retrieved", "tokens_packed", "tokens_saved", "duplicates"):
+                self.totals[key] += stats[key]
+        logger.info(f"Packed {stats['packed']} of {stats['retrieved']} documents ({stats['duplicates']} near "
+                    f"duplicates) into {tokens_packed} tokens, {stats['tokens_saved']} tokens saved")
+        return {"documents": [document for members in groups.values() for document in members],
+                "groups": grouped, "stats": stats}
@@ -0,0 +1,373 @@
+"""Columnar archive of processed documents and their embeddings.
+
+JSON output stores every embedding as a list of decimal floats, about 20
+bytes per dimension, and reloading it parses every one of them again. The
+archive stores documents as Parquet or Arrow IPC files instead:
+
+- `id` and `content` as strings, the metadata as a JSON string column, so
+  documents with different metadata fields share one schema;
+- `embedding` as `fixed_size_list<float32>[dimensions]`, 4 bytes per
+  dimension, null for documents that were not embedded.
+
+`DocumentArchiveSink` writes the output of a dataflow to rolling files, one
+sequence of files per worker and run. The names carry the time the writer
+started, so a restarted writer never reuses the name of a file that was
+deleted, e.g. compacted away, while a reader still maps it. A file becomes
+readable when it is finished: after `rows_per_file` documents or, in the
+sink, `roll_interval` seconds after its first document. Documents of the
+unfinished file are lost if the process dies, and the hidden `.tmp` file it
+leaves behind is not read. `read_archive` loads an archive back with the
+embeddings as one float32 matrix. Every record batch is a NumPy view of its
+Arrow buffer, of the memory mapped file for uncompressed Arrow files, so the
+only copy is one concatenation of the batches. `restore_document_store`
+fills a document store from the archive. A store can
+then be rebuilt after a schema change or a migration without calling the
+embedding API again.
+"""
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from bytewax.outputs import DynamicSink, StatelessSinkPartition
+from haystack import Document
+from haystack.document_stores.types import DuplicatePolicy
+from typing_extensions import override
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+def archive_schema(dimensions: Optional[int]) -> pa.Schema:
+    """Schema of the files, the embedding column is null until the dimensions are known."""
+    return pa.schema([
+        pa.field("id", pa.string(), nullable=False),
+        pa.field("content", pa.string()),
+        pa.field("meta", pa.string()),
+        pa.field("embedding", pa.list_(pa.float32(), dimensions) if dimensions else pa.null()),
+    ])
+
+
+def _row(item: Union[Document, Dict[str, Any]]) -> Dict[str, Any]:
+    """Id, content, meta and embedding of a Document or of its dictionary."""
+    if isinstance(item, Document):
+        return {"id": item.id, "content": item.content, "meta": item.meta, "embedding": item.embedding}
+    embedding = item.get("embedding", item.get("vector"))
+    return {"id": item["id"], "content": item.get("content"), "meta": item.get("meta") or {},
+            "embedding": embedding}
+
+
+class ArchiveWriter:
+    """Append documents to rolling Parquet or Arrow files in a directory."""
+
+    def __init__(self, directory: Union[Path, str], prefix: str = "documents", format: str = "parquet",
+                 rows_per_file: int = 100_000, rows_per_batch: int = 1024, compression: Optional[str] = "zstd",
+                 dimensions: Optional[int] = None, roll_interval: Optional[float] = None):
+        """
+        :param directory: Directory of the archive, created if missing.
+        :param prefix: Start of the file names, e.g. one per worker.
+        :param format: `parquet`, compact, or `arrow`, an IPC file that is
+            memory mapped when read back.
+        :param rows_per_file: Documents per file before rolling to the next.
+        :param rows_per_batch: Documents buffered per row group or record batch.
+        :param compression: Codec of the files, None to leave them
+            uncompressed. Compressed Arrow files are decompressed on read.
+        :param dimensions: Dimensions of the embeddings, by default those
+            of the first embedding written.
+        :param roll_interval: Seconds after the first document of a file
+            at which `roll_if_due` finishes it, None to roll by rows only.
+        """
+        if format not in FORMATS:
+            raise ValueError(f"format must be one of {list(FORMATS)}")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.format = format
+        self.rows_per_file = rows_per_file
+        self.rows_per_batch = rows_per_batch
+        self.compression = compression
+        self.dimensions = dimensions
+        self.roll_interval = roll_interval
+        self.files: List[Path] = []
+
+        self._rows: List[Dict[str, Any]] = []
+        self._writer = None
+        self._path: Optional[Path] = None
+        self._temporary: Optional[Path] = None
+        self._schema: Optional[pa.Schema] = None
+        self._file_rows = 0
+        self._first_row: Optional[float] = None  # When the first document of the file arrived
+        # Fixed width, so the files of a prefix sort in the order they were written
+        self._run = f"{time.time_ns():016x}"
+        self._sequence = 0
+
+    def write(self, items: Iterable[Union[Document, Dict[str, Any]]]) -> None:
+        for item in items:
+            if self._first_row is None:
+                self._first_row = time.monotonic()
+            self._rows.append(_row(item))
+            if len(self._rows) >= self.rows_per_batch:
+                self._write_rows()
+
+    def roll_if_due(self) -> bool:
+        """Finish the current file if its first document is older than `roll_interval`."""
+        if self.roll_interval is None or self._first_row is None:
+            return False
+        if time.monotonic() - self._first_row < self.roll_interval:
+            return False
+        self.close()
+        return True
+
+    def _batch(self, rows: List[Dict[str, Any]]) -> pa.RecordBatch:
+        embeddings = [row["embedding"] for row in rows]
+        if self.dimensions is None:
+            self.dimensions = next((len(embedding) for embedding in embeddings if embedding is not None), None)
+        dimensions = self.dimensions
+        if dimensions is None:
+            embedding_array = pa.nulls(len(rows))
+        else:
+            matrix = np.zeros((len(rows), dimensions), dtype=np.float32)
+            valid = np.zeros(len(rows), dtype=bool)
+            for i, embedding in enumerate(embeddings):
+                if embedding is None:
+                    continue
+                if len(embedding) != dimensions:
+                    raise ValueError(f"Embedding of {rows[i]['id']} has {len(embedding)} dimensions, "
+                                     f"the archive has {dimensions}")
+                matrix[i] = embedding
+                valid[i] = True
+            embedding_array = pa.FixedSizeListArray.from_arrays(pa.array(matrix.ravel(), pa.float32()), dimensions,
+                                                                mask=pa.array(~valid))
+        return pa.RecordBatch.from_arrays([
+            pa.array([row["id"] for row in rows], pa.string()),
+            pa.array([row["content"] for row in rows], pa.string()),
+            pa.array([json.dumps(row["meta"], default=str) for row in rows], pa.string()),
+            embedding_array,
+        ], schema=archive_schema(dimensions))
+
+    def _write_rows(self) -> None:
+        rows, self._rows = self._rows, []
+        while rows:
+            take = min(len(rows), self.rows_per_file - self._file_rows)
+            batch = self._batch(rows[:take])
+            if self._writer is not None and not batch.schema.equals(self._schema):
+                # The first embedding arrived after documents without one
+                self._roll()
+                continue
+            if self._writer is None:
+                self._open(batch.schema)
+                if self._first_row is None:
+                    self._first_row = time.monotonic()
+            self._writer.write_batch(batch)
+            self._file_rows += take
+            rows = rows[take:]
+            if self._file_rows >= self.rows_per_file:
+                self._roll()
+
+    def _open(self, schema: pa.Schema) -> None:
+        name = f"{self.prefix}-{self._run}-{self._sequence:06d}{FORMATS[self.format]}"
+        self._path = self.directory / name
+        # Written under a temporary name, readers only see finished files
+        temporary = self.directory / f".{name}.tmp"
+        if self.format == "parquet":
+            self._writer = pq.ParquetWriter(temporary, schema, compression=self.compression or "none")
+        else:
+            options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            self._writer = pa.ipc.new_file(str(temporary), schema, options=options)
+        self._temporary = temporary
+        self._schema = schema
+
+    def _roll(self) -> None:
+        if self._writer is None:
+            return
+        self._writer.close()
+        os.replace(self._temporary, self._path)
+        self.files.append(self._path)
+        self._writer = None
+        self._file_rows = 0
+        self._sequence += 1
+        self._first_row = None
+
+    def close(self) -> List[Path]:
+        """Write the buffered documents and finish the current file."""
+        if self._rows:
+            self._write_rows()
+        self._roll()
+        return self.files
+
+
+class _DocumentArchivePartition(StatelessSinkPartition[Any]):
+    def __init__(self, writer: ArchiveWriter):
+        self._writer = writer
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        if writer.roll_interval:
+            # Rolls the file of an idle stream too, between two batches
+            self._timer = threading.Thread(target=self._roll_when_due, daemon=True, name="archive-roll")
+            self._timer.start()
+
+    def _roll_when_due(self) -> None:
+        while not self._stop.wait(min(self._writer.roll_interval, 1.0)):
+            with self._lock:
+                self._writer.roll_if_due()
+
+    @override
+    def write_batch(self, items: List[Any]) -> None:
+        with self._lock:
+            self._writer.write(items)
+            self._writer.roll_if_due()
+
+    @override
+    def close(self) -> None:
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join()
+        with self._lock:
+            self._writer.close()
+
+
+class DocumentArchiveSink(DynamicSink[Any]):
+    """Write Documents, or their dictionaries, to a columnar archive."""
+
+    def __init__(self, directory: Union[Path, str], format: str = "parquet", rows_per_file: int = 10_000,
+                 rows_per_batch: int = 1024, compression: Optional[str] = "zstd",
+                 roll_interval: Optional[float] = 60.0):
+        """Init.
+
+        :arg directory: Directory of the archive.
+
+        :arg format: `parquet` or `arrow`.
+
+        :arg rows_per_file: Documents per file before a new file is
+            started.
+
+        :arg rows_per_batch: Documents buffered before they are
+            written.
+
+        :arg compression: Codec of the files, None for uncompressed.
+
+        :arg roll_interval: Seconds after its first document at which a
+            file is finished even if it is not full, which bounds both
+            the delay before documents are readable and the documents
+            lost if the process dies. None to roll by rows only.
+
+        """
+        self._directory = directory
+        self._format = format
+        self._rows_per_file = rows_per_file
+        self._rows_per_batch = rows_per_batch
+        self._compression = compression
+        self._roll_interval = roll_interval
+
+    @override
+    def build(self, _step_id: str, worker_index: int, _worker_count: int) -> _DocumentArchivePartition:
+        return _DocumentArchivePartition(ArchiveWriter(
+            self._directory, prefix=f"documents-w{worker_index:03d}", format=self._format,
+            rows_per_file=self._rows_per_file, rows_per_batch=self._rows_per_batch, compression=self._compression,
+            roll_interval=self._roll_interval,
+        ))
+
+
+@dataclass
+class ArchiveContents:
+    """Columns of an archive. Rows of `embeddings` where `has_embedding` is false are undefined."""
+
+    ids: List[str]
+    contents: List[Optional[str]]
+    metas: List[str]
+    embeddings: np.ndarray
+    has_embedding: np.ndarray
+
+    def documents(self) -> Iterator[Document]:
+        """Haystack documents, embeddings are converted to lists as the stores expect."""
+        for i, doc_id in enumerate(self.ids):
+            embedding = self.embeddings[i].tolist() if self.has_embedding[i] else None
+            yield Document(id=doc_id, content=self.contents[i], meta=json.loads(self.metas[i]), embedding=embedding)
+
+
+def archive_files(path: Union[Path, str]) -> List[Path]:
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    return sorted(file for extension in FORMATS.values() for file in path.glob(f"*{extension}"))
+
+
+def _read_table(path: Path) -> pa.Table:
+    if path.suffix == FORMATS["arrow"]:
+        # Uncompressed record batches point into the mapped file
+        return pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    return pq.read_table(path)
+
+
+def embedding_matrix(column: Union[pa.ChunkedArray, pa.FixedSizeListArray]) -> np.ndarray:
+    """
+    Float32 matrix of a `fixed_size_list<float32>` column. A single chunk is
+    a view of the Arrow buffer, several chunks are concatenated once.
+    """
+    chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+    dimensions = column.type.list_size
+    matrices = []
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        # The values buffer directly, the child array of a Parquet file marks
+        # the slots of null embeddings as null and could not be viewed
+        values = chunk.values
+        start = (values.offset + chunk.offset * dimensions) * 4
+        matrices.append(np.frombuffer(values.buffers()[1], dtype=np.float32, count=len(chunk) * dimensions,
+                                      offset=start).reshape(len(chunk), dimensions))
+    if len(matrices) == 1:
+        return matrices[0]
+    return np.concatenate(matrices) if matrices else np.zeros((0, dimensions), dtype=np.float32)
+
+
+def read_archive(path: Union[Path, str]) -> ArchiveContents:
+    """Load an archive file, or every file of an archive directory."""
+    tables = [_read_table(file) for file in archive_files(path)]
+    if not tables:
+        raise FileNotFoundError(f"No archive files in {path}")
+    types = [table.schema.field("embedding").type for table in tables]
+    dimensions = max((t.list_size for t in types if pa.types.is_fixed_size_list(t)), default=0)
+    ids, contents, metas, matrices, valid = [], [], [], [], []
+    for table in tables:
+        column = table.column("embedding")
+        ids += table.column("id").to_pylist()
+        contents += table.column("content").to_pylist()
+        metas += table.column("meta").to_pylist()
+        valid.append(column.is_valid().to_numpy(zero_copy_only=False))
+        if pa.types.is_fixed_size_list(column.type):
+            matrices.append(embedding_matrix(column))
+        else:
+            # Files written before the first embedding have none
+            matrices.append(np.zeros((table.num_rows, dimensions), dtype=np.float32))
+    embeddings = matrices[0] if len(matrices) == 1 else np.concatenate(matrices)
+    has_embedding = np.concatenate(valid)
+    return ArchiveContents(ids, contents, metas, embeddings, has_embedding)
+
+
+def restore_document_store(document_store: Any, path: Union[Path, str], batch_size: int = 1000,
+                           policy: DuplicatePolicy = DuplicatePolicy.OVERWRITE) -> int:
+    """
+    Write the documents of an archive to a document store, embeddings
+    included.
+
+    :return: Number of documents written.
+    """
+    batch, written = [], 0
+    for document in read_archive(path).documents():
+        batch.append(document)
+        if len(batch) == batch_size:
+            document_store.write_documents(batch, policy=policy)
+            written += len(batch)
+            batch = []
+    if batch:
+        document_store.write_documents(batch, policy=policy)
+        written += len(batch)
+    return written
@@ -0,0 +1,325 @@
+"""Content-addressable on-disk cache for HTTP fetches.
+
+Articles and filings are fetched repeatedly across runs and dataflows. This
+module keeps the response bodies on disk, addressed by the sha256 of their
+content, with an index mapping each URL to its body and validators.
+
+- SEC archive URLs are immutable once published and are served from the cache
+  without contacting the server.
+- Other URLs (news pages) are revalidated with `If-None-Match` /
+  `If-Modified-Since` and the cached body is reused on a `304`.
+- Concurrent requests for the same URL inside one process share one download.
+- The total size of the cached bodies is capped, least recently used entries
+  are evicted first.
+
+The index is owned by one process; bodies are content addressed, so several
+processes pointing at the same directory never corrupt each other's blobs.
+Bodies are read and written outside the lock of the index, and the index is
+saved at most every `save_interval` seconds and at exit rather than on every
+download, so a cache of many entries doesn't serialize the fetching threads.
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Union
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# EDGAR archive documents never change once they are published
+IMMUTABLE_URL_PATTERNS = (
+    r"^https?://(www\.)?sec\.gov/Archives/edgar/data/",
+)
+
+
+@dataclass
+class CachedResponse:
+    """A minimal, `requests.Response`-like view of a fetched URL."""
+
+    url: str
+    status_code: int
+    content: bytes
+    headers: Dict[str, str] = field(default_factory=dict)
+    from_cache: bool = False
+
+    @property
+    def text(self) -> str:
+        return self.content.decode("utf-8", errors="replace")
+
+
+class _Flight:
+    """A download in progress that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response: Optional[CachedResponse] = None
+        self.error: Optional[BaseException] = None
+
+
+class FetchCache:
+    """Cache HTTP GET responses on disk."""
+
+    def __init__(
+        self,
+        cache_dir: Union[str, Path] = ".fetch_cache",
+        max_bytes: int = 1024 * 1024 * 1024,
+        immutable_patterns: Iterable[str] = IMMUTABLE_URL_PATTERNS,
+        fetch: Optional[Callable[..., Any]] = None,
+        timeout: float = 10,
+        save_interval: float = 5.0,
+    ):
+        """
+        Initialize the cache.
+
+        :param cache_dir: Directory holding the index and the response bodies.
+        :param max_bytes: Maximum total size of the cached bodies.
+        :param immutable_patterns: Regexes matching URLs that never change and
+            are served from the cache without revalidation.
+        :param fetch: Callable with the signature of `requests.get` used for
+            network requests. Defaults to `requests.get`.
+        :param timeout: Timeout in seconds passed to `fetch`.
+        :param save_interval: Seconds between two saves of the index, it is
+            also saved at exit and by `flush`.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.blob_dir = self.cache_dir / "blobs"
+        self.index_path = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.immutable_patterns = [re.compile(p) for p in immutable_patterns]
+        self.fetch = fetch or requests.get
+        self.timeout = timeout
+        self.save_interval = save_interval
+
+        self._lock = threading.Lock()
+        # Serializes the writes of index.json, taken without `_lock`
+        self._save_lock = threading.Lock()
+        self._inflight: Dict[str, _Flight] = {}
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self._index = self._load_index()
+        self._dirty = False
+        self._saved = time.monotonic()
+        atexit.register(self.flush)
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def is_immutable(self, url: str) -> bool:
+        return any(p.search(url) for p in self.immutable_patterns)
+
+    def get(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        fetch: Optional[Callable[..., Any]] = None,
+    ) -> CachedResponse:
+        """
+        Return the response for `url`, from the cache where possible.
+
+        :param url: URL to fetch.
+        :param headers: Request headers sent on a network fetch.
+        :param timeout: Timeout for a network fetch, defaults to the cache's.
+        :param fetch: Callable used for a network fetch instead of the cache's,
+            for example a rate-limited client.
+        :return: The cached or freshly downloaded response.
+        """
+        url = str(url)
+        with self._lock:
+            entry = self._index.get(url)
+        if entry is not None and self.is_immutable(url):
+            cached = self._read_entry(url, entry)
+            if cached is not None:
+                with self._lock:
+                    self.hits += 1
+                return cached
+
+        with self._lock:
+            flight = self._inflight.get(url)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[url] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.response
+
+        try:
+            flight.response = self._fetch(url, headers, entry, timeout or self.timeout, fetch or self.fetch)
+            return flight.response
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[url]
+            flight.done.set()
+
+    def _fetch(
+        self,
+        url: str,
+        headers: Optional[Dict[str, str]],
+        entry: Optional[Dict],
+        timeout: float,
+        fetch: Callable[..., Any],
+    ) -> CachedResponse:
+        request_headers = dict(headers or {})
+        if entry is not None:
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = fetch(url, headers=request_headers, timeout=timeout)
+
+        if response.status_code == 304 and entry is not None:
+            cached = self._read_entry(url, entry)
+            if cached is not None:
+                with self._lock:
+                    self.revalidated += 1
+                return cached
+            # The body went missing on disk, fetch it again unconditionally
+            return self._fetch(url, headers, None, timeout, fetch)
+
+        with self._lock:
+            self.misses += 1
+        result = CachedResponse(
+            url=url,
+            status_code=response.status_code,
+            content=response.content,
+            headers=dict(response.headers),
+        )
+        if response.status_code == 200:
+            self._store(url, result)
+        return result
+
+    def _blob_path(self, digest: str) -> Path:
+        return self.blob_dir / digest[:2] / digest
+
+    def _read_entry(self, url: str, entry: Dict) -> Optional[CachedResponse]:
+        """Read the body of an entry, called without the lock."""
+        try:
+            content = self._blob_path(entry["sha256"]).read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                if self._index.get(url) is entry:
+                    del self._index[url]
+                    self._dirty = True
+            return None
+        with self._lock:
+            # Entries are replaced rather than changed, so the index can be
+            # saved from a shallow copy
+            if self._index.get(url) is entry:
+                self._index[url] = {**entry, "last_access": time.time()}
+                self._dirty = True
+        return CachedResponse(
+            url=url,
+            status_code=200,
+            content=content,
+            headers=dict(entry.get("headers", {})),
+            from_cache=True,
+        )
+
+    def _store(self, url: str, response: CachedResponse) -> None:
+        digest = hashlib.sha256(response.content).hexdigest()
+        path = self._blob_path(digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(response.content)
+            os.replace(tmp, path)
+
+        headers = response.headers
+        with self._lock:
+            self._index[url] = {
+                "sha256": digest,
+                "size": len(response.content),
+                "etag": headers.get("ETag") or headers.get("etag"),
+                "last_modified": headers.get("Last-Modified") or headers.get("last-modified"),
+                "headers": {k: v for k, v in headers.items() if k.lower() == "content-type"},
+                "last_access": time.time(),
+            }
+            self._evict()
+            self._dirty = True
+            due = time.monotonic() - self._saved >= self.save_interval
+        if due:
+            self.flush()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the bodies fit `max_bytes`."""
+        sizes = {}
+        for entry in self._index.values():
+            sizes[entry["sha256"]] = entry["size"]
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        refs: Dict[str, int] = {}
+        for entry in self._index.values():
+            refs[entry["sha256"]] = refs.get(entry["sha256"], 0) + 1
+
+        by_age = sorted(self._index.items(), key=lambda item: item[1]["last_access"])
+        for url, entry in by_age:
+            if total <= self.max_bytes:
+                break
+            del self._index[url]
+            digest = entry["sha256"]
+            refs[digest] -= 1
+            if refs[digest] == 0:
+                total -= entry["size"]
+                try:
+                    self._blob_path(digest).unlink()
+                except FileNotFoundError:
+                    pass
+            logger.debug(f"Evicted {url} from the fetch cache")
+
+    def _load_index(self) -> Dict[str, Dict]:
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def flush(self) -> None:
+        """Save the index if it changed, so entries and LRU order survive a restart."""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                index = dict(self._index)
+                self._dirty = False
+                self._saved = time.monotonic()
+            tmp = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as file:
+                json.dump(index, file)
+            os.replace(tmp, self.index_path)
+
+
+_shared_cache: Optional[FetchCache] = None
+_shared_lock = threading.Lock()
+
+
+def get_cache() -> FetchCache:
+    """
+    Return the fetch cache shared by every step in this process.
+    Configured with the `FETCH_CACHE_DIR` and `FETCH_CACHE_MAX_BYTES`
+    environment variables.
+    """
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = FetchCache(
+                cache_dir=os.getenv("FETCH_CACHE_DIR", ".fetch_cache"),
+                max_bytes=int(os.getenv("FETCH_CACHE_MAX_BYTES", 1024 * 1024 * 1024)),
+            )
+        return _shared_cache
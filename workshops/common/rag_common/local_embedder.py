@@ -0,0 +1,62 @@
+"""Deterministic local embedder for benchmarks and offline runs.
+
+Hashes word unigrams and bigrams into a fixed number of signed dimensions, so
+the bundled corpora can be embedded without an API key, in seconds, and with
+the same vectors on every run.
+"""
+import hashlib
+import json
+import re
+from typing import List
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def load_corpus(news_path: str = "data/news_out.jsonl", sec_path: str = "data/sec_out.jsonl") -> List[str]:
+    """Texts of the bundled news articles and SEC filing entries, in file order."""
+    texts = []
+    with open(news_path, "r", encoding="utf-8") as file:
+        for line in file:
+            event = json.loads(line)
+            texts.append(" ".join(filter(None, [event.get("headline"), event.get("summary"), event.get("content")])))
+    with open(sec_path, "r", encoding="utf-8") as file:
+        for line in file:
+            ticker, event = json.loads(line)
+            texts.append(f"{event.get('form_type')} {event.get('title')} {ticker}")
+    return texts
+
+
+class HashingEmbedder:
+    """Embed text with the hashing trick."""
+
+    def __init__(self, dimensions: int = 1536, bigrams: bool = True):
+        """
+        :param dimensions: Dimensions of the embeddings.
+        :param bigrams: Also hash pairs of consecutive words.
+        """
+        self.dimensions = dimensions
+        self.bigrams = bigrams
+        self._buckets = {}
+
+    def _bucket(self, term: str):
+        bucket = self._buckets.get(term)
+        if bucket is None:
+            digest = int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+            bucket = self._buckets[term] = (digest % self.dimensions, 1.0 if digest >> 63 else -1.0)
+        return bucket
+
+    def embed_one(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = TOKEN_PATTERN.findall((text or "").lower())
+        terms = words + ([f"{a} {b}" for a, b in zip(words, words[1:])] if self.bigrams else [])
+        for term in terms:
+            index, sign = self._bucket(term)
+            vector[index] += sign
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into a `(len(texts), dimensions)` float32 matrix of unit vectors."""
+        return np.stack([self.embed_one(text) for text in texts]) if texts else np.zeros((0, self.dimensions), np.float32)
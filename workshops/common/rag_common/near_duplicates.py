@@ -0,0 +1,254 @@
+"""Streaming near-duplicate detection in front of the document embedder.
+
+The feeds repeat themselves: price target notes that differ by one number,
+runs of NPORT-P filings of one fund family, articles republished with an
+edited headline. Every copy used to be embedded again. `NearDuplicateFilter`
+sits between the cleaner and the embedder of the indexing pipelines and
+splits the chunks into new ones, which are embedded, and near duplicates of a
+chunk seen recently, which are not embedded and carry the id of that
+canonical chunk in their `duplicate_of` metadata. `CanonicalEmbeddings`, after
+the embedder, gives them the vector of their canonical chunk so they are
+found by vector queries like any other chunk.
+
+Chunks are compared by MinHash signatures of their word shingles, an
+estimate of the Jaccard similarity of their shingle sets, and candidates are
+found with locality sensitive hashing over bands of the signature, so a check
+costs the same however many chunks are remembered. Memory is bounded by
+`max_entries` signatures, and signatures expire `ttl` seconds after they were
+added.
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from haystack import Document, component
+
+logger = logging.getLogger(__name__)
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+# Mersenne prime of the universal hash family of the permutations
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingles(text: str, size: int = 3) -> List[str]:
+    """Overlapping word n-grams of the lowercased text, the whole text if it is shorter."""
+    words = WORD_PATTERN.findall((text or "").lower())
+    if len(words) <= size:
+        return [" ".join(words)] if words else []
+    return [" ".join(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+
+class MinHashLSH:
+    """Remember MinHash signatures and find the ones close to a new text."""
+
+    def __init__(self, num_perm: int = 128, bands: int = 16, threshold: float = 0.8, shingle_size: int = 3,
+                 max_entries: int = 100_000, ttl: Optional[float] = 6 * 3600, seed: int = 1,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param num_perm: Length of the signatures.
+        :param bands: LSH bands, `num_perm` must be a multiple. More bands find
+            candidates of lower similarity.
+        :param threshold: Estimated Jaccard similarity from which a text is a
+            near duplicate.
+        :param shingle_size: Words per shingle.
+        :param max_entries: Signatures remembered, the oldest are evicted first.
+        :param ttl: Seconds a signature is remembered, None for no expiry.
+        :param seed: Seed of the permutations, the same seed gives the same
+            signatures.
+        :param clock: Source of the current time in seconds.
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = generator.randint(0, int(MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        # Key -> (signature, time added), oldest first
+        self._entries: "OrderedDict[str, Tuple[np.ndarray, float]]" = OrderedDict()
+        self._buckets: Dict[Tuple[int, bytes], List[str]] = {}
+        self._lock = threading.Lock()
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """MinHash signature of a text, None for a text without words."""
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return None
+        hashes = np.array([int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=4).digest(), "little")
+                           for gram in set(grams)], dtype=np.uint64)
+        # Wrapping uint64 arithmetic, as usual for MinHash in NumPy
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % MERSENNE_PRIME & MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _expire(self, now: float) -> None:
+        while self._entries:
+            key, (signature, added) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and (self.ttl is None or added >= now - self.ttl):
+                break
+            self._remove(key)
+
+    def _remove(self, key: str) -> None:
+        signature, _ = self._entries.pop(key)
+        for band_key in self._band_keys(signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is None:
+                continue
+            if key in bucket:
+                bucket.remove(key)
+            if not bucket:
+                del self._buckets[band_key]
+
+    def _closest(self, signature: np.ndarray, band_keys: List[Tuple[int, bytes]]) -> Tuple[Optional[str], float]:
+        candidates = {key for band_key in band_keys for key in self._buckets.get(band_key, ())}
+        best, similarity = None, 0.0
+        for key in candidates:
+            estimate = float(np.mean(self._entries[key][0] == signature))
+            if estimate > similarity:
+                best, similarity = key, estimate
+        return best, similarity
+
+    def check(self, key: str, text: str) -> Tuple[Optional[str], float]:
+        """
+        Look up the closest remembered text, remembering this one under `key`
+        unless it is a near duplicate.
+
+        :return: Key of the canonical text and the estimated similarity, or
+            None and the similarity of the closest candidate.
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return None, 0.0
+        band_keys = self._band_keys(signature)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            canonical, similarity = self._closest(signature, band_keys)
+            if canonical is not None and similarity >= self.threshold and canonical != key:
+                return canonical, similarity
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (signature, now)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, []).append(key)
+            if len(self._entries) > self.max_entries:
+                self._expire(now)
+            return None, similarity
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@component
+class NearDuplicateFilter:
+    """
+    Split documents into new ones and near duplicates of recent ones, see
+    the module docstring. Connect `documents` to the embedder, the
+    `duplicates` carry `duplicate_of` and `duplicate_similarity` metadata.
+    """
+
+    def __init__(self, lsh: Optional[MinHashLSH] = None, key: Optional[Callable[[Document], str]] = None,
+                 report_every: int = 500):
+        """
+        :param lsh: Detector, by default one with the default settings.
+        :param key: Id under which a canonical document is indexed, by
+            default the document id.
+        :param report_every: Log the embeddings saved every this many documents.
+        """
+        self.lsh = lsh or MinHashLSH()
+        self.key = key or (lambda document: document.id)
+        self.report_every = report_every
+        self.stats = {"documents": 0, "duplicates": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def saved_fraction(self) -> float:
+        """Fraction of the documents that were not embedded because they were near duplicates."""
+        return self.stats["duplicates"] / self.stats["documents"] if self.stats["documents"] else 0.0
+
+    @component.output_types(documents=List[Document], duplicates=List[Document])
+    def run(self, documents: List[Document]):
+        unique, duplicates = [], []
+        for document in documents:
+            canonical, similarity = self.lsh.check(self.key(document), document.content or "")
+            if canonical is None:
+                unique.append(document)
+            else:
+                duplicates.append(Document(id=document.id, content=document.content,
+                                           meta={**document.meta, "duplicate_of": canonical,
+                                                 "duplicate_similarity": round(similarity, 3)}))
+        with self._stats_lock:
+            before = self.stats["documents"]
+            self.stats["documents"] += len(documents)
+            self.stats["duplicates"] += len(duplicates)
+            report = before // self.report_every != self.stats["documents"] // self.report_every
+        if report:
+            logger.info(f"Near duplicates: {self.stats['duplicates']} of {self.stats['documents']} documents, "
+                        f"{self.saved_fraction:.1%} of the embedding calls saved")
+        return {"documents": unique, "duplicates": duplicates}
+
+
+@component
+class CanonicalEmbeddings:
+    """
+    Copy the vector of the canonical chunk onto its near duplicates. Connect
+    the embedder `documents` and the `duplicates` of a `NearDuplicateFilter`
+    with the same `key`. The vectors of the last `max_entries` embedded
+    documents are remembered, a duplicate of an older one is passed on
+    without a vector.
+    """
+
+    def __init__(self, key: Optional[Callable[[Document], str]] = None, max_entries: int = 20_000,
+                 report_every: int = 500):
+        """
+        :param key: Id under which a canonical document is indexed, the `key`
+            of the filter, by default the document id.
+        :param max_entries: Vectors remembered, the oldest are evicted first.
+        :param report_every: Log the duplicates indexed every this many duplicates.
+        """
+        self.key = key or (lambda document: document.id)
+        self.max_entries = max_entries
+        self.report_every = report_every
+        self.stats = {"duplicates": 0, "with_vector": 0}
+        self._vectors: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @component.output_types(documents=List[Document], duplicates=List[Document])
+    def run(self, documents: List[Document], duplicates: List[Document]):
+        resolved = []
+        with self._lock:
+            for document in documents:
+                if document.embedding is not None:
+                    key = self.key(document)
+                    self._vectors[key] = document.embedding
+                    self._vectors.move_to_end(key)
+            while len(self._vectors) > self.max_entries:
+                self._vectors.popitem(last=False)
+            for document in duplicates:
+                embedding = self._vectors.get(document.meta.get("duplicate_of"))
+                resolved.append(Document(id=document.id, content=document.content, meta=document.meta,
+                                         embedding=embedding))
+            before = self.stats["duplicates"]
+            self.stats["duplicates"] += len(duplicates)
+            self.stats["with_vector"] += sum(document.embedding is not None for document in resolved)
+            report = before // self.report_every != self.stats["duplicates"] // self.report_every
+            stats = dict(self.stats)
+        if report:
+            logger.info(f"Near duplicates indexed: {stats['duplicates']}, {stats['with_vector']} with the vector "
+                        f"of their canonical chunk, {stats['duplicates'] - stats['with_vector']} without a vector")
+        return {"documents": documents, "duplicates": resolved}
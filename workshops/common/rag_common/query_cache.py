@@ -0,0 +1,305 @@
+"""Caches in front of the query embedder and the LLM of the retriever pipelines.
+
+Analyst questions repeat a lot. Two cache levels avoid paying for the same
+work twice:
+
+1. `EmbeddingLRUCache` / `CachedTextEmbedder` map the exact query text to its
+   embedding, so a repeated question costs no embedding call.
+2. `SemanticAnswerCache` returns a stored answer when a new query embedding is
+   within a cosine similarity threshold of an earlier one, as long as the
+   entry has not expired, the index version has not changed and the documents
+   the answer relied on are unchanged.
+
+Both caches count hits and misses in a `CacheStats`.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from haystack import Document, component
+
+
+@dataclass
+class CacheStats:
+    """Hit and miss counters of a cache."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hit_rate,
+        }
+
+
+def normalize_query(text: str) -> str:
+    """Key used for exact matching, ignores case and surrounding whitespace."""
+    return " ".join(text.split()).casefold()
+
+
+def document_fingerprint(document: Document) -> str:
+    """Hash of the content of a document, changes whenever it is re-indexed with new text."""
+    return hashlib.sha256((document.content or "").encode("utf-8")).hexdigest()
+
+
+class EmbeddingLRUCache:
+    """Exact query text to embedding cache with least recently used eviction."""
+
+    def __init__(self, max_size: int = 10000):
+        """
+        :param max_size: Maximum number of embeddings kept.
+        """
+        self.max_size = max_size
+        self.stats = CacheStats()
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = normalize_query(text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+            return embedding
+
+    def put(self, text: str, embedding: List[float]) -> None:
+        key = normalize_query(text)
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@component
+class CachedTextEmbedder:
+    """
+    Wrap a text embedder component with an `EmbeddingLRUCache`.
+    Has the same inputs and outputs as the wrapped embedder, so it can replace
+    it in a pipeline.
+    """
+
+    def __init__(self, embedder: Any, cache: Optional[EmbeddingLRUCache] = None):
+        """
+        :param embedder: Text embedder to call on a cache miss, e.g. OpenAITextEmbedder.
+        :param cache: Cache to use, a new one is created if not given.
+        """
+        self.embedder = embedder
+        self.cache = cache or EmbeddingLRUCache()
+
+    def warm_up(self):
+        if hasattr(self.embedder, "warm_up"):
+            self.embedder.warm_up()
+
+    @component.output_types(embedding=List[float], meta=Dict[str, Any])
+    def run(self, text: str):
+        embedding = self.cache.get(text)
+        if embedding is not None:
+            return {"embedding": embedding, "meta": {"cache": "hit"}}
+        result = self.embedder.run(text=text)
+        self.cache.put(text, result["embedding"])
+        return {"embedding": result["embedding"], "meta": {**result.get("meta", {}), "cache": "miss"}}
+
+
+@dataclass
+class _AnswerEntry:
+    embedding: np.ndarray
+    answer: Any
+    sources: Dict[str, str]
+    index_version: Any
+    created: float = field(default_factory=time.time)
+
+
+class SemanticAnswerCache:
+    """Reuse answers of earlier queries that are semantically close to a new one."""
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        max_entries: int = 1000,
+        ttl: Optional[float] = None,
+        index_version: Any = None,
+    ):
+        """
+        :param threshold: Minimum cosine similarity between two query
+            embeddings for the stored answer to be reused.
+        :param max_entries: Maximum number of answers kept, the oldest are
+            evicted first.
+        :param ttl: Seconds after which an answer expires, `None` keeps
+            answers until they are invalidated.
+        :param index_version: Version of the index the answers are computed
+            against, see `set_index_version`.
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_version = index_version
+        self.stats = CacheStats()
+        self._entries: List[_AnswerEntry] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self,
+        embedding: List[float],
+        validate: Optional[Callable[[Dict[str, str]], bool]] = None,
+    ) -> Optional[Any]:
+        """
+        Find a stored answer for a query embedding.
+
+        :param embedding: Embedding of the new query.
+        :param validate: Called with the `{document id: fingerprint}` the
+            answer relied on, returns False if any of them changed.
+        :return: The stored answer or None.
+        """
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            live = [e for e in self._entries if self.ttl is None or now - e.created < self.ttl]
+            self.stats.evictions += len(self._entries) - len(live)
+            self._entries = live
+            if not live:
+                self.stats.misses += 1
+                return None
+            scores = np.stack([e.embedding for e in live]) @ query
+            best = int(np.argmax(scores))
+            entry = live[best]
+            if scores[best] < self.threshold:
+                self.stats.misses += 1
+                return None
+
+        if validate is not None and not validate(entry.sources):
+            with self._lock:
+                if entry in self._entries:
+                    self._entries.remove(entry)
+                self.stats.invalidations += 1
+                self.stats.misses += 1
+            return None
+
+        with self._lock:
+            self.stats.hits += 1
+        return entry.answer
+
+    def store(self, embedding: List[float], answer: Any, documents: List[Document]) -> None:
+        """
+        Store the answer to a query.
+
+        :param embedding: Embedding of the query.
+        :param answer: Answer to return for similar queries.
+        :param documents: Retrieved documents the answer was generated from.
+        """
+        entry = _AnswerEntry(
+            embedding=self._normalize(embedding),
+            answer=answer,
+            sources={doc.id: document_fingerprint(doc) for doc in documents},
+            index_version=self.index_version,
+        )
+        with self._lock:
+            self._entries.append(entry)
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(0)
+                self.stats.evictions += 1
+
+    def set_index_version(self, version: Any) -> None:
+        """Drop every answer computed against an older version of the index."""
+        with self._lock:
+            if version == self.index_version:
+                return
+            self.index_version = version
+            kept = [e for e in self._entries if e.index_version == version]
+            self.stats.invalidations += len(self._entries) - len(kept)
+            self._entries = kept
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stats.invalidations += len(self._entries)
+            self._entries = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def document_store_validator(document_store: Any) -> Callable[[Dict[str, str]], bool]:
+    """
+    Build a `validate` callable for `SemanticAnswerCache.lookup` that checks
+    the documents against a Haystack document store.
+
+    :param document_store: Store the retriever reads from.
+    """
+
+    def validate(sources: Dict[str, str]) -> bool:
+        if not sources:
+            return True
+        current = document_store.filter_documents(
+            filters={"field": "id", "operator": "in", "value": list(sources)}
+        )
+        fingerprints = {doc.id: document_fingerprint(doc) for doc in current}
+        return fingerprints == sources
+
+    return validate
+
+
+def cached_answer(
+    pipeline: Any,
+    question: str,
+    answer_cache: Optional[SemanticAnswerCache] = None,
+    validate: Optional[Callable[[Dict[str, str]], bool]] = None,
+) -> Dict[str, Any]:
+    """
+    Answer a question with a retriever pipeline, reusing cached answers.
+
+    The pipeline must name its components `text_embedder`, `retriever`,
+    `prompt_builder` and `llm`. Use a `CachedTextEmbedder` as `text_embedder`
+    so the embedding computed for the lookup is reused by the pipeline run.
+    With a `context_packer`, a cached answer depends on the packed documents
+    only.
+
+    :param pipeline: The retriever pipeline.
+    :param question: The question to answer.
+    :param answer_cache: Semantic answer cache, no answer caching if None.
+    :param validate: Checks that the documents of a cached answer are unchanged.
+    :return: `{"replies": [...], "cached": bool}`
+    """
+    embedding = None
+    if answer_cache is not None:
+        embedding = pipeline.get_component("text_embedder").run(text=question)["embedding"]
+        replies = answer_cache.lookup(embedding, validate=validate)
+        if replies is not None:
+            return {"replies": replies, "cached": True}
+
+    sources = "context_packer" if "context_packer" in pipeline.graph.nodes else "retriever"
+    result = pipeline.run(
+        {"text_embedder": {"text": question}, "prompt_builder": {"question": question}},
+        include_outputs_from={sources},
+    )
+    replies = result["llm"]["replies"]
+    if answer_cache is not None:
+        answer_cache.store(embedding, replies, result[sources]["documents"])
+    return {"replies": replies, "cached": False}
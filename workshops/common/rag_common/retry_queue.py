@@ -0,0 +1,232 @@
+"""Delayed retries of failed events, re-injected into the dataflow.
+
+A fetch or an embedding request that fails used to either stop the dataflow
+or be retried in the step, with the worker sleeping through every backoff
+while the events behind it waited. `RetryQueue.guard` wraps a step so an
+event whose processing raises is put on a delay queue instead, and the step
+moves on to the next event. `RetrySource`, merged into the stream in front
+of the step, emits the queued events again once their delay has passed:
+
+    retries = RetryQueue(dead_letter_path="data/dead_letter.jsonl")
+    retried = op.input("retries", flow, RetrySource(retries))
+    events = op.merge("with_retries", deserialized, retried)
+    documents = op.flat_map("index", events, retries.guard(process_event))
+
+The delay doubles with every attempt, with jitter so the events of a host
+that failed together do not come back together. After `max_attempts`, or
+when the queue is full, an event is appended to the dead-letter file with
+its last error. The queue is shared by the workers of a process and is not
+part of the snapshots, so a restart loses the retries that were waiting.
+"""
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Iterable, List, Optional, Tuple, Type
+
+from bytewax.inputs import DynamicSource, StatelessSourcePartition
+from typing_extensions import override
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RetryItem:
+    """An event waiting for, or going through, another attempt."""
+
+    payload: Any
+    attempts: int
+    error: str
+    key: Optional[str] = None
+
+
+def describe(payload: Any) -> str:
+    """Short name of an event for the log, its url or id when it has one."""
+    if isinstance(payload, dict):
+        return str(payload.get("url") or payload.get("id") or "event")
+    return type(payload).__name__
+
+
+class RetryQueue:
+    """Delay queue with exponential backoff and a dead-letter file."""
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 2.0, max_delay: float = 300.0,
+                 dead_letter_path: str = "data/dead_letter.jsonl",
+                 retry_on: Tuple[Type[BaseException], ...] = (Exception,), max_queued: int = 10_000,
+                 idle_timeout: Optional[float] = None):
+        """
+        :param max_attempts: Attempts of an event, the first included, before
+            it goes to the dead-letter file.
+        :param base_delay: Seconds before the first retry, doubled for every
+            further one.
+        :param max_delay: Longest delay between two attempts.
+        :param dead_letter_path: JSON lines file of the events that failed
+            for good.
+        :param retry_on: Exceptions that are retried, others stop the dataflow.
+        :param max_queued: Events waiting at most, further failures go to the
+            dead-letter file at once.
+        :param idle_timeout: Seconds without queued events or guarded calls
+            after which `RetrySource` ends, so a dataflow reading files can
+            finish. None keeps it running.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.dead_letter_path = dead_letter_path
+        self.retry_on = retry_on
+        self.max_queued = max_queued
+        self.idle_timeout = idle_timeout
+        self.stats = {"failed": 0, "retried": 0, "recovered": 0, "dead_lettered": 0}
+
+        self._lock = threading.Lock()
+        self._waiting: List[Tuple[float, int, RetryItem]] = []  # heap by due time
+        self._order = itertools.count()
+        self._running = 0
+        self._active = time.monotonic()
+        self._closed = False
+
+    def guard(self, func: Callable[[Any], Iterable[Any]], key: Optional[str] = None) -> Callable[[Any], List[Any]]:
+        """
+        Wrap a `flat_map` step or scheduler handler so a failed event is
+        queued for a retry and the step returns nothing for it.
+
+        :param key: Carried by the queued events, e.g. the source whose
+            handler failed, see `tag`.
+        """
+        def guarded(item: Any) -> List[Any]:
+            payload, attempts = (item.payload, item.attempts) if isinstance(item, RetryItem) else (item, 0)
+            with self._lock:
+                self._running += 1
+                self._active = time.monotonic()
+            try:
+                output = list(func(payload) or [])
+            except self.retry_on as e:
+                self.fail(payload, attempts + 1, e, key)
+                return []
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._active = time.monotonic()
+            if attempts:
+                with self._lock:
+                    self.stats["recovered"] += 1
+                logger.info(f"Retry {attempts} of {describe(payload)} succeeded")
+            return output
+        return guarded
+
+    def fail(self, payload: Any, attempts: int, error: BaseException, key: Optional[str] = None) -> None:
+        """Queue an event whose attempt number `attempts` failed, or dead-letter it."""
+        message = f"{type(error).__name__}: {error}"
+        with self._lock:
+            self.stats["failed"] += 1
+            reason = ("no attempts left" if attempts >= self.max_attempts
+                      else "retry queue closed" if self._closed
+                      else "retry queue full" if len(self._waiting) >= self.max_queued
+                      else None)
+            if reason is None:
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                heapq.heappush(self._waiting, (time.monotonic() + delay, next(self._order),
+                                               RetryItem(payload, attempts, message, key)))
+        if reason is None:
+            logger.warning(f"Attempt {attempts} of {describe(payload)} failed, retrying in {delay:.1f}s: {message}")
+        else:
+            self.dead_letter(RetryItem(payload, attempts, message, key), reason)
+
+    def dead_letter(self, item: RetryItem, reason: str) -> None:
+        """Append an event that failed for good to the dead-letter file."""
+        record = {"payload": item.payload, "key": item.key, "attempts": item.attempts, "error": item.error,
+                  "reason": reason, "failed_at": datetime.now(timezone.utc).isoformat()}
+        with self._lock:
+            self.stats["dead_lettered"] += 1
+            with open(self.dead_letter_path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+        logger.error(f"Gave up on {describe(item.payload)} after {item.attempts} attempts ({reason}): {item.error}")
+
+    def pop_due(self, limit: int) -> List[RetryItem]:
+        """Up to `limit` events whose delay has passed, oldest first."""
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            while self._waiting and self._waiting[0][0] <= now and len(due) < limit:
+                due.append(heapq.heappop(self._waiting)[2])
+            self.stats["retried"] += len(due)
+            if due:
+                self._active = now
+        return due
+
+    def next_due(self) -> Optional[float]:
+        """Seconds until the next event is due, None if none is waiting."""
+        with self._lock:
+            return max(0.0, self._waiting[0][0] - time.monotonic()) if self._waiting else None
+
+    def idle(self) -> bool:
+        """Whether `idle_timeout` passed without queued events or guarded calls."""
+        with self._lock:
+            return (self.idle_timeout is not None and not self._waiting and not self._running
+                    and time.monotonic() - self._active >= self.idle_timeout)
+
+    def close(self) -> None:
+        """Send the failures from now on to the dead-letter file."""
+        with self._lock:
+            self._closed = True
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def __len__(self) -> int:
+        return len(self._waiting)
+
+    @staticmethod
+    def tag(item: RetryItem) -> Tuple[Optional[str], Tuple[float, RetryItem]]:
+        """`map` step giving a retried event the shape of `tag_source`, keyed by the guard key."""
+        return item.key, (time.monotonic(), item)
+
+
+class _RetryPartition(StatelessSourcePartition[RetryItem]):
+    def __init__(self, queue: RetryQueue, batch_size: int, poll_interval: timedelta):
+        self._queue = queue
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+
+    @override
+    def next_batch(self) -> List[RetryItem]:
+        if self._queue.closed or self._queue.idle():
+            self._queue.close()
+            raise StopIteration()
+        return self._queue.pop_due(self._batch_size)
+
+    @override
+    def next_awake(self) -> Optional[datetime]:
+        due = self._queue.next_due()
+        wait = self._poll_interval if due is None else min(timedelta(seconds=due), self._poll_interval)
+        return datetime.now(timezone.utc) + wait
+
+
+class RetrySource(DynamicSource[RetryItem]):
+    """Emit the events of a `RetryQueue` once their delay has passed.
+
+    Every worker takes the due events of the queue shared by its process.
+    """
+
+    def __init__(self, queue: RetryQueue, batch_size: int = 100,
+                 poll_interval: timedelta = timedelta(milliseconds=500)):
+        """Init.
+
+        :arg queue: Queue the guarded steps put failed events on.
+        :arg batch_size: Events emitted at most per batch.
+        :arg poll_interval: Longest time between two looks at the queue.
+
+        """
+        self._queue = queue
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+
+    @override
+    def build(self, _step_id: str, _worker_index: int, _worker_count: int) -> _RetryPartition:
+        return _RetryPartition(self._queue, self._batch_size, self._poll_interval)
@@ -0,0 +1,230 @@
+"""Rate-limited HTTP client shared by every step that talks to sec.gov.
+
+SEC fair access allows 10 requests per second per client. The EDGAR poller,
+the issuer symbol lookup in `enrich` and the filing downloads of the
+`UnstructuredParser` all go through one client per process, so together they
+run right at that budget instead of each one staying far below it.
+
+- Every host gets its own token bucket, sec.gov defaults to 10 requests/s.
+- Live requests (new filings) are served before backfill requests.
+- A `429` or `503` halves the host's rate and honors `Retry-After`, the rate
+  then recovers gradually on successful responses.
+
+The budget is per process. When a dataflow runs with several processes, set
+`SEC_RATE_LIMIT` to the fair-access budget divided by the process count.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+LIVE = 0
+BACKFILL = 1
+
+SEC_HOSTS = ("www.sec.gov", "sec.gov", "efts.sec.gov", "data.sec.gov")
+
+
+class TokenBucket:
+    """Token bucket with two priority levels and adaptive rate."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None, min_rate: float = 0.5):
+        """
+        :param rate: Permitted requests per second.
+        :param burst: Maximum number of tokens, defaults to `rate`.
+        :param min_rate: Lowest rate the bucket backs off to.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.min_rate = min_rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._live_waiting = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, priority: int = LIVE) -> float:
+        """
+        Take a token if one is available.
+
+        :return: 0 if a token was taken, otherwise the seconds to wait before
+            trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if priority != LIVE and self._live_waiting:
+                # Leave the next token to the live request that is waiting
+                return 1.0 / self.rate
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def _waiting(self, priority: int, delta: int) -> None:
+        if priority == LIVE:
+            with self._lock:
+                self._live_waiting += delta
+
+    def acquire(self, priority: int = LIVE) -> None:
+        """Block until a token is available."""
+        wait = self.try_acquire(priority)
+        if not wait:
+            return
+        self._waiting(priority, 1)
+        try:
+            while wait:
+                time.sleep(wait)
+                wait = self.try_acquire(priority)
+        finally:
+            self._waiting(priority, -1)
+
+    async def acquire_async(self, priority: int = LIVE) -> None:
+        """Wait for a token without blocking the event loop."""
+        wait = self.try_acquire(priority)
+        if not wait:
+            return
+        self._waiting(priority, 1)
+        try:
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self.try_acquire(priority)
+        finally:
+            self._waiting(priority, -1)
+
+    def back_off(self, retry_after: Optional[float] = None) -> None:
+        """Halve the rate and pause the bucket after a throttling response."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0
+            pause = retry_after if retry_after is not None else 1.0 / self.rate
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        logger.warning(f"Throttled, backing off to {self.rate:.2f} requests/s for {pause:.1f}s")
+
+    def recover(self) -> None:
+        """Grow the rate back towards its configured maximum."""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.1 * self.max_rate)
+
+
+class RateLimitedClient:
+    """HTTP GET client with a token bucket per host."""
+
+    def __init__(
+        self,
+        rates: Optional[Dict[str, float]] = None,
+        default_rate: Optional[float] = None,
+        max_retries: int = 5,
+        session: Optional[requests.Session] = None,
+    ):
+        """
+        :param rates: Requests per second keyed by host name.
+        :param default_rate: Requests per second for other hosts. `None`
+            leaves them unlimited.
+        :param max_retries: Attempts after a `429` or `503` before giving up.
+        :param session: Session used for every request. By default each
+            thread gets its own, which keeps its connections between steps.
+        """
+        self.rates = dict(rates or {})
+        self.default_rate = default_rate
+        self.max_retries = max_retries
+        self._session = session
+        self._local = threading.local()
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        """Session of the calling thread, a `requests.Session` is not thread safe."""
+        if self._session is not None:
+            return self._session
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def bucket(self, url: str) -> Optional[TokenBucket]:
+        host = urlparse(url).hostname or ""
+        with self._lock:
+            if host not in self._buckets:
+                rate = self.rates.get(host, self.default_rate)
+                self._buckets[host] = TokenBucket(rate) if rate else None
+            return self._buckets[host]
+
+    def get(self, url: str, priority: int = LIVE, **kwargs) -> requests.Response:
+        """
+        Send a GET request within the host's rate limit.
+        Takes the same keyword arguments as `requests.get`.
+
+        :param url: URL to fetch.
+        :param priority: `LIVE` or `BACKFILL`.
+        :return: The response, the last one if every retry was throttled.
+        """
+        bucket = self.bucket(url)
+        for attempt in range(self.max_retries + 1):
+            if bucket:
+                bucket.acquire(priority)
+            response = self.session.get(url, **kwargs)
+            if not self._throttled(bucket, response) or attempt == self.max_retries:
+                return response
+            time.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        return response
+
+    async def aget(self, url: str, priority: int = LIVE, **kwargs) -> requests.Response:
+        """Async version of `get`, the request itself runs in a worker thread."""
+        bucket = self.bucket(url)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            if bucket:
+                await bucket.acquire_async(priority)
+            response = await loop.run_in_executor(None, lambda: self.session.get(url, **kwargs))
+            if not self._throttled(bucket, response) or attempt == self.max_retries:
+                return response
+            await asyncio.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        return response
+
+    def _throttled(self, bucket: Optional[TokenBucket], response: requests.Response) -> bool:
+        if response.status_code not in (429, 503):
+            if bucket:
+                bucket.recover()
+            return False
+        if bucket:
+            retry_after = response.headers.get("Retry-After")
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            bucket.back_off(retry_after)
+        return True
+
+
+_shared_client: Optional[RateLimitedClient] = None
+_shared_lock = threading.Lock()
+
+
+def get_client() -> RateLimitedClient:
+    """
+    Return the client shared by every step in this process.
+    The sec.gov budget is read from the `SEC_RATE_LIMIT` environment variable.
+    """
+    global _shared_client
+    with _shared_lock:
+        if _shared_client is None:
+            sec_rate = float(os.getenv("SEC_RATE_LIMIT", 10))
+            _shared_client = RateLimitedClient(rates={host: sec_rate for host in SEC_HOSTS})
+        return _shared_client
@@ -0,0 +1,634 @@
+"""Local vector index shared by the streaming indexer and the query service.
+
+The stream version writes its documents to an external store and the batch
+version builds its own InMemoryDocumentStore, so a question can't see a
+document indexed a moment ago without a round-trip through another service.
+A segment index is a directory both sides open:
+
+- `SegmentWriter` (or `SegmentSink` in a dataflow) writes new documents to
+  immutable, uncompressed Arrow IPC segment files, then publishes them by
+  replacing `MANIFEST.json`, the list of live segments, with `os.replace`.
+  Writers of different workers or processes take turns on a lock file.
+- `SegmentReader` memory maps the segments of the manifest. When the
+  manifest changes it maps the new segments and swaps in a new immutable
+  snapshot, searches read whichever snapshot is current and never lock.
+  A document written again, e.g. an updated story, is found in its newest
+  segment only.
+
+Embeddings are searched in place in the mapped files, so a document is
+searchable as soon as its segment is published, typically a fraction of a
+second after it was embedded. The writer and reader also work in one process.
+
+Segments are partitioned by time: the documents of a batch are split into
+buckets of `bucket_seconds` by their `updated_at`, or `created_at`, and the
+manifest records the bucket and time range of every segment. A search with
+`since` and `until` only touches the segments overlapping the range. Segments
+older than the reader's `hot_window` are not kept mapped, they are opened when
+a search reaches back to them. `maintain_segments` merges the many small
+segments of a bucket into one, dropping replaced versions of documents, and
+deletes the segments older than a TTL, so memory and query latency depend on
+the recent documents rather than on the whole history.
+"""
+import fcntl
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+from bytewax.outputs import DynamicSink, StatelessSinkPartition
+from haystack import Document
+from typing_extensions import override
+
+from .document_archive import ArchiveWriter, _read_table, _row, archive_schema, embedding_matrix
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = "MANIFEST.json"
+LOCK = ".manifest.lock"
+
+# Metadata fields holding the time of a document, the first one set is used
+TIME_FIELDS = ("updated_at", "created_at")
+
+Timestamp = Union[str, datetime, float, int, None]
+
+
+def to_epoch(value: Timestamp) -> Optional[float]:
+    """Seconds since the epoch of an ISO 8601 timestamp such as `2024-05-29T13:26:51Z`."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def document_time(meta: Dict[str, Any]) -> Optional[float]:
+    """Epoch seconds of the first of `TIME_FIELDS` set in the metadata."""
+    for field in TIME_FIELDS:
+        try:
+            epoch = to_epoch(meta.get(field))
+        except ValueError:
+            continue
+        if epoch is not None:
+            return epoch
+    return None
+
+
+def read_manifest(directory: Union[Path, str]) -> Dict[str, Any]:
+    """The published manifest, an empty one if nothing was published yet."""
+    try:
+        with open(Path(directory) / MANIFEST, "r", encoding="utf-8") as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        return {"generation": 0, "segments": []}
+    # Manifests written before segments had a time range list their names
+    manifest["segments"] = [entry if isinstance(entry, dict) else
+                            {"name": entry, "bucket": None, "min_time": None, "max_time": None, "rows": None}
+                            for entry in manifest["segments"]]
+    return manifest
+
+
+def _write_manifest(directory: Path, manifest: Dict[str, Any]) -> None:
+    temporary = directory / f".{MANIFEST}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(manifest, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, directory / MANIFEST)
+
+
+class _ManifestLock:
+    """Exclusive lock of the writers of a segment directory, readers never take it."""
+
+    def __init__(self, directory: Path):
+        self._path = directory / LOCK
+        self._file = None
+
+    def __enter__(self) -> "_ManifestLock":
+        self._file = open(self._path, "a")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+def _overlaps(entry: Dict[str, Any], since: Optional[float], until: Optional[float]) -> bool:
+    """Whether a segment may hold documents in `[since, until)`, unknown ranges always may."""
+    if entry["min_time"] is None:
+        return True
+    return (since is None or entry["max_time"] >= since) and (until is None or entry["min_time"] < until)
+
+
+class SegmentWriter:
+    """Write documents to new segments of a segment index and publish them."""
+
+    def __init__(self, directory: Union[Path, str], writer_id: str = "w000", max_segment_rows: int = 10_000,
+                 bucket_seconds: float = 3600.0):
+        """
+        :param directory: Directory of the index, created if missing.
+        :param writer_id: Unique name of the writer, e.g. its worker index.
+        :param max_segment_rows: Documents per segment, more are split over
+            several segments published together.
+        :param bucket_seconds: Width of the time buckets, documents of
+            different buckets never share a segment.
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_rows = max_segment_rows
+        self.bucket_seconds = bucket_seconds
+        # One record batch per segment, so a reader maps the embeddings
+        # without copying them
+        self._archive = ArchiveWriter(self.directory, prefix=f"segment-{writer_id}", format="arrow",
+                                      rows_per_file=max_segment_rows, rows_per_batch=max_segment_rows,
+                                      compression=None)
+
+    def _bucket(self, epoch: float) -> int:
+        return int(epoch // self.bucket_seconds * self.bucket_seconds)
+
+    def publish(self, items: Iterable[Union[Document, Dict[str, Any]]]) -> int:
+        """
+        Write documents, or their dictionaries, to new segments and publish them.
+
+        :return: Generation of the manifest that made them visible, 0 if
+            there was nothing to publish.
+        """
+        now = time.time()
+        buckets: Dict[int, List[Tuple[Dict[str, Any], float]]] = {}
+        for item in items:
+            row = _row(item)
+            epoch = document_time(row["meta"])
+            epoch = now if epoch is None else epoch
+            buckets.setdefault(self._bucket(epoch), []).append((row, epoch))
+
+        entries = []
+        for bucket, rows in sorted(buckets.items()):
+            # One segment per slice, so every entry has the range and count of its own rows
+            for start in range(0, len(rows), self.max_segment_rows):
+                part = rows[start:start + self.max_segment_rows]
+                written = len(self._archive.files)
+                self._archive.write(row for row, _ in part)
+                times = [epoch for _, epoch in part]
+                for segment in self._archive.close()[written:]:
+                    entries.append({"name": segment.name, "bucket": bucket, "min_time": min(times),
+                                    "max_time": max(times), "rows": len(part)})
+        if not entries:
+            return 0
+        with _ManifestLock(self.directory):
+            manifest = read_manifest(self.directory)
+            manifest["generation"] += 1
+            manifest["segments"] += entries
+            _write_manifest(self.directory, manifest)
+        return manifest["generation"]
+
+
+class _SegmentPartition(StatelessSinkPartition[Any]):
+    def __init__(self, writer: SegmentWriter, maintenance_interval: Optional[float], ttl: Optional[float]):
+        self._writer = writer
+        self._stop = threading.Event()
+        self._maintenance = None
+        if maintenance_interval:
+            self._maintenance = threading.Thread(target=self._maintain, args=(maintenance_interval, ttl),
+                                                 daemon=True, name="segment-maintenance")
+            self._maintenance.start()
+
+    def _maintain(self, interval: float, ttl: Optional[float]) -> None:
+        while not self._stop.wait(interval):
+            try:
+                maintain_segments(self._writer.directory, ttl=ttl)
+            except Exception:
+                logger.exception("Segment maintenance failed")
+
+    @override
+    def write_batch(self, items: List[Any]) -> None:
+        self._writer.publish(items)
+
+    @override
+    def close(self) -> None:
+        self._stop.set()
+        if self._maintenance is not None:
+            self._maintenance.join()
+
+
+class SegmentSink(DynamicSink[Any]):
+    """Publish every batch of Documents, or their dictionaries, as new segments."""
+
+    def __init__(self, directory: Union[Path, str], max_segment_rows: int = 10_000, bucket_seconds: float = 3600.0,
+                 maintenance_interval: Optional[float] = 60.0, ttl: Optional[float] = None):
+        """Init.
+
+        :arg directory: Directory of the segment index.
+
+        :arg max_segment_rows: Documents per segment.
+
+        :arg bucket_seconds: Width of the time buckets of the segments.
+
+        :arg maintenance_interval: Seconds between two runs of
+            `maintain_segments` by the first worker, None to never run it.
+
+        :arg ttl: Seconds after which segments are deleted, None keeps
+            them.
+
+        """
+        self._directory = directory
+        self._max_segment_rows = max_segment_rows
+        self._bucket_seconds = bucket_seconds
+        self._maintenance_interval = maintenance_interval
+        self._ttl = ttl
+
+    @override
+    def build(self, _step_id: str, worker_index: int, _worker_count: int) -> _SegmentPartition:
+        writer = SegmentWriter(self._directory, writer_id=f"w{worker_index:03d}",
+                               max_segment_rows=self._max_segment_rows, bucket_seconds=self._bucket_seconds)
+        return _SegmentPartition(writer, self._maintenance_interval if worker_index == 0 else None, self._ttl)
+
+
+@dataclass
+class _Segment:
+    name: str
+    table: pa.Table
+    ids: List[str]
+    # View of the mapped file, rows without an embedding are zero
+    embeddings: np.ndarray
+    norms: np.ndarray
+    has_embedding: np.ndarray
+    # Epoch seconds of every document, NaN when it has no time
+    times: np.ndarray
+
+    def document(self, row: int, score: Optional[float] = None) -> Document:
+        return Document(id=self.ids[row], content=self.table.column("content")[row].as_py(),
+                        meta=json.loads(self.table.column("meta")[row].as_py() or "{}"),
+                        embedding=self.embeddings[row].tolist() if self.has_embedding[row] else None, score=score)
+
+
+def _open_segment(path: Path) -> _Segment:
+    table = _read_table(path)
+    column = table.column("embedding")
+    if pa.types.is_fixed_size_list(column.type):
+        embeddings = embedding_matrix(column)
+        has_embedding = column.is_valid().to_numpy(zero_copy_only=False)
+    else:
+        embeddings = np.zeros((table.num_rows, 0), dtype=np.float32)
+        has_embedding = np.zeros(table.num_rows, dtype=bool)
+    norms = np.linalg.norm(embeddings, axis=1) if embeddings.shape[1] else np.zeros(table.num_rows)
+    times = np.array([document_time(json.loads(meta or "{}")) or math.nan
+                      for meta in table.column("meta").to_pylist()], dtype=np.float64)
+    return _Segment(path.name, table, table.column("id").to_pylist(), embeddings,
+                    np.maximum(norms, 1e-12).astype(np.float32), has_embedding, times)
+
+
+def _current_rows(segments: Sequence[_Segment], newer_ids: Set[str]) -> List[np.ndarray]:
+    """Rows of every segment, oldest first, not written again in a newer segment or in `newer_ids`."""
+    seen = set(newer_ids)
+    current = []
+    for segment in reversed(segments):
+        mask = np.ones(len(segment.ids), dtype=bool)
+        for row, doc_id in enumerate(segment.ids):
+            if doc_id in seen:
+                mask[row] = False
+            seen.add(doc_id)
+        current.append(mask)
+    return current[::-1]
+
+
+@dataclass(frozen=True)
+class _Snapshot:
+    generation: int
+    # Manifest entries, oldest segment first
+    entries: Tuple[Dict[str, Any], ...]
+    # Segments within the hot window, mapped and searched in place
+    hot: Dict[str, _Segment]
+    # Rows of every hot segment that are searched: embedded and not written
+    # again in a newer segment
+    live: Dict[str, np.ndarray]
+    # Ids of the hot segments, to hide replaced rows of older segments
+    hot_ids: Dict[str, Set[str]]
+
+
+class SegmentReader:
+    """Search the published segments of a segment index."""
+
+    def __init__(self, directory: Union[Path, str], poll_interval: float = 0.05,
+                 hot_window: Optional[float] = None, cold_segments: int = 16):
+        """
+        :param directory: Directory of the index.
+        :param poll_interval: Seconds between two checks of the manifest by
+            `search`, set to 0 to check before every search.
+        :param hot_window: Seconds of documents, counted back from now, whose
+            segments stay mapped. Older segments are opened when a search
+            reaches back to them. None keeps every segment mapped.
+        :param cold_segments: Older segments kept open after a search used them.
+        """
+        self.directory = Path(directory)
+        self.poll_interval = poll_interval
+        self.hot_window = hot_window
+        self.cold_segments = cold_segments
+        self._snapshot = _Snapshot(0, (), {}, {}, {})
+        self._manifest_stat: Optional[Tuple[int, int]] = None
+        self._checked = 0.0
+        # Only one thread builds the next snapshot, searches never wait for it
+        self._refreshing = threading.Lock()
+        self._cold: "OrderedDict[Tuple[int, str], Tuple[_Segment, np.ndarray]]" = OrderedDict()
+        # Ids of the segments outside the hot window read so far, by name,
+        # segments never change once published
+        self._cold_ids: Dict[str, Set[str]] = {}
+        self._cold_lock = threading.Lock()
+
+    def refresh(self, force: bool = False) -> bool:
+        """Map the segments of a newly published manifest, True if it changed."""
+        if not self._refreshing.acquire(blocking=False):
+            return False
+        try:
+            self._checked = time.monotonic()
+            try:
+                stat = os.stat(self.directory / MANIFEST)
+            except FileNotFoundError:
+                return False
+            if (stat.st_mtime_ns, stat.st_ino) == self._manifest_stat and not force:
+                return False
+            manifest = read_manifest(self.directory)
+            if manifest["generation"] == self._snapshot.generation and not force:
+                self._manifest_stat = (stat.st_mtime_ns, stat.st_ino)
+                return False
+            try:
+                self._snapshot = self._build(manifest)
+            except FileNotFoundError:
+                # Compacted away after the manifest was read, the next
+                # manifest no longer lists it
+                return False
+            self._manifest_stat = (stat.st_mtime_ns, stat.st_ino)
+            logger.info(f"Segment index generation {manifest['generation']}: {len(manifest['segments'])} "
+                        f"segments, {len(self._snapshot.hot)} mapped, {len(self)} documents")
+            return True
+        finally:
+            self._refreshing.release()
+
+    def _is_hot(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.hot_window is None or entry["max_time"] is None or entry["max_time"] >= now - self.hot_window
+
+    def _build(self, manifest: Dict[str, Any]) -> _Snapshot:
+        now = time.time()
+        entries = tuple(manifest["segments"])
+        mapped = self._snapshot.hot
+        segments = [mapped.get(entry["name"]) or _open_segment(self.directory / entry["name"])
+                    for entry in entries if self._is_hot(entry, now)]
+        current = _current_rows(segments, set())
+        names = {entry["name"] for entry in entries}
+        with self._cold_lock:
+            self._cold_ids = {name: ids for name, ids in self._cold_ids.items() if name in names}
+        return _Snapshot(
+            generation=manifest["generation"],
+            entries=entries,
+            hot={segment.name: segment for segment in segments},
+            live={segment.name: segment.has_embedding & rows for segment, rows in zip(segments, current)},
+            hot_ids={segment.name: set(segment.ids) for segment in segments},
+        )
+
+    def _segment_ids(self, snapshot: _Snapshot, name: str) -> Set[str]:
+        ids = snapshot.hot_ids.get(name)
+        if ids is not None:
+            return ids
+        with self._cold_lock:
+            ids = self._cold_ids.get(name)
+        if ids is None:
+            ids = set(_read_table(self.directory / name).column("id").to_pylist())
+            with self._cold_lock:
+                self._cold_ids[name] = ids
+        return ids
+
+    def _open_cold(self, snapshot: _Snapshot, position: int) -> Tuple[_Segment, np.ndarray]:
+        """A segment outside the hot window, with the rows replaced by any newer segment hidden."""
+        name = snapshot.entries[position]["name"]
+        key = (snapshot.generation, name)
+        with self._cold_lock:
+            if key in self._cold:
+                self._cold.move_to_end(key)
+                return self._cold[key]
+        segment = _open_segment(self.directory / name)
+        newer = set().union(*(self._segment_ids(snapshot, entry["name"])
+                              for entry in snapshot.entries[position + 1:]))
+        opened = segment, segment.has_embedding & _current_rows([segment], newer)[0]
+        with self._cold_lock:
+            self._cold[key] = opened
+            while len(self._cold) > self.cold_segments:
+                self._cold.popitem(last=False)
+        return opened
+
+    @property
+    def generation(self) -> int:
+        return self._snapshot.generation
+
+    def __len__(self) -> int:
+        """Searchable documents of the hot segments."""
+        return int(sum(mask.sum() for mask in self._snapshot.live.values()))
+
+    def _maybe_refresh(self) -> None:
+        if time.monotonic() - self._checked >= self.poll_interval:
+            self.refresh()
+
+    def _segments(self, snapshot: _Snapshot, since: Optional[float],
+                  until: Optional[float]) -> Iterable[Tuple[_Segment, np.ndarray]]:
+        for position, entry in enumerate(snapshot.entries):
+            if not _overlaps(entry, since, until):
+                continue
+            if entry["name"] in snapshot.hot:
+                yield snapshot.hot[entry["name"]], snapshot.live[entry["name"]]
+            else:
+                try:
+                    yield self._open_cold(snapshot, position)
+                except FileNotFoundError:
+                    # Compacted or expired since the snapshot was built
+                    continue
+
+    def search(self, queries: np.ndarray, top_k: int, since: Timestamp = None,
+               until: Timestamp = None) -> List[List[Document]]:
+        """
+        The `top_k` documents of highest cosine similarity to every row of
+        `queries`, among the documents of `[since, until)` if given.
+        """
+        self._maybe_refresh()
+        snapshot = self._snapshot
+        since, until = to_epoch(since), to_epoch(until)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        candidates: List[List[Tuple[float, int, _Segment]]] = [[] for _ in range(len(queries))]
+        for segment, live in self._segments(snapshot, since, until):
+            if since is not None:
+                live = live & (segment.times >= since)
+            if until is not None:
+                live = live & (segment.times < until)
+            if not live.any() or segment.embeddings.shape[1] != queries.shape[1]:
+                continue
+            scores = (queries @ segment.embeddings.T) / segment.norms
+            scores[:, ~live] = -np.inf
+            k = min(top_k, int(live.sum()))
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for row, rows in enumerate(top):
+                candidates[row] += [(float(scores[row, i]), int(i), segment) for i in rows]
+        results = []
+        for found in candidates:
+            found.sort(key=lambda candidate: -candidate[0])
+            results.append([segment.document(row, score) for score, row, segment in found[:top_k]])
+        return results
+
+    def filter_documents(self, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+        """
+        Current version of the documents of the hot segments, all of them or
+        those matching an `{"field": "id", "operator": "in", "value": [...]}`
+        filter, the one `document_store_validator` uses.
+        """
+        self._maybe_refresh()
+        wanted: Optional[Set[str]] = None
+        if filters is not None:
+            if filters.get("field") != "id" or filters.get("operator") not in ("in", "=="):
+                raise ValueError("SegmentReader only filters on the document id")
+            value = filters["value"]
+            wanted = set(value if isinstance(value, (list, tuple, set)) else [value])
+        snapshot = self._snapshot
+        documents = {}
+        for entry in reversed(snapshot.entries):
+            segment = snapshot.hot.get(entry["name"])
+            if segment is None or (wanted is not None and not wanted & snapshot.hot_ids[entry["name"]]):
+                continue
+            for row, doc_id in enumerate(segment.ids):
+                if doc_id not in documents and (wanted is None or doc_id in wanted):
+                    documents[doc_id] = segment.document(row)
+        return list(documents.values())
+
+    def count_documents(self) -> int:
+        return len(self)
+
+
+def _write_segment(directory: Path, name: str, table: pa.Table) -> None:
+    """Write a table to a single batch segment file, visible once complete."""
+    temporary = directory / f".{name}.tmp"
+    batch = table.combine_chunks().to_batches()[0] if table.num_rows else None
+    with pa.ipc.new_file(str(temporary), table.schema) as writer:
+        if batch is not None:
+            writer.write_batch(batch)
+    os.replace(temporary, directory / name)
+
+
+def _merge(directory: Path, entries: List[Dict[str, Any]], merged_names: Set[str],
+           max_segment_rows: int) -> List[Dict[str, Any]]:
+    """
+    Write the current rows of the segments named `merged_names` to new
+    segments, `entries` are the manifest entries from the first of them on.
+    """
+    # Newest first, a row is current if no newer segment has its id
+    seen: Set[str] = set()
+    kept: Dict[str, pa.Table] = {}
+    for entry in reversed(entries):
+        if entry["name"] not in merged_names:
+            seen.update(_read_table(directory / entry["name"]).column("id").to_pylist())
+            continue
+        table = _read_table(directory / entry["name"])
+        ids = table.column("id").to_pylist()
+        rows = np.ones(len(ids), dtype=bool)
+        for row in range(len(ids) - 1, -1, -1):
+            if ids[row] in seen:
+                rows[row] = False
+            seen.add(ids[row])
+        kept[entry["name"]] = table.filter(pa.array(rows))
+
+    tables = [kept[entry["name"]] for entry in entries if entry["name"] in kept]
+    types = [table.schema.field("embedding").type for table in tables]
+    dimensions = max((t.list_size for t in types if pa.types.is_fixed_size_list(t)), default=None)
+    schema = archive_schema(dimensions)
+    for i, table in enumerate(tables):
+        if not table.schema.equals(schema):
+            # Written before the first embedding, the embedding column is null
+            tables[i] = table.set_column(3, schema.field("embedding"),
+                                         pa.nulls(table.num_rows, schema.field("embedding").type))
+    merged = pa.concat_tables(tables)
+    bucket = entries[0]["bucket"]
+    written = []
+    for part, start in enumerate(range(0, merged.num_rows, max_segment_rows)):
+        chunk = merged.slice(start, max_segment_rows)
+        name = f"compacted-{bucket if bucket is not None else 'none'}-{time.time_ns():x}-{part:03d}.arrow"
+        _write_segment(directory, name, chunk)
+        times = [t for t in (document_time(json.loads(meta or "{}")) for meta in chunk.column("meta").to_pylist())
+                 if t is not None]
+        written.append({"name": name, "bucket": bucket, "min_time": min(times) if times else None,
+                        "max_time": max(times) if times else None, "rows": chunk.num_rows})
+    return written
+
+
+def maintain_segments(directory: Union[Path, str], ttl: Optional[float] = None, min_segments: int = 8,
+                      max_segment_rows: int = 100_000, now: Optional[float] = None) -> Dict[str, int]:
+    """
+    Compact and expire the segments of a segment index.
+
+    Every bucket with at least `min_segments` segments is merged into one
+    segment, without the documents written again later, and segments whose
+    newest document is older than `ttl` seconds are deleted. Merging happens
+    outside the writers' lock, it is published only if no other maintenance
+    changed the bucket meanwhile.
+
+    :return: Counts of `compacted` and `expired` segments and `dropped` rows.
+    """
+    directory = Path(directory)
+    now = time.time() if now is None else now
+    stats = {"compacted": 0, "expired": 0, "dropped": 0}
+    removed: List[str] = []
+
+    manifest = read_manifest(directory)
+    if ttl is not None:
+        with _ManifestLock(directory):
+            manifest = read_manifest(directory)
+            expired = [entry for entry in manifest["segments"]
+                       if entry["max_time"] is not None and entry["max_time"] < now - ttl]
+            if expired:
+                names = {entry["name"] for entry in expired}
+                manifest["generation"] += 1
+                manifest["segments"] = [entry for entry in manifest["segments"] if entry["name"] not in names]
+                _write_manifest(directory, manifest)
+                removed += names
+                stats["expired"] = len(expired)
+
+    buckets: Dict[Any, List[int]] = {}
+    for position, entry in enumerate(manifest["segments"]):
+        buckets.setdefault(entry["bucket"], []).append(position)
+    for bucket, positions in buckets.items():
+        if len(positions) < min_segments:
+            continue
+        entries = [manifest["segments"][position] for position in positions]
+        names = {entry["name"] for entry in entries}
+        merged = _merge(directory, manifest["segments"][positions[0]:], names, max_segment_rows)
+        with _ManifestLock(directory):
+            current = read_manifest(directory)
+            if not names <= {entry["name"] for entry in current["segments"]}:
+                for entry in merged:
+                    (directory / entry["name"]).unlink(missing_ok=True)
+                continue
+            # In place of the newest merged segment, the rows published after
+            # it still replace the merged ones
+            last = max(i for i, entry in enumerate(current["segments"]) if entry["name"] in names)
+            segments = current["segments"]
+            current["segments"] = ([entry for entry in segments[:last] if entry["name"] not in names] + merged
+                                   + segments[last + 1:])
+            current["generation"] += 1
+            _write_manifest(directory, current)
+        removed += names
+        stats["compacted"] += len(entries)
+        stats["dropped"] += sum(entry["rows"] or 0 for entry in entries) - sum(entry["rows"] for entry in merged)
+
+    # Readers that mapped a deleted segment keep reading their mapping
+    for name in removed:
+        (directory / name).unlink(missing_ok=True)
+    if stats["compacted"] or stats["expired"]:
+        logger.info(f"Compacted {stats['compacted']} segments, dropped {stats['dropped']} replaced documents, "
+                    f"expired {stats['expired']} segments")
+    return stats
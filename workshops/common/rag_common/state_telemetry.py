@@ -0,0 +1,348 @@
+"""Memory accounting of stateful steps and long-lived objects of a dataflow.
+
+State that only grows is invisible until the process is killed: the list of
+seen filing ids of `dedupe`, the events buffered by `collect_window` until
+their window closes, the `company_tickers.json` DataFrame and in-memory
+indexes and document stores. `StateTelemetry` reports, per step and key,
+the number of entries, their approximate size in memory and the size of
+their snapshot:
+
+- `stateful_map` runs a `stateful_map` step whose states are measured every
+  `sample_every` updates: entries by `len`, bytes by a sampled `sizeof`
+  walk and the snapshot by the length of the state pickled, which is how
+  bytewax snapshots it;
+- `count_window` and `window_closed` count the events a window operator
+  holds per key, from the events going in and the windows coming out, and
+  estimate their bytes from a sample of the events;
+- `watch` registers objects measured at every report, DataFrames by their
+  `memory_usage`, anything else by the same sampled walk.
+
+A report is logged every `report_interval` seconds, with a warning for every
+step or object over `warn_bytes` and every key over `warn_entries`, and the
+metrics are written as JSON to `metrics_path` when it is set. With
+`trace_allocations` tracemalloc also reports the traced memory of the
+process and its largest allocation sites, at a noticeable cost.
+
+    STATE_REPORT_SECONDS=60 STATE_WARN_MB=512 STATE_WARN_ENTRIES=1000000
+    STATE_METRICS_PATH=state_metrics.json STATE_TRACEMALLOC=1
+"""
+import json
+import logging
+import os
+import pickle
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from itertools import islice
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import bytewax.operators as op
+
+logger = logging.getLogger(__name__)
+
+# Items measured per container at the top level, ten times fewer at every
+# level below, and the levels walked
+SAMPLE_ITEMS = 100
+MAX_DEPTH = 4
+# Allocation sites in a tracemalloc report
+TOP_ALLOCATIONS = 5
+
+
+def approx_size(obj: Any, sample: int = SAMPLE_ITEMS, _depth: int = 0) -> int:
+    """
+    Approximate bytes held by an object and the objects it contains.
+    Containers are measured on a sample of their items and extrapolated,
+    so the cost is bounded however large they are.
+    """
+    memory_usage = getattr(obj, "memory_usage", None)
+    if callable(memory_usage):
+        # pandas DataFrames and Series
+        try:
+            usage = memory_usage(deep=True)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+        except TypeError:
+            pass
+    nbytes = getattr(obj, "nbytes", None)
+    if isinstance(nbytes, int):
+        return sys.getsizeof(obj) + nbytes if getattr(obj, "base", None) is None else sys.getsizeof(obj)
+
+    size = sys.getsizeof(obj)
+    if _depth >= MAX_DEPTH or isinstance(obj, (str, bytes, bytearray, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        items = obj.items()
+    elif isinstance(obj, (list, tuple, set, frozenset)) or type(obj).__name__ == "deque":
+        items = obj
+    elif hasattr(obj, "__dict__"):
+        return size + approx_size(vars(obj), sample, _depth + 1)
+    else:
+        return size
+
+    count = len(obj)
+    if not count:
+        return size
+    limit = max(3, sample // 10 ** _depth)
+    measured = total = 0
+    try:
+        for item in islice(items, limit):
+            if isinstance(item, tuple) and isinstance(obj, dict):
+                total += sum(approx_size(part, sample, _depth + 1) for part in item)
+            else:
+                total += approx_size(item, sample, _depth + 1)
+            measured += 1
+    except RuntimeError:
+        # Changed by another thread while it was measured
+        pass
+    return size + (total * count // measured if measured else 0)
+
+
+def entry_count(obj: Any) -> Optional[int]:
+    """Entries of a container or document store, None if it has no length."""
+    count_documents = getattr(obj, "count_documents", None)
+    if callable(count_documents):
+        return count_documents()
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def snapshot_size(state: Any) -> Optional[int]:
+    """Bytes of a state pickled like a bytewax snapshot, None if it cannot be pickled."""
+    try:
+        return len(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return None
+
+
+class StateTelemetry:
+    """Sampled entry, memory and snapshot sizes of stateful steps, per key."""
+
+    def __init__(self, report_interval: float = 60.0, sample_every: int = 100, warn_bytes: int = 512 * 2 ** 20,
+                 warn_entries: int = 1_000_000, metrics_path: Optional[str] = None,
+                 trace_allocations: bool = False, top_keys: int = 5):
+        """
+        :param report_interval: Seconds between reports.
+        :param sample_every: Updates of a step between two measures of a state.
+            The first state of every key is always measured.
+        :param warn_bytes: Bytes of a step or object from which it is reported as a warning.
+        :param warn_entries: Entries of a key from which it is reported as a warning.
+        :param metrics_path: JSON file the metrics are written to at every report.
+        :param trace_allocations: Start tracemalloc and report the traced memory.
+        :param top_keys: Largest keys listed per step.
+        """
+        self.report_interval = report_interval
+        self.sample_every = sample_every
+        self.warn_bytes = warn_bytes
+        self.warn_entries = warn_entries
+        self.metrics_path = metrics_path
+        self.trace_allocations = trace_allocations
+        self.top_keys = top_keys
+
+        self._lock = threading.Lock()
+        # Step -> key -> entries, bytes and snapshot bytes of the last measure
+        self._states: Dict[str, Dict[str, Dict[str, int]]] = defaultdict(dict)
+        self._updates: Dict[str, int] = defaultdict(int)
+        # Window step -> key -> buffered events, and the sampled event sizes
+        self._windows: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self._event_sizes: Dict[str, Tuple[int, int]] = defaultdict(lambda: (0, 0))
+        self._watched: Dict[str, Tuple[Any, Optional[Callable[[Any], Optional[int]]]]] = {}
+        self._thread: Optional[threading.Thread] = None
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @classmethod
+    def from_env(cls) -> "StateTelemetry":
+        return cls(report_interval=float(os.environ.get("STATE_REPORT_SECONDS", 60)),
+                   sample_every=int(os.environ.get("STATE_SAMPLE_EVERY", 100)),
+                   warn_bytes=int(float(os.environ.get("STATE_WARN_MB", 512)) * 2 ** 20),
+                   warn_entries=int(os.environ.get("STATE_WARN_ENTRIES", 1_000_000)),
+                   metrics_path=os.environ.get("STATE_METRICS_PATH"),
+                   trace_allocations=os.environ.get("STATE_TRACEMALLOC", "") not in ("", "0"))
+
+    def stateful_map(self, step_id: str, up: Any, mapper: Callable[[Any, Any], Tuple[Any, Any]]) -> Any:
+        """
+        `op.stateful_map` measuring the state of every key. The mapper does
+        not see the key, so it is carried into the step by a `map` step.
+        """
+        self.start()
+        keyed = op.map(f"{step_id}_key", up, lambda item: (item[0], item))
+
+        def measured(state: Any, item: Tuple[str, Any]) -> Tuple[Any, Any]:
+            key, value = item
+            state, emit = mapper(state, value)
+            self.observe(step_id, key, state)
+            return state, emit
+
+        return op.stateful_map(step_id, keyed, measured)
+
+    def observe(self, step: str, key: str, state: Any) -> None:
+        """Record the state of a key after an update, measured every `sample_every` updates."""
+        with self._lock:
+            self._updates[step] += 1
+            states = self._states[step]
+            if state is None:
+                states.pop(key, None)
+                return
+            if key in states and self._updates[step] % self.sample_every:
+                return
+        measure = {"entries": entry_count(state) or 1, "bytes": approx_size(state),
+                   "snapshot_bytes": snapshot_size(state) or 0}
+        with self._lock:
+            self._states[step][key] = measure
+
+    def count_window(self, step_id: str, up: Any) -> Any:
+        """`map` step counting the events going into the window operator `step_id`."""
+        self.start()
+
+        def count(item: Tuple[str, Any]) -> Tuple[str, Any]:
+            key, value = item
+            with self._lock:
+                self._windows[step_id][key] += 1
+                self._updates[step_id] += 1
+                sampled = self._updates[step_id] % self.sample_every == 1 or self.sample_every == 1
+            if sampled:
+                size = approx_size(value)
+                with self._lock:
+                    total, measured = self._event_sizes[step_id]
+                    self._event_sizes[step_id] = (total + size, measured + 1)
+            return item
+
+        return op.map(f"{step_id}_count", up, count)
+
+    def window_closed(self, step_id: str, window: Any) -> None:
+        """Count the events released by the windows and the late events of `window`, a `WindowOut`."""
+        def closed(_step: str, item: Tuple[str, Any]) -> None:
+            key, (_, events) = item
+            self._release(step_id, key, len(events))
+
+        def late(_step: str, item: Tuple[str, Any]) -> None:
+            self._release(step_id, item[0], 1)
+
+        op.inspect(f"{step_id}_closed", window.down, closed)
+        op.inspect(f"{step_id}_late", window.late, late)
+
+    def _release(self, step: str, key: str, count: int) -> None:
+        with self._lock:
+            held = self._windows[step]
+            held[key] -= count
+            if held[key] <= 0:
+                del held[key]
+
+    def watch(self, name: str, obj: Any, entries: Optional[Callable[[Any], Optional[int]]] = None) -> None:
+        """
+        Measure a long-lived object at every report.
+
+        :param entries: Counts the entries of the object, by default its
+            `count_documents()` or `len`.
+        """
+        self.start()
+        with self._lock:
+            self._watched[name] = (obj, entries)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Current sizes of the steps, windows, watched objects and the process."""
+        with self._lock:
+            states = {step: dict(keys) for step, keys in self._states.items()}
+            windows = {step: dict(keys) for step, keys in self._windows.items()}
+            event_sizes = dict(self._event_sizes)
+            watched = dict(self._watched)
+
+        steps = {}
+        for step, keys in states.items():
+            largest = sorted(keys.items(), key=lambda item: -item[1]["bytes"])[:self.top_keys]
+            steps[step] = {
+                "keys": len(keys),
+                **{field: sum(measure[field] for measure in keys.values())
+                   for field in ("entries", "bytes", "snapshot_bytes")},
+                "top": {key: measure for key, measure in largest},
+            }
+        for step, keys in windows.items():
+            total, measured = event_sizes.get(step, (0, 0))
+            event_bytes = total / measured if measured else 0
+            largest = sorted(keys.items(), key=lambda item: -item[1])[:self.top_keys]
+            steps[step] = {
+                "keys": len(keys),
+                "entries": sum(keys.values()),
+                "bytes": int(sum(keys.values()) * event_bytes),
+                "top": {key: {"entries": count, "bytes": int(count * event_bytes)} for key, count in largest},
+            }
+
+        objects = {}
+        for name, (obj, entries) in watched.items():
+            objects[name] = {"entries": (entries or entry_count)(obj), "bytes": approx_size(obj)}
+
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        process: Dict[str, Any] = {"max_rss_bytes": max_rss}
+        if tracemalloc.is_tracing():
+            process["traced_bytes"], process["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+            process["top_allocations"] = {str(stat.traceback[0]): stat.size for stat in statistics}
+        return {"time": time.time(), "steps": steps, "objects": objects, "process": process}
+
+    def report(self) -> Dict[str, Any]:
+        """Log the metrics, warn about the ones over the thresholds and write them to `metrics_path`."""
+        metrics = self.metrics()
+        for step, row in metrics["steps"].items():
+            snapshot = f", snapshots {_mb(row['snapshot_bytes'])}" if "snapshot_bytes" in row else ""
+            logger.info(f"State of {step}: {row['keys']} keys, {row['entries']} entries, "
+                        f"~{_mb(row['bytes'])}{snapshot}")
+            if row["bytes"] >= self.warn_bytes:
+                logger.warning(f"State of {step} holds ~{_mb(row['bytes'])}, over {_mb(self.warn_bytes)}")
+            for key, measure in row["top"].items():
+                if measure["entries"] >= self.warn_entries:
+                    logger.warning(f"Key {key!r} of {step} holds {measure['entries']} entries, "
+                                   f"over {self.warn_entries}")
+        for name, row in metrics["objects"].items():
+            logger.info(f"{name}: {row['entries']} entries, ~{_mb(row['bytes'])}")
+            if row["bytes"] >= self.warn_bytes:
+                logger.warning(f"{name} holds ~{_mb(row['bytes'])}, over {_mb(self.warn_bytes)}")
+        process = metrics["process"]
+        traced = f", {_mb(process['traced_bytes'])} traced" if "traced_bytes" in process else ""
+        logger.info(f"Process max RSS {_mb(process['max_rss_bytes'])}{traced}")
+
+        if self.metrics_path:
+            with open(self.metrics_path + ".tmp", "w") as f:
+                json.dump(metrics, f, default=str)
+            os.replace(self.metrics_path + ".tmp", self.metrics_path)
+        return metrics
+
+    def start(self) -> None:
+        """Start the thread reporting every `report_interval` seconds."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="state-telemetry")
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.report_interval)
+            try:
+                self.report()
+            except Exception as e:
+                logger.error(f"State telemetry report failed: {e}")
+
+
+def _mb(size: float) -> str:
+    return f"{size / 2 ** 20:.1f} MB"
+
+
+_shared_telemetry: Optional[StateTelemetry] = None
+_shared_lock = threading.Lock()
+
+
+def get_telemetry() -> StateTelemetry:
+    """
+    Return the telemetry shared by every step in this process, configured
+    by the `STATE_*` environment variables.
+    """
+    global _shared_telemetry
+    with _shared_lock:
+        if _shared_telemetry is None:
+            _shared_telemetry = StateTelemetry.from_env()
+        return _shared_telemetry
@@ -0,0 +1,371 @@
+"""Opt-in profiling of chosen dataflow steps and Haystack components.
+
+A profile of the whole `bytewax.run` process mixes the frames of every step
+with the runtime. This module profiles only the calls of the steps that are
+asked for, and writes one profile per step:
+
+- `sample` mode (the default) reads the stacks of the threads inside a
+  profiled step every few milliseconds from a background thread, so the
+  steps themselves only pay for a dictionary update per call. Stacks are
+  written as `<step>.<pid>.collapsed`, one `frame;frame;frame count` line
+  per stack, for `flamegraph.pl` or speedscope.
+- `cprofile` mode runs every call of a step under `cProfile` and writes
+  `<step>.<pid>.pstats`, exact call counts at a higher overhead. Only the
+  outermost profiled step of a thread is profiled.
+
+Wrap step functions with `profiled` and the components of a pipeline with
+`profile_components`. Nothing is recorded until profiling is enabled with
+environment variables:
+
+    STEP_PROFILE=embed_content,document_cleaner   # step names, * for all
+    STEP_PROFILE_MODE=sample                      # or cprofile
+    STEP_PROFILE_DIR=profiles                     # output directory
+    STEP_PROFILE_INTERVAL=30                      # seconds between writes
+
+It can be switched in a running deployment by the control file, which is
+read every second, or `SIGUSR2`, which toggles it:
+
+    python -m rag_common.step_profiler on --steps embed_content --mode sample
+    python -m rag_common.step_profiler off
+"""
+import argparse
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+from types import FrameType
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SAMPLE = "sample"
+CPROFILE = "cprofile"
+MODES = (SAMPLE, CPROFILE)
+
+# Frames walked per sample, deeper stacks are cut at the step
+MAX_DEPTH = 128
+CONTROL_FILE = "control.json"
+
+
+def _parse_steps(steps: Any) -> Set[str]:
+    if isinstance(steps, str):
+        steps = steps.split(",")
+    return {step.strip() for step in steps or () if step and step.strip()}
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StepProfiler:
+    """Per-step sampling or cProfile profiles, written periodically."""
+
+    def __init__(self, steps: Iterable[str] = (), mode: str = SAMPLE, directory: str = "profiles",
+                 write_interval: float = 30.0, sample_interval: float = 0.005, control_path: Optional[str] = None,
+                 poll_interval: float = 1.0):
+        """
+        :param steps: Names of the profiled steps, `*` for all, none disables profiling.
+        :param mode: `sample` or `cprofile`.
+        :param directory: Directory of the profile files.
+        :param write_interval: Seconds between writes of the profiles.
+        :param sample_interval: Seconds between two stack samples.
+        :param control_path: JSON file overriding the settings when it
+            changes, by default `control.json` in `directory`.
+        :param poll_interval: Seconds between reads of the control file.
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}")
+        self.steps = _parse_steps(steps)
+        self.mode = mode
+        self.directory = directory
+        self.write_interval = write_interval
+        self.sample_interval = sample_interval
+        self.control_path = control_path or os.path.join(directory, CONTROL_FILE)
+        self.poll_interval = poll_interval
+        self.enabled = bool(self.steps)
+
+        self._lock = threading.Lock()
+        # Thread id -> the profiled steps the thread is in, with their entry frames
+        self._active: Dict[int, List[Tuple[str, FrameType]]] = defaultdict(list)
+        self._stacks: Dict[str, Counter] = defaultdict(Counter)
+        self._calls: Dict[str, Counter] = defaultdict(Counter)
+        self._seconds: Dict[str, float] = defaultdict(float)
+        # (step, thread id) -> profile of the calls of a step in a thread, and its lock
+        self._profiles: Dict[Tuple[str, int], Tuple[cProfile.Profile, threading.Lock]] = {}
+        self._profiling = threading.local()
+        self._control_mtime: Optional[float] = None
+        self._written: Dict[str, Dict[str, int]] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_env(cls) -> "StepProfiler":
+        directory = os.environ.get("STEP_PROFILE_DIR", "profiles")
+        return cls(steps=os.environ.get("STEP_PROFILE", ""),
+                   mode=os.environ.get("STEP_PROFILE_MODE", SAMPLE),
+                   directory=directory,
+                   write_interval=float(os.environ.get("STEP_PROFILE_INTERVAL", 30)),
+                   sample_interval=float(os.environ.get("STEP_PROFILE_SAMPLE_MS", 5)) / 1000,
+                   control_path=os.environ.get("STEP_PROFILE_CONTROL"))
+
+    def wants(self, step: str) -> bool:
+        return self.enabled and ("*" in self.steps or step in self.steps)
+
+    def wrap(self, step: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        """Profile the calls of `func` as `step` while profiling of the step is enabled."""
+        self.start()
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if not self.wants(step):
+                return func(*args, **kwargs)
+            if self.mode == CPROFILE:
+                return self._call_cprofile(step, func, args, kwargs)
+            return self._call_sampled(step, func, args, kwargs)
+        return wrapper
+
+    def _call_sampled(self, step: str, func: Callable[..., Any], args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        thread_id = threading.get_ident()
+        entry = (step, sys._getframe())
+        with self._lock:
+            self._active[thread_id].append(entry)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                active = self._active[thread_id]
+                active.remove(entry)
+                if not active:
+                    del self._active[thread_id]
+                self._calls[step]["calls"] += 1
+                self._seconds[step] += elapsed
+
+    def _call_cprofile(self, step: str, func: Callable[..., Any], args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        # A thread has a single profiler, inner steps run under the outer one
+        if getattr(self._profiling, "step", None) is not None:
+            return func(*args, **kwargs)
+        key = (step, threading.get_ident())
+        with self._lock:
+            if key not in self._profiles:
+                self._profiles[key] = (cProfile.Profile(), threading.Lock())
+            profile, profile_lock = self._profiles[key]
+        started = time.perf_counter()
+        with profile_lock:
+            self._profiling.step = step
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active in this process
+                self._profiling.step = None
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                self._profiling.step = None
+                with self._lock:
+                    self._calls[step]["calls"] += 1
+                    self._seconds[step] += time.perf_counter() - started
+
+    def start(self) -> None:
+        """Start the thread sampling stacks, reading the control file and writing profiles."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name="step-profiler")
+        self._thread.start()
+
+    def _run(self) -> None:
+        next_poll = next_write = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if now >= next_poll:
+                next_poll = now + self.poll_interval
+                self.read_control()
+            if now >= next_write:
+                next_write = now + self.write_interval
+                self.write()
+            if self.enabled and self.mode == SAMPLE:
+                self.sample()
+                time.sleep(self.sample_interval)
+            else:
+                time.sleep(min(self.poll_interval, max(0.0, next_write - time.monotonic())))
+
+    def sample(self) -> None:
+        """Record the stack of every thread inside a profiled step, below the step."""
+        with self._lock:
+            active = {thread_id: list(entries) for thread_id, entries in self._active.items()}
+        if not active:
+            return
+        frames = sys._current_frames()
+        stacks = []
+        for thread_id, entries in active.items():
+            frame = frames.get(thread_id)
+            for step, entry in entries:
+                labels = []
+                current = frame
+                while current is not None and current is not entry and len(labels) < MAX_DEPTH:
+                    labels.append(_frame_label(current))
+                    current = current.f_back
+                if labels:
+                    stacks.append((step, ";".join([step, *reversed(labels)])))
+        with self._lock:
+            for step, stack in stacks:
+                self._stacks[step][stack] += 1
+                self._calls[step]["samples"] += 1
+
+    def read_control(self) -> None:
+        """Apply the control file if it changed since it was last read."""
+        try:
+            mtime = os.stat(self.control_path).st_mtime
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        try:
+            with open(self.control_path) as f:
+                control = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring profiler control file {self.control_path}: {e}")
+            return
+        self.configure(enabled=control.get("enabled"), steps=control.get("steps"), mode=control.get("mode"))
+
+    def configure(self, enabled: Optional[bool] = None, steps: Any = None, mode: Optional[str] = None) -> None:
+        """Change the profiled steps or mode of a running profiler, None keeps a setting."""
+        if mode is not None and mode not in MODES:
+            logger.warning(f"Ignoring unknown profiling mode {mode!r}")
+            mode = None
+        with self._lock:
+            if steps is not None:
+                self.steps = _parse_steps(steps)
+            if mode is not None:
+                self.mode = mode
+            if enabled is not None:
+                self.enabled = bool(enabled) and bool(self.steps)
+        logger.info(f"Step profiling {'enabled' if self.enabled else 'disabled'}"
+                    + (f" in {self.mode} mode for {', '.join(sorted(self.steps))}" if self.enabled else ""))
+
+    def toggle(self, *_: Any) -> None:
+        """Signal handler switching profiling on and off."""
+        self.configure(enabled=not self.enabled)
+
+    def write(self) -> None:
+        """Write the profiles recorded so far, every file replaced atomically."""
+        pid = os.getpid()
+        with self._lock:
+            calls = {step: dict(counts) for step, counts in self._calls.items()}
+            # Nothing recorded since the last write
+            if calls == self._written:
+                return
+            self._written = calls
+            stacks = {step: dict(counts) for step, counts in self._stacks.items()}
+            seconds = dict(self._seconds)
+            profiles = list(self._profiles.items())
+        os.makedirs(self.directory, exist_ok=True)
+        for step, counts in stacks.items():
+            lines = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+            self._replace(self._path(step, pid, "collapsed"), lines.encode("utf-8"))
+
+        merged: Dict[str, pstats.Stats] = {}
+        for (step, _), (profile, profile_lock) in profiles:
+            # A profile being recorded is written at the next interval
+            if not profile_lock.acquire(timeout=1.0):
+                continue
+            try:
+                stats = pstats.Stats(profile)
+            finally:
+                profile_lock.release()
+            if step in merged:
+                merged[step].add(stats)
+            else:
+                merged[step] = stats
+        for step, stats in merged.items():
+            path = self._path(step, pid, "pstats")
+            stats.dump_stats(path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+        summary = ", ".join(f"{step} {counts.get('calls', 0)} calls {seconds.get(step, 0.0):.1f}s"
+                            + (f" {counts['samples']} samples" if counts.get("samples") else "")
+                            for step, counts in sorted(calls.items()))
+        if summary:
+            logger.info(f"Step profiles written to {self.directory}: {summary}")
+
+    def _path(self, step: str, pid: int, extension: str) -> str:
+        name = re.sub(r"[^\w.-]", "_", step)
+        return os.path.join(self.directory, f"{name}.{pid}.{extension}")
+
+    @staticmethod
+    def _replace(path: str, data: bytes) -> None:
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+_shared_profiler: Optional[StepProfiler] = None
+_shared_lock = threading.Lock()
+
+
+def get_profiler() -> StepProfiler:
+    """
+    Return the profiler shared by every step in this process, configured by
+    the `STEP_PROFILE_*` environment variables. `SIGUSR2` toggles it when
+    it is first created in the main thread.
+    """
+    global _shared_profiler
+    with _shared_lock:
+        if _shared_profiler is None:
+            _shared_profiler = StepProfiler.from_env()
+            if hasattr(signal, "SIGUSR2") and threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGUSR2, _shared_profiler.toggle)
+        return _shared_profiler
+
+
+def profiled(step: str, func: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap a step function, named like its step, for the shared profiler."""
+    return get_profiler().wrap(step, func)
+
+
+def profile_components(pipeline: Any, prefix: Optional[str] = None) -> None:
+    """
+    Wrap the `run` method of every component of a Haystack pipeline for the
+    shared profiler, as step `<prefix>.<component name>`, or the component
+    name without a prefix.
+    """
+    profiler = get_profiler()
+    for name in pipeline.graph.nodes:
+        instance = pipeline.get_component(name)
+        step = f"{prefix}.{name}" if prefix else name
+        instance.run = profiler.wrap(step, instance.run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Switch step profiling of a running dataflow.")
+    parser.add_argument("state", choices=("on", "off"))
+    parser.add_argument("--steps", help="Comma separated step names, * for all")
+    parser.add_argument("--mode", choices=MODES)
+    parser.add_argument("--control", default=os.environ.get("STEP_PROFILE_CONTROL") or os.path.join(
+        os.environ.get("STEP_PROFILE_DIR", "profiles"), CONTROL_FILE))
+    args = parser.parse_args()
+    control = {"enabled": args.state == "on"}
+    if args.steps is not None:
+        control["steps"] = sorted(_parse_steps(args.steps))
+    if args.mode is not None:
+        control["mode"] = args.mode
+    os.makedirs(os.path.dirname(args.control) or ".", exist_ok=True)
+    StepProfiler._replace(args.control, json.dumps(control).encode("utf-8"))
+    print(f"Wrote {args.control}: {control}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Streamed answer generation with time-to-first-token measurement.
+
+Waiting for a whole chat completion makes a question feel as slow as its
+longest answer. These helpers request the completion with `stream=True` and
+yield the tokens as they arrive, and an `AnswerTimer` records when each stage
+of the query finished:
+
+- `embed`: the query embedding returned
+- `retrieve`: the documents were retrieved, and packed with a `context_packer`
+- `prompt`: the prompt was assembled
+- `first_token`: the first token arrived, the latency a reader notices
+- `total`: the answer is complete
+
+`stream_chat_completion` streams an OpenAI or Azure OpenAI client,
+`stream_pipeline_answer` runs a Haystack retriever pipeline component by
+component, so retrieval starts as soon as the embedding returns and the
+generator streams into the caller. Both work against `rag_common.chat_stub_server`
+for offline runs.
+"""
+import copy
+import inspect
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class AnswerTimer:
+    """Seconds from the start of a query to the end of each of its stages."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, stage: str) -> None:
+        """Record the end of a stage, the first mark of a stage wins."""
+        self.marks.setdefault(stage, time.perf_counter() - self.start)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        return self.marks.get("first_token")
+
+    @property
+    def total(self) -> Optional[float]:
+        return self.marks.get("total")
+
+    def as_dict(self) -> Dict[str, float]:
+        return {stage: round(seconds, 4) for stage, seconds in self.marks.items()}
+
+    def __repr__(self) -> str:
+        stages = ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in self.marks.items())
+        return f"AnswerTimer({stages})"
+
+
+def stream_chat_completion(client: Any, timer: Optional[AnswerTimer] = None, **kwargs: Any) -> Iterator[str]:
+    """
+    Yield the content of a chat completion as it is generated.
+
+    :param client: `OpenAI` or `AzureOpenAI` client.
+    :param timer: Records `first_token` and `total`.
+    :param kwargs: Arguments of `client.chat.completions.create`, `stream` is set.
+    """
+    timer = timer or AnswerTimer()
+    stream = client.chat.completions.create(stream=True, **kwargs)
+    for chunk in stream:
+        # Azure sends a first chunk without choices with the content filter results
+        if not chunk.choices:
+            continue
+        content = chunk.choices[0].delta.content
+        if content:
+            timer.mark("first_token")
+            yield content
+    timer.mark("total")
+    logger.info(f"Streamed answer: {timer}")
+
+
+class _Cancelled(Exception):
+    """Raised in the streaming callback once the consumer stopped reading."""
+
+
+def _run_streaming(generator: Any, prompt: str, callback: Callable[[Any], None]) -> Dict[str, Any]:
+    """Run a Haystack generator with a streaming callback of this call only."""
+    if "streaming_callback" in inspect.signature(generator.run).parameters:
+        return generator.run(prompt=prompt, streaming_callback=callback)
+    # Older Haystack versions read the callback from the component, so a
+    # copy for this call keeps concurrent answers apart. It shares the client
+    generator = copy.copy(generator)
+    generator.streaming_callback = callback
+    return generator.run(prompt=prompt)
+
+
+def _stream_generator(generator: Any, prompt: str, timer: AnswerTimer) -> Iterator[str]:
+    """
+    Run a Haystack generator in a thread and yield its streaming chunks. If
+    the consumer stops early, the thread ends at the next chunk and is not
+    waited for.
+    """
+    tokens: "queue.Queue[Any]" = queue.Queue()
+    result: Dict[str, Any] = {}
+    cancelled = threading.Event()
+
+    def on_chunk(chunk: Any) -> None:
+        if cancelled.is_set():
+            raise _Cancelled()
+        if chunk.content:
+            tokens.put(chunk.content)
+
+    def run() -> None:
+        try:
+            result.update(_run_streaming(generator, prompt, on_chunk))
+        except _Cancelled:
+            pass
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            tokens.put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True, name="answer-stream")
+    thread.start()
+    finished = False
+    try:
+        while True:
+            token = tokens.get()
+            if token is _DONE:
+                finished = True
+                break
+            timer.mark("first_token")
+            yield token
+    finally:
+        if finished:
+            thread.join()
+        else:
+            cancelled.set()
+    if "error" in result:
+        raise result["error"]
+
+
+def stream_pipeline_answer(
+    pipeline: Any,
+    question: str,
+    timer: Optional[AnswerTimer] = None,
+    answer_cache: Any = None,
+    validate: Optional[Callable[[Dict[str, str]], bool]] = None,
+) -> Iterator[str]:
+    """
+    Yield the answer of a retriever pipeline to a question as it is generated.
+
+    The pipeline must name its components `text_embedder`, `retriever`,
+    `prompt_builder` and `llm`, optionally with a `context_packer`, like
+    `cached_answer` expects. A cached answer is yielded at once, a generated
+    one is stored in `answer_cache` when it is complete.
+
+    :param pipeline: The retriever pipeline, the `llm` an OpenAIGenerator.
+    :param question: The question to answer.
+    :param timer: Records the end of every stage.
+    :param answer_cache: SemanticAnswerCache, no answer caching if None.
+    :param validate: Checks that the documents of a cached answer are unchanged.
+    """
+    timer = timer or AnswerTimer()
+    embedding = pipeline.get_component("text_embedder").run(text=question)["embedding"]
+    timer.mark("embed")
+    if answer_cache is not None:
+        replies = answer_cache.lookup(embedding, validate=validate)
+        if replies is not None:
+            timer.mark("first_token")
+            yield from replies
+            timer.mark("total")
+            return
+
+    documents = pipeline.get_component("retriever").run(query_embedding=embedding)["documents"]
+    template_variables: Dict[str, Any] = {"question": question, "documents": documents}
+    if "context_packer" in pipeline.graph.nodes:
+        packed = pipeline.get_component("context_packer").run(documents=documents, query_embedding=embedding)
+        documents = packed["documents"]
+        template_variables.update(documents=documents, groups=packed["groups"])
+    timer.mark("retrieve")
+    prompt = pipeline.get_component("prompt_builder").run(**template_variables)["prompt"]
+    timer.mark("prompt")
+
+    tokens: List[str] = []
+    for token in _stream_generator(pipeline.get_component("llm"), prompt, timer):
+        tokens.append(token)
+        yield token
+    timer.mark("total")
+    logger.info(f"Streamed answer: {timer}")
+    if answer_cache is not None:
+        answer_cache.store(embedding, ["".join(tokens)], documents)
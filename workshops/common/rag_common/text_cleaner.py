@@ -0,0 +1,130 @@
+"""Single pass cleaning of HTML news content and filing text.
+
+Replaces a chain of a BeautifulSoup parse, a whitespace `re.sub` and the
+regular expressions of DocumentCleaner with one compiled expression. A single
+scan over the text strips tags, comments and script/style blocks, decodes
+entities such as `&#34;` and `&amp;` and collapses the whitespace around all
+of these. The configured noise patterns are removed by a second scan over the
+decoded text, so `[^a-zA-Z0-9\s]` removes the `&` of `AT&amp;T` as it does
+that of `AT&T`.
+"""
+import html
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+from haystack import Document, component
+
+# Fields of news events and document metadata that hold prose, ids, urls,
+# authors and timestamps are left alone
+TEXT_FIELDS = ("headline", "summary", "content", "title")
+
+# Tags that separate words when removed, e.g. "<p>a</p><p>b</p>" is "a b"
+_BLOCK_TAG = re.compile(r"<(?:/?(?:p|div|br|li|ul|ol|tr|td|th|h[1-6]|table|section|article|blockquote|pre)\b|!--)",
+                        re.IGNORECASE)
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n|</?p\b|<br\s*/?>\s*<br", re.IGNORECASE)
+_GAP_PARTS = (
+    r"\s",
+    r"&nbsp;|&#160;|&#xa0;",
+    r"<!--.*?-->",
+    r"<(?:script|style)\b.*?</(?:script|style)\s*>",
+    r"</?[A-Za-z!][^>]*>",
+)
+_MARKUP = re.compile(r"<!--.*?-->|<(?:script|style)\b.*?</(?:script|style)\s*>|</?[A-Za-z!][^>]*>", re.DOTALL)
+# Non-breaking spaces are whitespace, so they are left to the gaps
+_ENTITY = r"&(?!nbsp;|#160;|#xa0;)(?:#\d{1,7}|#[xX][0-9a-fA-F]{1,6}|[A-Za-z][A-Za-z0-9]{1,31});"
+
+
+class TextCleaner:
+    """Compiled cleaner for strings and the text fields of events."""
+
+    def __init__(self, noise_patterns: Sequence[str] = (), keep_paragraphs: bool = False):
+        """
+        :param noise_patterns: Regular expressions of text to remove, e.g.
+            `r"(?i:\\bloading\\b\\.*)"`. Use scoped flags, they are combined
+            into one expression.
+        :param keep_paragraphs: Keep paragraph breaks as a blank line, so a
+            chunker can still cut between passages.
+        """
+        self.noise_patterns = list(noise_patterns)
+        self.keep_paragraphs = keep_paragraphs
+        part = "|".join(_GAP_PARTS)
+        # A lone space between two words is already clean, skipping it keeps
+        # the replacement callback off the common case
+        self._pattern = re.compile(f"(?P<entity>{_ENTITY})|(?P<gap>(?! (?!{part}))(?:{part})+)", re.DOTALL)
+        self._noise = None
+        if self.noise_patterns:
+            noise = "|".join([r"\s"] + [f"(?:{pattern})" for pattern in self.noise_patterns])
+            self._noise = re.compile(f"(?! (?!{noise}))(?:{noise})+", re.DOTALL)
+        self._entities: Dict[str, str] = {}
+
+    def _replace(self, match: "re.Match") -> str:
+        entity = match.group("entity")
+        if entity is not None:
+            decoded = self._entities.get(entity)
+            if decoded is None:
+                decoded = self._entities[entity] = html.unescape(entity)
+            return decoded
+        gap = match.group("gap")
+        if self.keep_paragraphs and _PARAGRAPH_BREAK.search(gap):
+            return "\n\n"
+        # Inline tags and noise inside a word join its parts, whitespace
+        # outside of tags and block tags become a single space
+        if "<" in gap:
+            if _BLOCK_TAG.search(gap):
+                return " "
+            gap = _MARKUP.sub("", gap)
+        return " " if any(c.isspace() for c in gap) or "&" in gap else ""
+
+    def _replace_noise(self, match: "re.Match") -> str:
+        gap = match.group()
+        if self.keep_paragraphs and "\n\n" in gap:
+            return "\n\n"
+        # Noise inside a word joins its parts, like an inline tag
+        return " " if any(c.isspace() for c in gap) else ""
+
+    def clean(self, text: Optional[str]) -> str:
+        """Clean one string."""
+        if not text:
+            return ""
+        text = self._pattern.sub(self._replace, text)
+        if self._noise is not None:
+            text = self._noise.sub(self._replace_noise, text)
+        return text.strip()
+
+    def clean_fields(self, event: Dict[str, Any], fields: Iterable[str] = TEXT_FIELDS) -> Dict[str, Any]:
+        """Clean the string values of the given fields of an event in place."""
+        for field in fields:
+            value = event.get(field)
+            if isinstance(value, str):
+                event[field] = self.clean(value)
+        return event
+
+
+@component
+class DocumentTextCleaner:
+    """
+    Clean the content and the text metadata fields of documents with a
+    TextCleaner, in place of DocumentCleaner. Documents left without content
+    are dropped, they would only cost an embedding call.
+    """
+
+    def __init__(self, noise_patterns: Sequence[str] = (), keep_paragraphs: bool = False,
+                 meta_fields: Iterable[str] = TEXT_FIELDS):
+        """
+        :param noise_patterns: Regular expressions of text to remove.
+        :param keep_paragraphs: Keep paragraph breaks as a blank line.
+        :param meta_fields: Metadata fields cleaned along with the content.
+        """
+        self.cleaner = TextCleaner(noise_patterns=noise_patterns, keep_paragraphs=keep_paragraphs)
+        self.meta_fields = tuple(meta_fields)
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        cleaned = []
+        for document in documents:
+            content = self.cleaner.clean(document.content)
+            if not content:
+                continue
+            meta = self.cleaner.clean_fields(dict(document.meta), self.meta_fields)
+            cleaned.append(Document(content=content, meta=meta))
+        return {"documents": cleaned}
@@ -0,0 +1,345 @@
+"""Streaming, token budgeted chunking of long documents.
+
+`DocumentSplitter(split_by="passage")` needs the whole document first, and
+turns a 10-K full-text submission either into passages too large for the
+embedding model or into thousands of tiny ones, each an embedding call.
+`StreamingChunker` packs text into chunks of at most `max_tokens` tokens as
+the pages of a document are fed to it, cutting at section headings where possible, then between
+passages, then between sentences, and repeats up to `overlap_tokens` tokens of
+a chunk at the start of the next one.
+
+Tokens are estimated with a regular expression that tracks the cl100k_base
+encoding of the OpenAI embedding models closely enough for budgeting. Pass
+`exact=True` to count them with tiktoken instead.
+"""
+import bisect
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional
+
+from haystack import Document, component
+
+# Pieces that are about one cl100k_base token each: words, groups of up to
+# three digits and punctuation marks. Long words take one more per 8 letters.
+PIECE_PATTERN = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+LONG_WORD_PATTERN = re.compile(r"[A-Za-z]{9,}")
+PASSAGE_BREAK = re.compile(r"\n[ \t\r\f\v]*\n\s*")
+SENTENCE_BREAK = re.compile(r"(?<=[.!?;:])\s+")
+WORD_PATTERN = re.compile(r"\S+")
+# Headings of SEC filings ("PART II", "Item 1A. Risk Factors") and markdown
+SECTION_PATTERN = re.compile(r"(?:#{1,6}\s|PART\s+[IVX]+\b|ITEM\s+\d+[A-Z]?\b|Item\s+\d+[A-Z]?\.)")
+# A passage without a break is cut at a sentence once this many characters
+# per token of the budget are buffered
+MAX_CHARS_PER_TOKEN = 16
+
+
+def approximate_token_count(text: str) -> int:
+    """Estimate the number of cl100k_base tokens of a text."""
+    pieces = len(PIECE_PATTERN.findall(text))
+    return pieces + sum((len(word) - 1) // 8 for word in LONG_WORD_PATTERN.findall(text))
+
+
+class TokenCounter:
+    """Count tokens approximately, or exactly with tiktoken."""
+
+    def __init__(self, exact: bool = False, encoding: str = "cl100k_base"):
+        """
+        :param exact: Count with tiktoken, slower than the approximation.
+        :param encoding: tiktoken encoding of the embedding model.
+        """
+        self.exact = exact
+        self._encoding = None
+        if exact:
+            try:
+                import tiktoken
+            except ImportError as e:
+                raise ImportError("Exact token counts need tiktoken, run 'pip install tiktoken'") from e
+            self._encoding = tiktoken.get_encoding(encoding)
+
+    def __call__(self, text: str) -> int:
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        return approximate_token_count(text)
+
+
+@dataclass
+class Chunk:
+    text: str
+    index: int  # Position of the chunk in the stream
+    tokens: int
+    start: int  # Character offset of the chunk in the stream
+    section: Optional[str] = None
+
+
+@dataclass
+class _Unit:
+    text: str
+    tokens: int
+    start: int
+
+
+class StreamingChunker:
+    """Incrementally pack a stream of text into token budgeted chunks."""
+
+    def __init__(self, max_tokens: int = 512, overlap_tokens: int = 64, min_tokens: int = 64,
+                 counter: Optional[TokenCounter] = None):
+        """
+        :param max_tokens: Maximum tokens of a chunk.
+        :param overlap_tokens: Maximum tokens of the end of a chunk repeated at
+            the start of the next one. Sections do not overlap.
+        :param min_tokens: A section heading starts a new chunk only if the
+            current one has at least this many tokens.
+        :param counter: Token counter, approximate by default.
+        """
+        if not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("overlap_tokens must be at least 0 and smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+        self.counter = counter or TokenCounter()
+        self._buffer = ""
+        self._offset = 0  # Stream offset of the buffer
+        self._units: List[_Unit] = []
+        self._carried = 0  # Leading units repeated from the previous chunk
+        self._tokens = 0
+        self._section: Optional[str] = None
+        self._chunk_section: Optional[str] = None
+        self._index = 0
+
+    def feed(self, text: str) -> List[Chunk]:
+        """Add text to the stream and return the chunks it completes."""
+        self._buffer += text
+        chunks: List[Chunk] = []
+        last_break = None
+        for last_break in PASSAGE_BREAK.finditer(self._buffer):
+            pass
+        if last_break is not None:
+            self._consume(last_break.start(), last_break.end(), chunks)
+        elif len(self._buffer) > self.max_tokens * MAX_CHARS_PER_TOKEN:
+            # One endless passage, e.g. a plain text filing, is cut at the
+            # last complete sentence so the buffer stays bounded
+            cut = None
+            for cut in SENTENCE_BREAK.finditer(self._buffer):
+                pass
+            if cut is None:
+                space = self._buffer.rfind(" ")
+                cut_start, cut_end = (space, space + 1) if space > 0 else (len(self._buffer), len(self._buffer))
+            else:
+                cut_start, cut_end = cut.start(), cut.end()
+            self._consume(cut_start, cut_end, chunks)
+        return chunks
+
+    def finish(self) -> List[Chunk]:
+        """Flush the rest of the stream, the chunker can then be reused."""
+        chunks: List[Chunk] = []
+        self._consume(len(self._buffer), len(self._buffer), chunks)
+        if len(self._units) > self._carried:
+            chunks.append(self._emit(overlap=False))
+        self._units, self._carried, self._tokens = [], 0, 0
+        self._offset, self._index, self._section = 0, 0, None
+        return chunks
+
+    def _consume(self, end: int, resume: int, chunks: List[Chunk]) -> None:
+        """Chunk the buffer up to `end` and keep the buffer from `resume` on."""
+        complete, start = self._buffer[:end], self._offset
+        self._buffer = self._buffer[resume:]
+        self._offset += resume
+        position = 0
+        for passage_break in PASSAGE_BREAK.finditer(complete):
+            self._add_passage(complete[position:passage_break.start()], start + position, chunks)
+            position = passage_break.end()
+        self._add_passage(complete[position:], start + position, chunks)
+
+    def _add_passage(self, text: str, start: int, chunks: List[Chunk]) -> None:
+        stripped = text.strip()
+        if not stripped:
+            return
+        start += text.index(stripped[0])
+        if SECTION_PATTERN.match(stripped):
+            if len(self._units) > self._carried and self._tokens >= self.min_tokens:
+                chunks.append(self._emit(overlap=False))
+                self._units, self._carried, self._tokens = [], 0, 0
+            self._section = stripped.split("\n", 1)[0][:100]
+        tokens = self.counter(stripped)
+        if tokens <= self.max_tokens:
+            self._add_unit(_Unit(stripped, tokens, start), chunks)
+            return
+        for unit in self._split(stripped, start):
+            self._add_unit(unit, chunks)
+
+    def _split(self, text: str, start: int) -> Iterator[_Unit]:
+        """Split an oversized passage at sentences, sentences at words and words at the budget."""
+        position = 0
+        for sentence_break in [*SENTENCE_BREAK.finditer(text), None]:
+            end = len(text) if sentence_break is None else sentence_break.start()
+            sentence, sentence_start = text[position:end], position
+            position = len(text) if sentence_break is None else sentence_break.end()
+            if not sentence:
+                continue
+            tokens = self.counter(sentence)
+            if tokens <= self.max_tokens:
+                yield _Unit(sentence, tokens, start + sentence_start)
+                continue
+            words, count, words_start = [], 0, 0
+            for word in WORD_PATTERN.finditer(sentence):
+                word_start = sentence_start + word.start()
+                word_tokens = self.counter(word.group())
+                if words and count + word_tokens > self.max_tokens:
+                    yield _Unit(" ".join(words), count, start + words_start)
+                    words, count = [], 0
+                if word_tokens > self.max_tokens:
+                    # A word over the budget on its own, e.g. a long URL or
+                    # a base64 blob, is cut into pieces that fit
+                    pieces = list(self._split_word(word.group(), word_start))
+                    for piece in pieces[:-1]:
+                        yield _Unit(piece.text, piece.tokens, start + piece.start)
+                    word_tokens, word_start = pieces[-1].tokens, pieces[-1].start
+                    words.append(pieces[-1].text)
+                else:
+                    words.append(word.group())
+                if len(words) == 1:
+                    words_start = word_start
+                count += word_tokens
+            if words:
+                yield _Unit(" ".join(words), count, start + words_start)
+
+    def _split_word(self, word: str, start: int) -> Iterator[_Unit]:
+        """Cut a word into the longest pieces within the budget."""
+        position = 0
+        while position < len(word):
+            # Longest prefix of the rest within the budget, at least one character
+            low, high = position + 1, len(word)
+            while low < high:
+                middle = (low + high + 1) // 2
+                if self.counter(word[position:middle]) <= self.max_tokens:
+                    low = middle
+                else:
+                    high = middle - 1
+            piece = word[position:low]
+            yield _Unit(piece, self.counter(piece), start + position)
+            position = low
+
+    def _add_unit(self, unit: _Unit, chunks: List[Chunk]) -> None:
+        if len(self._units) > self._carried and self._tokens + unit.tokens > self.max_tokens:
+            chunks.append(self._emit(overlap=True))
+        # Drop repeated text that leaves no room for the new unit
+        while self._carried and self._tokens + unit.tokens > self.max_tokens:
+            self._tokens -= self._units.pop(0).tokens
+            self._carried -= 1
+        if not self._units:
+            self._chunk_section = self._section
+        self._units.append(unit)
+        self._tokens += unit.tokens
+
+    def _emit(self, overlap: bool) -> Chunk:
+        chunk = Chunk(
+            text="\n\n".join(unit.text for unit in self._units),
+            index=self._index,
+            tokens=self._tokens,
+            start=self._units[0].start,
+            section=self._chunk_section,
+        )
+        self._index += 1
+        carried = self._overlap() if overlap else []
+        self._units, self._carried = carried, len(carried)
+        self._tokens = sum(unit.tokens for unit in carried)
+        return chunk
+
+    def _overlap(self) -> List[_Unit]:
+        """Trailing passages, or else trailing sentences, within the overlap budget."""
+        if not self.overlap_tokens:
+            return []
+        carried, tokens = [], 0
+        for unit in reversed(self._units):
+            if tokens + unit.tokens > self.overlap_tokens:
+                break
+            carried.insert(0, unit)
+            tokens += unit.tokens
+        if carried:
+            return carried
+        last = self._units[-1]
+        sentences, tokens = [], 0
+        for sentence in reversed(SENTENCE_BREAK.split(last.text)):
+            sentence_tokens = self.counter(sentence)
+            if tokens + sentence_tokens > self.overlap_tokens:
+                break
+            sentences.insert(0, sentence)
+            tokens += sentence_tokens
+        if not sentences:
+            return []
+        text = " ".join(sentences)
+        return [_Unit(text, tokens, last.start + max(last.text.find(sentences[0]), 0))]
+
+
+def _source_of(document: Document) -> str:
+    meta = document.meta or {}
+    return str(meta.get("url") or meta.get("source_url") or meta.get("file_path") or document.id)
+
+
+@component
+class TokenChunker:
+    """
+    Split documents into token budgeted chunks, in place of DocumentSplitter.
+
+    Consecutive documents from the same source, like the pages the
+    Unstructured parser returns for a filing, are streamed through one
+    chunker, so chunks can span them. Each chunk keeps the metadata of the
+    document it starts in and adds `source_id`, `split_id`,
+    `split_idx_start`, `token_count` and `section`.
+    """
+
+    def __init__(self, max_tokens: int = 512, overlap_tokens: int = 64, min_tokens: int = 64, exact: bool = False):
+        """
+        :param max_tokens: Maximum tokens of a chunk, below the 8191 token
+            input limit of the OpenAI embedding models.
+        :param overlap_tokens: Maximum tokens repeated between consecutive chunks.
+        :param min_tokens: A section heading starts a new chunk only if the
+            current one has at least this many tokens.
+        :param exact: Count tokens with tiktoken instead of estimating them.
+        """
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+        self.counter = TokenCounter(exact=exact)
+
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        chunks = []
+        group: List[Document] = []
+        for document in documents:
+            if group and _source_of(document) != _source_of(group[0]):
+                chunks.extend(self._chunk_group(group))
+                group = []
+            group.append(document)
+        if group:
+            chunks.extend(self._chunk_group(group))
+        return {"documents": chunks}
+
+    def _chunk_group(self, group: List[Document]) -> List[Document]:
+        chunker = StreamingChunker(max_tokens=self.max_tokens, overlap_tokens=self.overlap_tokens,
+                                   min_tokens=self.min_tokens, counter=self.counter)
+        starts: List[int] = []
+        produced: List[Chunk] = []
+        offset = 0
+        for document in group:
+            content = document.content or ""
+            starts.append(offset)
+            # A document ends a passage, the next one starts a new one
+            produced.extend(chunker.feed(content + "\n\n"))
+            offset += len(content) + 2
+        produced.extend(chunker.finish())
+
+        documents = []
+        for chunk in produced:
+            position = max(bisect.bisect_right(starts, chunk.start) - 1, 0)
+            origin = group[position]
+            meta: Dict[str, Any] = dict(origin.meta or {})
+            meta.update({
+                "source_id": origin.id,
+                "split_id": chunk.index,
+                "split_idx_start": chunk.start - starts[position],
+                "token_count": chunk.tokens,
+                "section": chunk.section,
+            })
+            documents.append(Document(content=chunk.text, meta=meta))
+        return documents
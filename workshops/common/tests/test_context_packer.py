@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from haystack import Document
+
+from rag_common.context_packer import ContextPacker
+
+STORY = "Virtus Inv price target raised to $267 by Piper Sandler. The analyst maintains Overweight."
+
+
+def documents():
+    return [Document(content=STORY, meta={"symbols": ["VRTS"], "url": "https://www.benzinga.com/a"}),
+            Document(content=STORY, meta={"symbols": ["VRTS"], "url": "https://www.benzinga.com/b"}),
+            Document(content="Faraday Future receives a Nasdaq grant.", meta={"symbols": ["FFIE"], "url": "c"})]
+
+
+def test_near_duplicates_are_dropped_and_groups_formed():
+    result = ContextPacker(max_tokens=200).run(documents=documents())
+
+    assert result["stats"]["duplicates"] == 1
+    assert [group["symbol"] for group in result["groups"]] == ["VRTS", "FFIE"]
+
+
+def test_totals_of_concurrent_queries():
+    packer = ContextPacker(max_tokens=200)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: packer.run(documents=documents())["stats"], range(400)))
+
+    assert packer.totals["queries"] == 400
+    assert packer.totals["tokens_saved"] == sum(stats["tokens_saved"] for stats in results)
@@ -0,0 +1,47 @@
+import time
+
+from haystack import Document
+
+from rag_common.document_archive import ArchiveWriter, DocumentArchiveSink, archive_files, read_archive
+
+
+def news(start, count):
+    return [Document(id=f"d{i}", content=f"story {i}", embedding=[float(i), 1.0]) for i in range(start, start + count)]
+
+
+def test_files_are_rolled_by_time(tmp_path):
+    writer = ArchiveWriter(tmp_path, rows_per_batch=1, roll_interval=0.5)
+    writer.write(news(0, 2))
+    assert not writer.roll_if_due()
+
+    time.sleep(0.5)
+    assert writer.roll_if_due()
+    writer.write(news(2, 1))
+    writer.close()
+
+    assert len(archive_files(tmp_path)) == 2
+    assert read_archive(tmp_path).ids == ["d0", "d1", "d2"]
+
+
+def test_the_sink_rolls_the_file_of_an_idle_stream(tmp_path):
+    partition = DocumentArchiveSink(tmp_path, rows_per_batch=1, roll_interval=0.05).build("archive", 0, 1)
+    partition.write_batch(news(0, 3))
+
+    deadline = time.monotonic() + 5
+    while not archive_files(tmp_path) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    partition.close()
+
+    contents = read_archive(tmp_path)
+    assert contents.ids == ["d0", "d1", "d2"]
+    assert contents.embeddings[2].tolist() == [2.0, 1.0]
+
+
+def test_writers_of_a_restarted_worker_do_not_overwrite_files(tmp_path):
+    for start in (0, 2):
+        writer = ArchiveWriter(tmp_path, prefix="documents-w000")
+        writer.write(news(start, 2))
+        writer.close()
+
+    assert len(archive_files(tmp_path)) == 2
+    assert read_archive(tmp_path).ids == ["d0", "d1", "d2", "d3"]
@@ -0,0 +1,52 @@
+from haystack import Document
+
+from rag_common.near_duplicates import CanonicalEmbeddings, MinHashLSH, NearDuplicateFilter
+
+NOTE = ("Piper Sandler analyst Crispin Love maintains Virtus Inv with a Overweight "
+        "and raises the price target from $265 to $267.")
+EDITED = NOTE.replace("$267", "$270")
+OTHER = "Faraday Future receives Nasdaq grant for extended suspension pending hearing."
+
+
+def test_edited_copy_is_a_near_duplicate():
+    lsh = MinHashLSH(shingle_size=2)
+
+    assert lsh.check("note", NOTE) == (None, 0.0)
+    canonical, similarity = lsh.check("edited", EDITED)
+    assert canonical == "note" and similarity >= 0.8
+    assert lsh.check("other", OTHER)[0] is None
+
+
+def test_expired_signatures_are_forgotten():
+    now = [0.0]
+    lsh = MinHashLSH(ttl=60, clock=lambda: now[0])
+    lsh.check("note", NOTE)
+    now[0] = 61.0
+
+    assert lsh.check("copy", NOTE)[0] is None
+
+
+def test_duplicates_get_the_vector_of_their_canonical_chunk():
+    dedup, canonical = NearDuplicateFilter(), CanonicalEmbeddings()
+    first = dedup.run([Document(id="note", content=NOTE), Document(id="copy", content=NOTE)])
+    embedded = [Document(id=document.id, content=document.content, embedding=[0.5, 0.5])
+                for document in first["documents"]]
+    canonical.run(documents=embedded, duplicates=first["duplicates"])
+    later = dedup.run([Document(id="later", content=NOTE)])
+    result = canonical.run(documents=[], duplicates=later["duplicates"])
+
+    assert [document.id for document in first["documents"]] == ["note"]
+    assert [(document.id, document.meta["duplicate_of"], document.embedding)
+            for document in result["duplicates"]] == [("later", "note", [0.5, 0.5])]
+    assert dedup.stats == {"documents": 3, "duplicates": 2}
+    assert canonical.stats == {"duplicates": 2, "with_vector": 2}
+
+
+def test_duplicate_of_an_evicted_vector_has_none():
+    canonical = CanonicalEmbeddings(max_entries=1)
+    canonical.run(documents=[Document(id="a", content="a", embedding=[1.0]),
+                             Document(id="b", content="b", embedding=[2.0])], duplicates=[])
+    result = canonical.run(documents=[], duplicates=[Document(id="c", content="a", meta={"duplicate_of": "a"})])
+
+    assert result["duplicates"][0].embedding is None
+    assert canonical.stats == {"duplicates": 1, "with_vector": 0}
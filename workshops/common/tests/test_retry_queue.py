@@ -0,0 +1,65 @@
+import json
+from collections import Counter
+from datetime import timedelta
+
+import bytewax.operators as op
+import pytest
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSink, TestingSource, run_main
+
+from rag_common.retry_queue import RetryQueue, RetrySource
+
+
+def test_failed_event_is_queued_then_dead_lettered(tmp_path):
+    path = tmp_path / "dead_letter.jsonl"
+    retries = RetryQueue(max_attempts=2, base_delay=0, dead_letter_path=str(path))
+
+    def fail(event):
+        raise ConnectionError(f"{event} unreachable")
+
+    guarded = retries.guard(fail, key="news")
+    assert guarded("a") == []
+    [item] = retries.pop_due(10)
+    assert (item.payload, item.attempts, item.key) == ("a", 1, "news")
+
+    assert guarded(item) == []
+    assert len(retries) == 0
+    [record] = [json.loads(line) for line in path.read_text().splitlines()]
+    assert record["payload"] == "a" and record["attempts"] == 2 and record["reason"] == "no attempts left"
+    assert record["error"] == "ConnectionError: a unreachable"
+
+
+def test_other_exceptions_are_not_retried():
+    retries = RetryQueue(retry_on=(ConnectionError,))
+
+    def fail(_):
+        raise KeyError("bug")
+
+    with pytest.raises(KeyError):
+        retries.guard(fail)("a")
+    assert len(retries) == 0
+
+
+def test_retries_flow_through_the_dataflow(tmp_path):
+    path = tmp_path / "dead_letter.jsonl"
+    retries = RetryQueue(max_attempts=3, base_delay=0.01, dead_letter_path=str(path), idle_timeout=0.3)
+    attempts = Counter()
+
+    def process(event):
+        attempts[event] += 1
+        if event == "broken" or (event == "flaky" and attempts[event] < 3):
+            raise TimeoutError(event)
+        return [event.upper()]
+
+    output = []
+    flow = Dataflow("retries")
+    events = op.input("input", flow, TestingSource(["ok", "flaky", "broken", "fine"]))
+    retried = op.input("retries", flow, RetrySource(retries, poll_interval=timedelta(milliseconds=10)))
+    merged = op.merge("with_retries", events, retried)
+    op.output("output", op.flat_map("process", merged, retries.guard(process)), TestingSink(output))
+    run_main(flow)
+
+    assert sorted(output) == ["FINE", "FLAKY", "OK"]
+    assert attempts == {"ok": 1, "flaky": 3, "broken": 3, "fine": 1}
+    assert retries.stats == {"failed": 5, "retried": 4, "recovered": 1, "dead_lettered": 1}
+    assert [json.loads(line)["payload"] for line in path.read_text().splitlines()] == ["broken"]
@@ -0,0 +1,54 @@
+import threading
+from types import SimpleNamespace
+
+from rag_common.sec_client import BACKFILL, LIVE, RateLimitedClient, TokenBucket
+
+
+class FakeSession:
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.urls.append(url)
+        return SimpleNamespace(status_code=self.statuses.pop(0), headers={"Retry-After": "0"})
+
+
+def test_backed_off_rate_recovers_to_its_maximum():
+    bucket = TokenBucket(10)
+    bucket.back_off(retry_after=0)
+    assert bucket.rate == 5
+
+    for _ in range(10):
+        bucket.recover()
+    assert bucket.rate == 10
+
+
+def test_live_requests_go_before_the_backfill():
+    bucket = TokenBucket(1, burst=1)
+    assert bucket.try_acquire(BACKFILL) == 0
+    assert bucket.try_acquire(LIVE) > 0
+
+
+def test_throttled_requests_are_retried():
+    session = FakeSession([429, 503, 200])
+    client = RateLimitedClient(rates={"www.sec.gov": 100}, session=session)
+
+    response = client.get("https://www.sec.gov/a.txt")
+
+    assert response.status_code == 200
+    assert len(session.urls) == 3
+    assert client.bucket("https://www.sec.gov/b.txt").rate < 100
+
+
+def test_every_thread_has_its_own_session():
+    client = RateLimitedClient()
+    sessions = []
+    threads = [threading.Thread(target=lambda: sessions.append(client.session)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(session) for session in sessions}) == 4
+    assert client.session is client.session
@@ -0,0 +1,62 @@
+import numpy as np
+from haystack import Document
+
+from rag_common.segment_index import SegmentReader, SegmentWriter, maintain_segments, read_manifest
+
+HOUR = 3600.0
+START = 1_716_940_800.0  # 2024-05-29T00:00:00Z
+
+
+def document(doc_id, epoch, content=None, vector=(1.0, 0.0, 0.0)):
+    return Document(id=doc_id, content=content or doc_id, embedding=list(vector), meta={"updated_at": epoch})
+
+
+def test_every_segment_records_its_own_rows_and_time_range(tmp_path):
+    writer = SegmentWriter(tmp_path, max_segment_rows=4)
+    writer.publish(document(f"d{i}", START + i) for i in range(10))
+
+    entries = read_manifest(tmp_path)["segments"]
+    assert [entry["rows"] for entry in entries] == [4, 4, 2]
+    assert [(entry["min_time"], entry["max_time"]) for entry in entries] == [
+        (START, START + 3), (START + 4, START + 7), (START + 8, START + 9)]
+
+
+def test_cold_segments_hide_documents_written_again_in_newer_cold_segments(tmp_path):
+    writer = SegmentWriter(tmp_path)
+    writer.publish([document("story", START, "first version")])
+    writer.publish([document("story", START + 2 * HOUR, "updated version")])
+    # Both segments are days older than the hot window
+    reader = SegmentReader(tmp_path, poll_interval=0, hot_window=HOUR)
+
+    found = reader.search(np.array([1.0, 0.0, 0.0]), top_k=5)[0]
+
+    assert len(reader) == 0
+    assert [(d.id, d.content) for d in found] == [("story", "updated version")]
+
+
+def test_compaction_keeps_the_current_version_of_every_document(tmp_path):
+    writer = SegmentWriter(tmp_path)
+    for i in range(8):
+        writer.publish([document(f"d{i}", START + i), document("story", START + i, f"version {i}")])
+    reader = SegmentReader(tmp_path, poll_interval=0)
+
+    stats = maintain_segments(tmp_path, min_segments=8)
+    found = reader.search(np.array([1.0, 0.0, 0.0]), top_k=20)[0]
+
+    assert stats == {"compacted": 8, "expired": 0, "dropped": 7}
+    entries = read_manifest(tmp_path)["segments"]
+    assert len(entries) == 1 and entries[0]["rows"] == 9
+    assert sorted(d.id for d in found) == sorted([f"d{i}" for i in range(8)] + ["story"])
+    assert next(d.content for d in found if d.id == "story") == "version 7"
+    assert sorted(p.name for p in tmp_path.glob("*.arrow")) == [entries[0]["name"]]
+
+
+def test_writers_of_a_restarted_worker_do_not_overwrite_segments(tmp_path):
+    SegmentWriter(tmp_path, writer_id="w000").publish([document("a", START)])
+    SegmentWriter(tmp_path, writer_id="w000").publish([document("b", START)])
+
+    names = [entry["name"] for entry in read_manifest(tmp_path)["segments"]]
+    reader = SegmentReader(tmp_path)
+    reader.refresh()
+    assert len(set(names)) == 2
+    assert len(reader) == 2
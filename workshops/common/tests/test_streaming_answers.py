@@ -0,0 +1,49 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from rag_common.streaming_answers import AnswerTimer, _stream_generator
+
+
+class WordGenerator:
+    """Generator streaming the words of its prompt through the callback set on it."""
+
+    def __init__(self, delay=0.005):
+        self.delay = delay
+        self.streaming_callback = None
+
+    def run(self, prompt):
+        for word in prompt.split():
+            time.sleep(self.delay)
+            self.streaming_callback(SimpleNamespace(content=word + " "))
+        return {"replies": [prompt]}
+
+
+def test_concurrent_answers_share_a_generator():
+    generator, answers = WordGenerator(), {}
+
+    def ask(i):
+        answers[i] = "".join(_stream_generator(generator, f"answer {i} " * 10, AnswerTimer()))
+
+    threads = [threading.Thread(target=ask, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert answers == {i: f"answer {i} " * 10 for i in range(4)}
+    assert generator.streaming_callback is None
+
+
+def test_abandoned_answer_does_not_block():
+    timer = AnswerTimer()
+    tokens = _stream_generator(WordGenerator(delay=0.01), "word " * 1000, timer)
+    assert next(tokens) == "word "
+
+    started = time.perf_counter()
+    tokens.close()
+
+    assert time.perf_counter() - started < 0.5
+    assert "first_token" in timer.marks
+    time.sleep(0.1)
+    assert not any(thread.name == "answer-stream" for thread in threading.enumerate())
@@ -0,0 +1,33 @@
+from haystack import Document
+
+from rag_common.text_cleaner import DocumentTextCleaner, TextCleaner
+
+
+def test_markup_and_entities():
+    cleaner = TextCleaner()
+
+    assert cleaner.clean("<p>Virtus&nbsp;Inv</p><p>price <b>tar</b>get &amp; rating</p>") \
+        == "Virtus Inv price target & rating"
+    assert cleaner.clean(None) == ""
+
+
+def test_noise_is_removed_after_decoding_the_entities():
+    cleaner = TextCleaner(noise_patterns=[r"[^a-zA-Z0-9\s]"])
+
+    assert cleaner.clean("a &lt;b&gt; c") == "a b c"
+    assert cleaner.clean("AT&amp;T shares") == "ATT shares"
+
+
+def test_paragraph_breaks_are_kept():
+    cleaner = TextCleaner(noise_patterns=[r"(?i:\bloading\b\.*)"], keep_paragraphs=True)
+
+    assert cleaner.clean("<p>First Loading...</p>\n<p>second</p>") == "First\n\nsecond"
+
+
+def test_documents_left_empty_are_dropped():
+    cleaner = DocumentTextCleaner(meta_fields=["headline"])
+
+    result = cleaner.run(documents=[Document(content="<p> </p>"),
+                                    Document(content="body", meta={"headline": "Q1 &amp; Q2"})])
+
+    assert [(doc.content, doc.meta["headline"]) for doc in result["documents"]] == [("body", "Q1 & Q2")]
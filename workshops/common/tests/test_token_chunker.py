@@ -0,0 +1,45 @@
+from haystack import Document
+
+from rag_common.token_chunker import StreamingChunker, TokenChunker, TokenCounter
+
+COUNTER = TokenCounter()
+PARAGRAPH = ("The Fund invests at least 80% of its net assets in equity securities of companies "
+             "in the technology sector. Returns may vary; past performance is no guarantee. ")
+
+
+def chunk(text, **kwargs):
+    chunker = StreamingChunker(**kwargs)
+    return chunker.feed(text) + chunker.finish()
+
+
+def test_chunks_stay_within_the_token_budget():
+    text = "\n\n".join(PARAGRAPH * (i % 7 + 1) for i in range(60))
+    chunks = chunk(text, max_tokens=128, overlap_tokens=16)
+
+    assert len(chunks) > 1
+    assert all(c.tokens <= 128 and COUNTER(c.text) <= 128 for c in chunks)
+    assert [c.index for c in chunks] == list(range(len(chunks)))
+    assert all(text[c.start:].startswith(c.text.split("\n\n")[0][:40]) for c in chunks)
+
+
+def test_over_long_words_are_cut():
+    # An encoded exhibit or a table flattened to one word per line is one
+    # "word" far over the budget
+    word = "A1b2C3d4" * 400
+    chunks = chunk(f"Exhibit {word} ends here.", max_tokens=64, overlap_tokens=8)
+
+    assert all(c.tokens <= 64 and COUNTER(c.text) <= 64 for c in chunks)
+    assert word in "".join(c.text.replace(" ", "") for c in chunks)
+
+
+def test_pages_of_a_filing_are_chunked_together():
+    pages = [Document(content=PARAGRAPH * 3, meta={"url": "https://www.sec.gov/a.txt", "page_number": page})
+             for page in (1, 2, 3)]
+    other = Document(content="Item 1. Business", meta={"url": "https://www.sec.gov/b.txt"})
+    documents = TokenChunker(max_tokens=64, overlap_tokens=8).run(pages + [other])["documents"]
+
+    filing = [d for d in documents if d.meta["url"].endswith("a.txt")]
+    assert [d.meta["split_id"] for d in filing] == list(range(len(filing)))
+    assert {d.meta["page_number"] for d in filing} == {1, 2, 3}
+    assert all(d.meta["token_count"] <= 64 for d in documents)
+    assert documents[-1].meta["split_id"] == 0 and documents[-1].content == "Item 1. Business"
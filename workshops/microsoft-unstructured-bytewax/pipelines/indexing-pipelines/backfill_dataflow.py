@@ -0,0 +1,111 @@
+"""Rebuild the index from archived daily JSONL dumps.
+
+Reads every file matched by `BACKFILL_PATH`, a directory or a glob, at full
+speed. Every file is a partition, so the files are spread over the workers
+and processes of the run:
+
+    BACKFILL_PATH="archive/news_2024-*.jsonl" python -m bytewax.run backfill_dataflow:flow -w 4
+    python -m bytewax.run backfill_dataflow:flow -p 4 -i 0 -a hosts.txt
+
+The byte offset of each file is snapshotted, so with a recovery directory
+an interrupted backfill continues where it stopped instead of from the start:
+
+    python -m bytewax.recovery recovery/ 1
+    python -m bytewax.run backfill_dataflow:flow -r recovery/ -s 30 -b 0
+
+Chunks are sent to the embedding API at most `BACKFILL_DOCUMENTS_PER_SECOND`
+per process when it is set, a token per chunk rather than per event, as a
+filing can be hundreds of chunks and a news story one, and filing downloads yield to live downloads in
+the shared sec.gov rate limit. Lines/s, documents/s and embeddings/s are
+logged every `BACKFILL_REPORT_SECONDS`.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List
+
+from bytewax import operators as op
+from bytewax.dataflow import Dataflow
+from custom_connectors import MultiFileSource, AzureSearchSink
+from rag_custom_pipeline import safe_deserialize, JSONLReader
+from rag_common.sec_client import BACKFILL, TokenBucket
+from rag_common.step_profiler import profile_components, profiled
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_PATH = os.environ.get("BACKFILL_PATH", "data")
+DOCUMENTS_PER_SECOND = float(os.environ.get("BACKFILL_DOCUMENTS_PER_SECOND", "0"))
+REPORT_SECONDS = float(os.environ.get("BACKFILL_REPORT_SECONDS", "30"))
+
+
+class ThroughputMeter:
+    """Counts shared by the steps of all workers of a process, logged as rates."""
+
+    def __init__(self, report_interval: float = 30.0):
+        self.report_interval = report_interval
+        self.counts: Dict[str, int] = {"lines": 0, "documents": 0, "embeddings": 0, "duplicates": 0}
+        self._started = time.monotonic()
+        self._reported = self._started
+        self._last = dict(self.counts)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, count: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += count
+            now = time.monotonic()
+            if now - self._reported < self.report_interval:
+                return
+            elapsed, self._reported = now - self._reported, now
+            recent = {key: (value - self._last[key]) / elapsed for key, value in self.counts.items()}
+            self._last = dict(self.counts)
+        logger.info(self.format(recent, now - self._started))
+
+    def format(self, rates: Dict[str, float], elapsed: float) -> str:
+        return (f"backfill {elapsed:.0f}s: {rates['lines']:.1f} lines/s, {rates['documents']:.1f} documents/s, "
+                f"{rates['embeddings']:.1f} embeddings/s ({self.counts['lines']} lines, "
+                f"{self.counts['documents']} documents, {self.counts['embeddings']} embeddings, "
+                f"{self.counts['duplicates']} near duplicates not embedded)")
+
+
+def count_lines(meter: ThroughputMeter) -> Callable[[str], str]:
+    def count(line: str) -> str:
+        meter.add("lines")
+        return line
+    return count
+
+
+def make_process_event(reader: JSONLReader, meter: ThroughputMeter) -> Callable[[Any], List[Dict]]:
+    """
+    `flat_map` step indexing one event. The embedding budget is taken per
+    chunk by the `rate_limiter` of the reader.
+    """
+    def process_event(event: Any) -> List[Dict]:
+        if not event:
+            return []
+        dictionaries = reader.run(event)
+        # Near duplicates carry the vector of their canonical chunk, they cost no embedding call
+        duplicate = ['duplicate_of' in json.loads(dictionary["meta"]) for dictionary in dictionaries]
+        meter.add("documents", len(dictionaries))
+        meter.add("duplicates", sum(duplicate))
+        meter.add("embeddings", sum(dictionary.get("vector") is not None and not is_duplicate
+                                    for dictionary, is_duplicate in zip(dictionaries, duplicate)))
+        return dictionaries
+    return process_event
+
+
+meter = ThroughputMeter(report_interval=REPORT_SECONDS)
+rate_limiter = TokenBucket(DOCUMENTS_PER_SECOND) if DOCUMENTS_PER_SECOND else None
+jsonl_reader = JSONLReader(priority=BACKFILL,
+                           rate_limiter=rate_limiter)
+# Opt-in per-step profiles, see rag_common/step_profiler.py
+profile_components(jsonl_reader.pipeline, prefix="build_indeces")
+
+flow = Dataflow("backfill-pipeline")
+lines = op.input("input", flow, MultiFileSource(BACKFILL_PATH))
+counted = op.map("count_lines", lines, count_lines(meter))
+deserialize_data = op.map("deserialize", counted, profiled("deserialize", safe_deserialize))
+extract_html = op.flat_map("build_indeces", deserialize_data,
+                           profiled("build_indeces", make_process_event(jsonl_reader, meter)))
+op.output("output", extract_html, AzureSearchSink())
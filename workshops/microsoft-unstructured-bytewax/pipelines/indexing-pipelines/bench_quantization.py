@@ -0,0 +1,86 @@
+"""Memory versus recall of the quantized storage modes of LocalSearchIndex.
+
+Embeds the bundled news and SEC data with the deterministic HashingEmbedder,
+loads it into a float32, an int8 and a binary index and reports the vector
+memory, recall@k against exact float32 search and the query latency for a
+range of re-scoring multipliers.
+
+    python bench_quantization.py --queries 200 --k 10
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from rag_common.local_embedder import HashingEmbedder, load_corpus
+from local_search_index import LocalSearchIndex, VectorQuery
+
+
+def build_index(vectors, storage, rescore_multiplier=4, full_precision_path=None):
+    index = LocalSearchIndex(dimensions=vectors.shape[1], vector_storage=storage,
+                             rescore_multiplier=rescore_multiplier, full_precision_path=full_precision_path)
+    index.upload_documents({"id": str(i), "vector": vector} for i, vector in enumerate(vectors))
+    return index
+
+
+def run_queries(index, queries, k):
+    results, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        hits = index.search(vector_queries=[VectorQuery(vector=query, k_nearest_neighbors=k)], select=["id"])
+        latencies.append(time.perf_counter() - start)
+        results.append([hit["@search.score"] for hit in hits])
+    return results, latencies
+
+
+def recall(results, truth, k):
+    """
+    Fraction of the results at least as close as the k-th exact neighbor.
+    The corpus has many identical filings, so ties are counted as hits.
+    Re-scored results carry exact scores, so they can be compared directly.
+    """
+    return float(np.mean([
+        sum(score >= exact[-1] - 1e-5 for score in scores) / k
+        for scores, exact in zip(results, truth) if len(exact) == k
+    ]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    args = parser.parse_args()
+
+    texts = load_corpus()
+    embedder = HashingEmbedder(dimensions=args.dimensions)
+    vectors = embedder.embed(texts)
+    rng = np.random.default_rng(0)
+    # Queries are the first words of random documents, like a headline search
+    picks = rng.choice(len(texts), size=min(args.queries, len(texts)), replace=False)
+    queries = embedder.embed([" ".join(texts[i].split()[:8]) for i in picks])
+    print(f"{len(texts)} documents, {len(queries)} queries, {args.dimensions} dimensions, k={args.k}")
+
+    exact = build_index(vectors, "float32")
+    truth, latencies = run_queries(exact, queries, args.k)
+    float_bytes = exact.memory_usage()["full_precision_resident"]
+    print(f"{'storage':<8} {'rescore':>7} {'resident MB':>12} {'vs float32':>10} "
+          f"{f'recall@{args.k}':>10} {'p50 ms':>8}")
+    print(f"{'float32':<8} {'-':>7} {float_bytes / 2**20:>12.2f} {1.0:>10.3f} {1.0:>10.3f} "
+          f"{np.percentile(latencies, 50) * 1000:>8.3f}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for storage in ("int8", "binary"):
+            for multiplier in (1, 2, 4, 8):
+                path = str(Path(tmp) / f"{storage}-{multiplier}.f32")
+                index = build_index(vectors, storage, multiplier, full_precision_path=path)
+                results, latencies = run_queries(index, queries, args.k)
+                resident = index.memory_usage()["quantized_codes"]
+                print(f"{storage:<8} {multiplier:>7} {resident / 2**20:>12.2f} {resident / float_bytes:>10.3f} "
+                      f"{recall(results, truth, args.k):>10.3f} {np.percentile(latencies, 50) * 1000:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Recall and latency of vector index settings on the bundled corpora.
+
+Embeds the news and SEC data once with the deterministic HashingEmbedder (the
+vectors are cached in `.bench_cache/`), generates query sets from it and, for
+every combination of a parameter grid, reports the build time, recall@k
+against brute force and the p50/p95/p99 query latency.
+
+    python bench_retrieval.py --queries 200 --k 10
+    python bench_retrieval.py --grid '{"m": [4, 8], "ef_construction": [100, 400], "ef_search": [50, 500]}'
+
+Any vector store can be measured by wrapping it in a `VectorBackend`, see
+`LocalIndexBackend` and `AzureSearchBackend`.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from rag_common.local_embedder import HashingEmbedder, load_corpus
+from local_search_index import LocalSearchIndex, VectorQuery
+
+CACHE_DIR = Path(".bench_cache")
+
+DEFAULT_GRID = {"m": [4, 16], "ef_construction": [100, 400], "ef_search": [50, 100, 500]}
+
+
+def embed_corpus(embedder: HashingEmbedder, texts: List[str], cache_dir: Path = CACHE_DIR) -> np.ndarray:
+    """Embed texts, reusing the vectors of a previous run over the same texts and embedder."""
+    digest = hashlib.sha256(f"{embedder.dimensions}|{embedder.bigrams}".encode("utf-8"))
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    path = cache_dir / f"vectors-{digest.hexdigest()[:16]}.npy"
+    if path.exists():
+        return np.load(path)
+    vectors = embedder.embed(texts)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    np.save(path, vectors)
+    return vectors
+
+
+def _headline(words: List[str], rng: np.random.Generator) -> str:
+    return " ".join(words[:8])
+
+
+def _keywords(words: List[str], rng: np.random.Generator) -> str:
+    return " ".join(rng.choice(words, size=min(4, len(words)), replace=False))
+
+
+def _noisy(words: List[str], rng: np.random.Generator) -> str:
+    passage = words[:40]
+    return " ".join(word for word in passage if rng.random() > 0.3) or passage[0]
+
+
+# Each query set mimics one kind of question asked of the index
+QUERY_SETS: Dict[str, Callable[[List[str], np.random.Generator], str]] = {
+    "headline": _headline,  # the start of an article or filing title
+    "keywords": _keywords,  # a few words picked anywhere in a document
+    "noisy": _noisy,  # a passage with words dropped, like a paraphrase
+}
+
+
+def generate_queries(texts: List[str], count: int, seed: int = 0) -> Dict[str, List[str]]:
+    """The same `count` random documents turned into a query of every set."""
+    rng = np.random.default_rng(seed)
+    picks = [i for i in rng.permutation(len(texts)) if texts[i].split()][:count]
+    return {name: [make(texts[i].split(), rng) for i in picks] for name, make in QUERY_SETS.items()}
+
+
+def exact_scores(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """Brute force top-k cosine scores of every query, best first."""
+    scores = queries @ vectors.T
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return -np.sort(-np.take_along_axis(scores, best, axis=1), axis=1)
+
+
+def recall(vectors: np.ndarray, queries: np.ndarray, results: List[Sequence[int]], truth: np.ndarray) -> float:
+    """
+    Fraction of the returned rows at least as close as the k-th exact neighbor.
+    The corpus has many identical filings, so ties are counted as hits. The
+    rows are re-scored exactly, so backends with other score scales compare.
+    """
+    k = truth.shape[1]
+    hits = [
+        np.sum(vectors[list(rows)] @ query >= expected[-1] - 1e-5) / k if len(rows) else 0.0
+        for query, rows, expected in zip(queries, results, truth)
+    ]
+    return float(np.mean(hits))
+
+
+class VectorBackend:
+    """
+    A vector store under test. `build` loads the vectors, `search` returns
+    the rows of the nearest vectors. Parameters named in `search_parameters`
+    are applied per query, changing them does not rebuild the store.
+    """
+
+    name = "backend"
+    search_parameters: Tuple[str, ...] = ()
+
+    def build(self, vectors: np.ndarray, **parameters) -> None:
+        raise NotImplementedError
+
+    def search(self, query: np.ndarray, k: int, **parameters) -> List[int]:
+        raise NotImplementedError
+
+
+class BruteForceBackend(VectorBackend):
+    """Exact search with one matrix product, the baseline latency."""
+
+    name = "brute-force"
+
+    def build(self, vectors: np.ndarray, **parameters) -> None:
+        self.vectors = vectors
+
+    def search(self, query: np.ndarray, k: int, **parameters) -> List[int]:
+        scores = self.vectors @ query
+        best = np.argpartition(-scores, k - 1)[:k]
+        return best[np.argsort(-scores[best])].tolist()
+
+
+class LocalIndexBackend(VectorBackend):
+    """`LocalSearchIndex` with the HNSW graph or exhaustive ranking."""
+
+    search_parameters = ("ef_search", "exhaustive")
+
+    def __init__(self, algorithm: str = "hnsw", vector_storage: str = "float32"):
+        self.algorithm = algorithm
+        self.vector_storage = vector_storage
+        self.name = f"local-{algorithm}" + ("" if vector_storage == "float32" else f"-{vector_storage}")
+
+    def build(self, vectors: np.ndarray, **parameters) -> None:
+        rescore_multiplier = parameters.pop("rescore_multiplier", 4)
+        self.index = LocalSearchIndex(dimensions=vectors.shape[1], algorithm=self.algorithm,
+                                      vector_storage=self.vector_storage, rescore_multiplier=rescore_multiplier,
+                                      hnsw_parameters=parameters or None)
+        self.index.upload_documents({"id": str(i), "vector": vector} for i, vector in enumerate(vectors))
+
+    def search(self, query: np.ndarray, k: int, ef_search: Optional[int] = None, exhaustive: bool = False,
+               **parameters) -> List[int]:
+        if ef_search is not None:
+            self.index.hnsw_parameters["ef_search"] = ef_search
+        hits = self.index.search(vector_queries=[VectorQuery(vector=query, k_nearest_neighbors=k, exhaustive=exhaustive)],
+                                 select=["id"])
+        return [int(hit["id"]) for hit in hits]
+
+
+class AzureSearchBackend(VectorBackend):
+    """
+    An Azure AI Search index with an `id` key and a `vector` field, measured
+    over the network. The HNSW parameters are those of the index, only
+    `exhaustive` is set per query. Use a dedicated index, `build` uploads the
+    whole corpus to it.
+    """
+
+    name = "azure"
+    search_parameters = ("exhaustive",)
+
+    def __init__(self, search_client: Any, batch_size: int = 500):
+        self.search_client = search_client
+        self.batch_size = batch_size
+
+    def build(self, vectors: np.ndarray, **parameters) -> None:
+        for start in range(0, len(vectors), self.batch_size):
+            self.search_client.merge_or_upload_documents([
+                {"id": str(start + i), "vector": vector.tolist()}
+                for i, vector in enumerate(vectors[start:start + self.batch_size])
+            ])
+
+    def search(self, query: np.ndarray, k: int, exhaustive: bool = False, **parameters) -> List[int]:
+        from azure.search.documents.models import VectorizedQuery
+
+        results = self.search_client.search(
+            search_text=None,
+            vector_queries=[VectorizedQuery(vector=query.tolist(), k_nearest_neighbors=k, fields="vector",
+                                            exhaustive=exhaustive)],
+            select=["id"],
+            top=k,
+        )
+        return [int(result["id"]) for result in results]
+
+
+def expand_grid(grid: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def benchmark(
+    backend: VectorBackend,
+    vectors: np.ndarray,
+    query_sets: Dict[str, np.ndarray],
+    truth: Dict[str, np.ndarray],
+    grid: Optional[Dict[str, List[Any]]] = None,
+    k: int = 10,
+) -> List[Dict[str, Any]]:
+    """
+    Measure a backend on every parameter combination of a grid. The store is
+    built once per combination of build parameters.
+
+    :return: One row per combination and query set.
+    """
+    grid = grid or {}
+    build_grid = {name: values for name, values in grid.items() if name not in backend.search_parameters}
+    search_grid = {name: values for name, values in grid.items() if name in backend.search_parameters}
+    rows = []
+    for build_parameters in expand_grid(build_grid):
+        start = time.perf_counter()
+        backend.build(vectors, **dict(build_parameters))
+        build_seconds = time.perf_counter() - start
+        for search_parameters in expand_grid(search_grid):
+            for set_name, queries in query_sets.items():
+                results, latencies = [], []
+                for query in queries:
+                    start = time.perf_counter()
+                    results.append(backend.search(query, k, **search_parameters))
+                    latencies.append(time.perf_counter() - start)
+                p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+                rows.append({
+                    "backend": backend.name,
+                    "parameters": {**build_parameters, **search_parameters},
+                    "queries": set_name,
+                    "build_s": build_seconds,
+                    f"recall@{k}": recall(vectors, queries, results, truth[set_name]),
+                    "p50_ms": p50,
+                    "p95_ms": p95,
+                    "p99_ms": p99,
+                })
+    return rows
+
+
+def print_rows(rows: List[Dict[str, Any]], k: int) -> None:
+    print(f"{'backend':<18} {'parameters':<46} {'queries':<9} {'build s':>8} {f'recall@{k}':>10} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for row in rows:
+        parameters = " ".join(f"{name}={value}" for name, value in row["parameters"].items()) or "-"
+        print(f"{row['backend']:<18} {parameters:<46} {row['queries']:<9} {row['build_s']:>8.2f} "
+              f"{row[f'recall@{k}']:>10.3f} {row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f} {row['p99_ms']:>8.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200, help="queries per query set")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--grid", type=json.loads, default=DEFAULT_GRID, help="HNSW parameter grid as JSON")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    texts = load_corpus()
+    embedder = HashingEmbedder(dimensions=args.dimensions)
+    start = time.perf_counter()
+    vectors = embed_corpus(embedder, texts)
+    print(f"{len(texts)} documents embedded or loaded in {time.perf_counter() - start:.2f}s")
+
+    query_sets = {name: embedder.embed(queries) for name, queries in generate_queries(texts, args.queries).items()}
+    truth = {name: exact_scores(vectors, queries, args.k) for name, queries in query_sets.items()}
+    print(f"{len(query_sets)} query sets of {args.queries} queries, {args.dimensions} dimensions, k={args.k}\n")
+
+    rows = benchmark(BruteForceBackend(), vectors, query_sets, truth, k=args.k)
+    rows += benchmark(LocalIndexBackend("exhaustive"), vectors, query_sets, truth, k=args.k)
+    rows += benchmark(LocalIndexBackend("hnsw"), vectors, query_sets, truth, grid=args.grid, k=args.k)
+    print_rows(rows, args.k)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(rows, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
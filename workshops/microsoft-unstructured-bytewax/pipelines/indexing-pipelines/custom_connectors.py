@@ -1,26 +1,36 @@
-"""Connectors for local text files with delay."""
+"""Connectors for local text files with delay, plain or compressed."""
+from glob import glob
 from pathlib import Path
-from typing import Callable, List, Dict, Any, Optional, Union
+from typing import Callable, Iterable, List, Dict, Any, Optional, Union
 from datetime import datetime, timedelta, timezone
 import json
+import logging
 import os
 
 import requests
 from typing_extensions import override
-from bytewax.connectors.files import FileSource, _FileSourcePartition
+from bytewax.connectors.files import FileSource
 from bytewax.outputs import StatelessSinkPartition, DynamicSink
 from dotenv import load_dotenv
 load_dotenv(".env")
 search_api_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
 
 from bytewax import inputs
+from bytewax.inputs import DynamicSource, FixedPartitionedSource, StatefulSourcePartition, StatelessSourcePartition
+from rag_common.compressed_jsonl import open_partition
+
+logger = logging.getLogger(__name__)
+
+# Limits of one indexing request of Azure AI Search
+MAX_ACTIONS_PER_REQUEST = 1000
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
 
 def _get_path_dev(path: Path) -> str:
     return hex(path.stat().st_dev)
 
-class _SimulationSourcePartition(_FileSourcePartition):
-    def __init__(self, path: Path, batch_size: int, resume_state: Optional[int], delay: timedelta):
-        super().__init__(path, batch_size, resume_state)
+class _SimulationSourcePartition(StatefulSourcePartition[str, Any]):
+    def __init__(self, path: Path, batch_size: int, resume_state: Optional[Any], delay: timedelta):
+        self._part = open_partition(path, batch_size, resume_state)
         self._delay = delay
         self._next_awake = datetime.now(timezone.utc)
 
@@ -28,14 +38,26 @@ class _SimulationSourcePartition(_FileSourcePartition):
     def next_batch(self) -> List[str]:
         if self._delay:
             self._next_awake += self._delay
-        return super().next_batch()
+        return self._part.next_batch()
 
     @override
     def next_awake(self) -> Optional[datetime]:
         return self._next_awake
 
+    @override
+    def snapshot(self) -> Any:
+        return self._part.snapshot()
+
+    @override
+    def close(self) -> None:
+        self._part.close()
+
 class SimulationSource(FileSource):
-    """Read a path line-by-line from the filesystem with a delay between batches."""
+    """Read a path line-by-line from the filesystem with a delay between batches.
+
+    The file can be plain, gzip or zstd compressed JSONL, see
+    `compressed_jsonl`.
+    """
 
     def __init__(
         self,
@@ -46,7 +68,7 @@ class SimulationSource(FileSource):
     ):
         """Init.
 
-        :arg path: Path to file.
+        :arg path: Path to file, compressed or not.
 
         :arg batch_size: Number of lines to read per batch. Defaults
             to 10.
@@ -68,15 +90,131 @@ class SimulationSource(FileSource):
 
     @override
     def build_part(
-        self, step_id: str, for_part: str, resume_state: Optional[int]
+        self, step_id: str, for_part: str, resume_state: Optional[Any]
     ) -> _SimulationSourcePartition:
         _fs_id, path = for_part.split("::", 1)
         assert path == str(self._path), "Can't resume reading from different file"
         return _SimulationSourcePartition(self._path, self._batch_size, resume_state, self._delay)
 
+def expand_paths(paths: Union[Path, str, Iterable[Union[Path, str]]], pattern: str = "*.jsonl*") -> List[Path]:
+    """Files named by a directory, a glob or a list of them, sorted."""
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    files = set()
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.update(child for child in path.glob(pattern) if child.is_file())
+        elif path.exists():
+            files.add(path)
+        else:
+            files.update(Path(match) for match in glob(str(path)) if Path(match).is_file())
+    return sorted(files)
+
+class MultiFileSource(FixedPartitionedSource[str, Any]):
+    """Read many files line-by-line at full speed, one partition per file.
+
+    Files are the unit of parallelism, so bytewax spreads them over all
+    workers of all processes. The resume state of each file is its byte
+    offset, or its checkpoint in the compressed stream for gzip and zstd
+    archives, so a dataflow run with recovery continues every file where its
+    last snapshot left off.
+    """
+
+    def __init__(
+        self,
+        paths: Union[Path, str, Iterable[Union[Path, str]]],
+        batch_size: int = 1000,
+        pattern: str = "*.jsonl*",
+        get_fs_id: Callable[[Path], str] = _get_path_dev,
+    ):
+        """Init.
+
+        :arg paths: A directory, a glob such as
+            `"archive/news_2024*.jsonl"`, a file, or a list of them.
+
+        :arg batch_size: Number of lines to read per batch. Defaults
+            to 1000.
+
+        :arg pattern: Files read from a directory. Defaults to
+            `"*.jsonl*"`, which includes `.jsonl.gz` and `.jsonl.zst`
+            archives.
+
+        :arg get_fs_id: Called with the parent directory of every file,
+            see {py:obj}`SimulationSource`.
+
+        """
+        self._paths = {str(path): path for path in expand_paths(paths, pattern)}
+        if not self._paths:
+            raise ValueError(f"No files found for {paths!r}")
+        self._batch_size = batch_size
+        self._get_fs_id = get_fs_id
+
+    @override
+    def list_parts(self) -> List[str]:
+        return [f"{self._get_fs_id(path.parent)}::{key}" for key, path in self._paths.items()]
+
+    @override
+    def build_part(
+        self, step_id: str, for_part: str, resume_state: Optional[Any]
+    ) -> StatefulSourcePartition:
+        _fs_id, path = for_part.split("::", 1)
+        return open_partition(Path(path), self._batch_size, resume_state)
+
+class _TickPartition(StatelessSourcePartition[None]):
+    def __init__(self, interval: timedelta):
+        self._interval = interval
+        self._next_awake = datetime.now(timezone.utc)
+
+    @override
+    def next_batch(self) -> List[None]:
+        self._next_awake += self._interval
+        return [None]
+
+    @override
+    def next_awake(self) -> Optional[datetime]:
+        return self._next_awake
+
+class TickSource(DynamicSource[None]):
+    """Emit `None` on every worker at a fixed interval, forever.
+
+    Merged into a stream, it lets a step run while no events arrive,
+    e.g. to emit the output of work finished in the background.
+    """
+
+    def __init__(self, interval: timedelta = timedelta(milliseconds=200)):
+        """Init.
+
+        :arg interval: Time between ticks. Defaults to 200
+            milliseconds.
+
+        """
+        self._interval = interval
+
+    @override
+    def build(
+        self, _step_id: str, _worker_index: int, _worker_count: int
+    ) -> _TickPartition:
+        return _TickPartition(self._interval)
+
+def _request_bodies(actions: List[Dict[str, Any]]) -> Iterable[bytes]:
+    """JSON bodies of at most `MAX_ACTIONS_PER_REQUEST` actions and `MAX_REQUEST_BYTES` each."""
+    encoded, size = [], 0
+    for action in actions:
+        item = json.dumps(action).encode("utf-8")
+        # 14 bytes of '{"value": []}' and the separators
+        if encoded and (len(encoded) == MAX_ACTIONS_PER_REQUEST
+                        or size + len(item) + len(encoded) + 14 > MAX_REQUEST_BYTES):
+            yield b'{"value": [' + b",".join(encoded) + b"]}"
+            encoded, size = [], 0
+        encoded.append(item)
+        size += len(item)
+    if encoded:
+        yield b'{"value": [' + b",".join(encoded) + b"]}"
+
 class _AzureSearchPartition(StatelessSinkPartition[Any]):
     @override
-    def write_batch(self, dictionary) -> None:
+    def write_batch(self, dictionaries) -> None:
         index_name = "bytewax-index"
         search_api_version = '2023-11-01'
         search_endpoint = f'https://bytewax-workshop.search.windows.net/indexes/{index_name}/docs/index?api-version={search_api_version}'  
@@ -85,28 +223,24 @@ class _AzureSearchPartition(StatelessSinkPartition[Any]):
             'api-key': search_api_key  
         }  
 
-        dictionary = dictionary[0]
-        # Use the flattened meta directly
-        flattened_meta = dictionary['meta']
-        
-        # Convert DataFrame to the format expected by Azure Search  
-        body = json.dumps({  
-            "value": [  
-                {  
-                    "@search.action": "upload",  
-                    "id": dictionary['id'],  
-                    "content": dictionary['content'],  
-                    "meta": flattened_meta,  # Use flattened meta
-                    "vector": dictionary['vector']  # Include the generated embeddings  
-                } 
-            ]  
-        })  
-        
-        # Upload documents to Azure Search  
-        response = requests.post(search_endpoint, 
-                                 headers=headers, data=body) 
-
-        return {"status": "success" if response.status_code == 200 else response.text}
+        # Ids are derived from the source and content, so uploading a
+        # replayed document overwrites the existing entry in the index
+        # The documents carry the typed fields of the index next to the
+        # content, flattened meta and embedding
+        actions = [{"@search.action": "mergeOrUpload", **dictionary} for dictionary in dictionaries]
+
+        # Upload documents to Azure Search, in requests within its limits
+        for body in _request_bodies(actions):
+            response = requests.post(search_endpoint, headers=headers, data=body)
+            if response.status_code >= 400:
+                raise RuntimeError(f"Azure Search upload failed with status {response.status_code}: "
+                                   f"{response.text[:1000]}")
+            if response.status_code == 207:
+                # Some documents failed, the others were indexed
+                failed = [result for result in response.json().get("value", []) if not result.get("status")]
+                for result in failed:
+                    logger.error(f"Azure Search did not index {result.get('key')} "
+                                 f"({result.get('statusCode')}): {result.get('errorMessage')}")
 
 class AzureSearchSink(DynamicSink[Any]):
     """Write each output item to Azure Search
@@ -118,6 +252,32 @@ class AzureSearchSink(DynamicSink[Any]):
     ) -> _AzureSearchPartition:
         return _AzureSearchPartition()
 
+class _LocalSearchPartition(StatelessSinkPartition[Any]):
+    def __init__(self, index):
+        self._index = index
+
+    @override
+    def write_batch(self, dictionaries) -> None:
+        self._index.merge_or_upload_documents(dictionaries)
+
+
+class LocalSearchSink(DynamicSink[Any]):
+    """Write each output item to a LocalSearchIndex, for running the flow offline."""
+
+    def __init__(self, index):
+        """Init.
+
+        :arg index: The `local_search_index.LocalSearchIndex` to write to.
+
+        """
+        self._index = index
+
+    @override
+    def build(
+        self, _step_id: str, _worker_index: int, _worker_count: int
+    ) -> _LocalSearchPartition:
+        return _LocalSearchPartition(self._index)
+
 ## Usage Example
 # from simulated_connector import SimulationSource
 # flow = Dataflow("simulate")
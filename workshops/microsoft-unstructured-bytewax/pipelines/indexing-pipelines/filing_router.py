@@ -0,0 +1,232 @@
+"""Route EDGAR filings by form type to processing paths of different cost.
+
+A 10-K and one of the thousand NPORT-P reports of a day used to get the same
+treatment: a full-text download, remote partitioning and the embedding of
+every element. In the sample day of `sec_filings_20240529.jsonl` NPORT-P,
+Form 4, 10-D and 424B2 alone are half of the 3,016 filings. `FilingRouter`
+looks up the `form_type` of every filing and sends it down one of four paths:
+
+- `SKIP`: not indexed at all;
+- `METADATA`: indexed as a single document made of its title and metadata,
+  without downloading or embedding it;
+- `LIGHT`: downloaded and parsed up to `max_pages` pages;
+- `FULL`: downloaded, parsed and embedded in full.
+
+Every route is a source of the `SourceScheduler`, so it has its own
+concurrency budget and latency target, and an hourly budget of filings. A
+filing arriving when its route has spent its budget goes to the route's
+`overflow` route instead, a cheaper one, so a burst of 8-Ks degrades to
+light parses instead of queueing for hours.
+
+Form types missing from the table use the entry of the form they amend
+(`10-K/A` that of `10-K`), then the default route. The table can be
+replaced with a JSON file, see `FilingRouter.from_file`.
+"""
+import json
+import logging
+import threading
+import time
+from dataclasses import dataclass, fields
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from rag_common.sec_client import LIVE, TokenBucket
+from source_scheduler import SourcePolicy
+
+logger = logging.getLogger(__name__)
+
+SKIP = "skip"
+METADATA = "metadata"
+LIGHT = "light"
+FULL = "full"
+ACTIONS = (SKIP, METADATA, LIGHT, FULL)
+
+
+@dataclass
+class Route:
+    """
+    How the filings of a route are processed.
+
+    :param action: `SKIP`, `METADATA`, `LIGHT` or `FULL`.
+    :param max_concurrency: Filings of this route processed at once.
+    :param latency_target: Seconds from reading a filing to emitting its
+        documents, sets the priority of the route in the scheduler.
+    :param max_pages: Pages of a filing parsed, None for all of them.
+    :param strategy: Partitioning strategy of the Unstructured API, None for
+        the one of the parser.
+    :param budget_per_hour: Filings of this route processed per hour, None
+        for no limit. Up to a tenth of it can be spent at once.
+    :param overflow: Route of the filings over the budget, skipped if None.
+    """
+
+    action: str
+    max_concurrency: int = 1
+    latency_target: float = 300.0
+    max_pages: Optional[int] = None
+    strategy: Optional[str] = None
+    budget_per_hour: Optional[float] = None
+    overflow: Optional[str] = None
+
+
+# Periodic and ownership reports are structured data with little text to
+# retrieve, annual and current reports and proxy statements are what
+# questions are about
+DEFAULT_ROUTES = {
+    "full": Route(FULL, max_concurrency=2, latency_target=300.0, budget_per_hour=120, overflow="light"),
+    "light": Route(LIGHT, max_concurrency=2, latency_target=600.0, max_pages=5, strategy="fast",
+                   budget_per_hour=600, overflow="metadata"),
+    "metadata": Route(METADATA, max_concurrency=1, latency_target=30.0),
+    "skip": Route(SKIP),
+}
+
+DEFAULT_FORMS = {
+    **dict.fromkeys(["10-K", "10-Q", "8-K", "20-F", "40-F", "6-K", "S-1", "S-3", "S-4", "F-1", "F-10",
+                     "DEF 14A", "PREM14A", "DEFM14A", "SC 13D", "SC TO-I", "SC TO-T", "SC 14D9", "ARS"],
+                    "full"),
+    **dict.fromkeys(["424B2", "424B3", "424B5", "424B7", "FWP", "10-D", "497K", "497", "485BPOS", "485APOS",
+                     "N-CSR", "N-CSRS", "N-14", "DEFA14A", "DFAN14A", "425", "SC 13G", "11-K", "S-8", "1-A"],
+                    "light"),
+    **dict.fromkeys(["NPORT-P", "3", "4", "5", "144", "D", "13F-HR", "SD", "40-17F2", "24F-2NT", "NT 10-K",
+                     "NT 10-Q", "8-A12B", "8-A12G", "25", "X-17A-5", "C", "C-AR", "C-U", "MA-I", "MA-A"],
+                    "metadata"),
+    # Loan level asset data, notices and certifications without text worth retrieving
+    **dict.fromkeys(["ABS-EE", "13F-NT", "497J", "CERT", "40-17G", "APP WD", "IRANNOTICE"], "skip"),
+}
+
+
+class FilingRouter:
+    """Form type routing table with an hourly budget per route."""
+
+    def __init__(self, routes: Optional[Dict[str, Route]] = None, forms: Optional[Dict[str, str]] = None,
+                 default: str = "light", prefix: str = "edgar", report_interval: float = 60.0):
+        """
+        :param routes: Routes by name.
+        :param forms: Route name by form type.
+        :param default: Route of the form types missing from `forms`.
+        :param prefix: Prefix of the scheduler source names of the routes.
+        :param report_interval: Seconds between routing reports in the log.
+        """
+        self.routes = dict(DEFAULT_ROUTES if routes is None else routes)
+        self.forms = {form.upper(): name for form, name in (DEFAULT_FORMS if forms is None else forms).items()}
+        self.default = default
+        self.prefix = prefix
+        self.report_interval = report_interval
+        for name, route in self.routes.items():
+            if route.action not in ACTIONS:
+                raise ValueError(f"Unknown action {route.action!r} of route {name!r}")
+            if route.overflow is not None and route.overflow not in self.routes:
+                raise ValueError(f"Unknown overflow route {route.overflow!r} of route {name!r}")
+        for name in {default, *self.forms.values()}:
+            if name not in self.routes:
+                raise ValueError(f"Unknown route {name!r}")
+
+        self._budgets = {
+            name: TokenBucket(route.budget_per_hour / 3600, burst=max(1.0, route.budget_per_hour / 10))
+            for name, route in self.routes.items() if route.budget_per_hour
+        }
+        self._counts = {name: {"routed": 0, "overflowed": 0} for name in self.routes}
+        self._lock = threading.Lock()
+        self._next_report = time.monotonic() + report_interval
+
+    @classmethod
+    def from_file(cls, path: str, **kwargs: Any) -> "FilingRouter":
+        """
+        Load the table from a JSON file with `routes`, a `Route` object per
+        name, `forms`, a route name per form type, and optionally `default`.
+        Missing keys keep the defaults.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        names = {field.name for field in fields(Route)}
+        routes = config.get("routes")
+        if routes is not None:
+            routes = {name: Route(**{key: value for key, value in route.items() if key in names})
+                      for name, route in routes.items()}
+        return cls(routes=routes, forms=config.get("forms"), default=config.get("default", "light"), **kwargs)
+
+    def source(self, name: str) -> str:
+        """Scheduler source name of a route."""
+        return f"{self.prefix}_{name}"
+
+    def lookup(self, form_type: Optional[str]) -> str:
+        """Route name of a form type, before budgets."""
+        form = (form_type or "").strip().upper()
+        if form in self.forms:
+            return self.forms[form]
+        if form.endswith("/A") and form[:-2] in self.forms:
+            return self.forms[form[:-2]]
+        return self.default
+
+    def route(self, event: Dict[str, Any]) -> Optional[str]:
+        """
+        Route name of a filing, following the overflow of routes over their
+        budget. None if the filing is skipped.
+        """
+        name: Optional[str] = self.lookup(event.get("form_type"))
+        seen = set()
+        while name is not None and name not in seen:
+            seen.add(name)
+            budget = self._budgets.get(name)
+            if budget is None or budget.try_acquire(LIVE) == 0:
+                break
+            with self._lock:
+                self._counts[name]["overflowed"] += 1
+            name = self.routes[name].overflow
+        else:
+            name = None
+        if name is not None:
+            with self._lock:
+                self._counts[name]["routed"] += 1
+        self._maybe_report()
+        if name is None or self.routes[name].action == SKIP:
+            return None
+        return name
+
+    def tag(self, event: Any) -> List[Tuple[str, Tuple[float, Any]]]:
+        """
+        `flat_map` step stamping filings with the scheduler source of their
+        route and the time they were read, like `tag_source`. Skipped
+        filings are dropped.
+        """
+        if not event:
+            return []
+        name = self.route(event)
+        if name is None:
+            return []
+        return [(self.source(name), (time.monotonic(), event))]
+
+    def policies(self, handler: Callable[[Any, Route], Iterable[Any]]) -> Dict[str, SourcePolicy]:
+        """
+        Scheduler policies of the routes that process filings.
+
+        :param handler: Called with a filing and its route, returns the items
+            to emit downstream.
+        """
+        return {
+            self.source(name): SourcePolicy(handler=partial(_call_with_route, handler, route),
+                                            max_concurrency=route.max_concurrency,
+                                            latency_target=route.latency_target)
+            for name, route in self.routes.items() if route.action != SKIP
+        }
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """Filings routed to and overflowed from every route."""
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._counts.items()}
+
+    def log_report(self) -> None:
+        routes = ", ".join(f"{name} {counts['routed']} (+{counts['overflowed']} over budget)"
+                           for name, counts in self.report().items())
+        logger.info(f"Filings routed: {routes}")
+
+    def _maybe_report(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_report:
+                return
+            self._next_report = now + self.report_interval
+        self.log_report()
+
+
+def _call_with_route(handler: Callable[[Any, Route], Iterable[Any]], route: Route, event: Any) -> Iterable[Any]:
+    return handler(event, route)
@@ -0,0 +1,162 @@
+"""Hierarchical navigable small world graph for approximate cosine search.
+
+Takes the same parameters as the `myHnsw` configuration in
+`init_azure_index.py` (`m`, `ef_construction`, `ef_search`), so the retrieval
+benchmark can measure locally what each setting costs and buys before it is
+used for the Azure index.
+"""
+import heapq
+import math
+from typing import List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+
+class HnswIndex:
+    """Approximate nearest neighbor index over unit vectors."""
+
+    def __init__(self, dimensions: int, m: int = 4, ef_construction: int = 400, ef_search: int = 500, seed: int = 0):
+        """
+        :param dimensions: Dimensions of the vectors.
+        :param m: Number of links per node on the upper layers, twice as many
+            on the bottom layer.
+        :param ef_construction: Size of the candidate list while inserting.
+        :param ef_search: Size of the candidate list while searching.
+        :param seed: Seed of the random layer assignment.
+        """
+        self.dimensions = dimensions
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self._level_mult = 1 / math.log(max(m, 2))
+        self._rng = np.random.default_rng(seed)
+        self._vectors = np.zeros((0, dimensions), dtype=np.float32)
+        self._links: List[List[List[int]]] = []
+        self._entry: Optional[int] = None
+        self._max_level = -1
+        self.deleted: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._links) - len(self.deleted)
+
+    def _distances(self, query: np.ndarray, nodes: Sequence[int]) -> np.ndarray:
+        return 1.0 - self._vectors[list(nodes)] @ query
+
+    def _search_layer(self, query: np.ndarray, entry_points: List[int], ef: int, level: int) -> List[Tuple[float, int]]:
+        """Best `ef` nodes of a layer as `(distance, node)`, closest first."""
+        visited = set(entry_points)
+        distances = self._distances(query, entry_points)
+        candidates = [(d, n) for d, n in zip(distances.tolist(), entry_points)]
+        heapq.heapify(candidates)
+        results = [(-d, n) for d, n in candidates]
+        heapq.heapify(results)
+        while len(results) > ef:
+            heapq.heappop(results)
+
+        while candidates:
+            distance, node = heapq.heappop(candidates)
+            if distance > -results[0][0] and len(results) >= ef:
+                break
+            neighbors = [n for n in self._links[node][level] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for neighbor_distance, neighbor in zip(self._distances(query, neighbors).tolist(), neighbors):
+                if len(results) < ef or neighbor_distance < -results[0][0]:
+                    heapq.heappush(candidates, (neighbor_distance, neighbor))
+                    heapq.heappush(results, (-neighbor_distance, neighbor))
+                    if len(results) > ef:
+                        heapq.heappop(results)
+        return sorted((-d, n) for d, n in results)
+
+    def _select(self, base: np.ndarray, candidates: List[int], limit: int) -> List[int]:
+        """
+        Pick up to `limit` links among candidates, closest first, skipping a
+        candidate that is closer to an already picked link than to the base.
+        Keeps the links spread out, so clusters of near-identical documents
+        do not use up every link and cut the graph into islands.
+        """
+        if len(candidates) <= 1:
+            return list(candidates)
+        vectors = self._vectors[candidates]
+        distances = 1.0 - vectors @ base
+        # Distance of each candidate to its closest picked link
+        closest_link = np.full(len(candidates), np.inf, dtype=np.float32)
+        picked: List[int] = []
+        for i in np.argsort(distances, kind="stable").tolist():
+            if closest_link[i] > distances[i]:
+                picked.append(candidates[i])
+                if len(picked) == limit:
+                    break
+                np.minimum(closest_link, 1.0 - vectors @ vectors[i], out=closest_link)
+        return picked
+
+    def _shrink(self, node: int, level: int) -> None:
+        limit = self.m0 if level == 0 else self.m
+        links = self._links[node][level]
+        if len(links) > limit:
+            self._links[node][level] = self._select(self._vectors[node], links, limit)
+
+    def add(self, vector: Sequence[float]) -> int:
+        """Insert a vector and return its node id."""
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            # It would be equally far from every query and only add noise to the graph
+            raise ValueError("A zero vector can't be indexed")
+        vector = vector / norm
+
+        node = len(self._links)
+        if node == len(self._vectors):
+            grown = np.zeros((max(16, node * 2), self.dimensions), dtype=np.float32)
+            grown[:node] = self._vectors[:node]
+            self._vectors = grown
+        self._vectors[node] = vector
+        level = int(-math.log(1.0 - self._rng.random()) * self._level_mult)
+        self._links.append([[] for _ in range(level + 1)])
+
+        if self._entry is None:
+            self._entry, self._max_level = node, level
+            return node
+
+        entry_points = [self._entry]
+        for upper in range(self._max_level, level, -1):
+            entry_points = [self._search_layer(vector, entry_points, 1, upper)[0][1]]
+
+        for current in range(min(level, self._max_level), -1, -1):
+            found = self._search_layer(vector, entry_points, self.ef_construction, current)
+            limit = self.m0 if current == 0 else self.m
+            neighbors = self._select(vector, [n for _, n in found], limit)
+            self._links[node][current] = neighbors
+            for neighbor in neighbors:
+                self._links[neighbor][current].append(node)
+                self._shrink(neighbor, current)
+            entry_points = [n for _, n in found]
+
+        if level > self._max_level:
+            self._entry, self._max_level = node, level
+        return node
+
+    def remove(self, node: int) -> None:
+        """Hide a node from results, it still routes searches through the graph."""
+        self.deleted.add(node)
+
+    def search(self, query: Sequence[float], k: int, ef_search: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Find the approximate nearest neighbors of a query.
+
+        :return: `(node, cosine similarity)` pairs, best first.
+        """
+        if self._entry is None:
+            return []
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        ef = max(ef_search or self.ef_search, k)
+
+        entry_points = [self._entry]
+        for level in range(self._max_level, 0, -1):
+            entry_points = [self._search_layer(query, entry_points, 1, level)[0][1]]
+        found = self._search_layer(query, entry_points, ef + len(self.deleted), 0)
+        return [(node, 1.0 - distance) for distance, node in found if node not in self.deleted][:k]
@@ -0,0 +1,159 @@
+"""Fields of the index records built from news and EDGAR events.
+
+`safe_deserialize` turns a line of the ingestion pipelines into an event,
+`event_metadata` keeps the fields of it listed in `METADATA_FIELDS` and
+`document_record` renders a chunk with that metadata as a record of the
+`bytewax-index`, with the typed fields the index filters on.
+"""
+import json
+import logging
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Optional
+
+from haystack import Document
+
+from local_search_index import format_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Event fields kept as metadata of every chunk of a document
+METADATA_FIELDS = ['title', 'form_type', 'symbol', 'symbols', 'url', 'created_at', 'updated_at']
+# Index page of a filing in the EDGAR feed, `...-index.htm`
+INDEX_PAGE = re.compile(r'-index\.html?$')
+
+
+def flatten_meta(meta):
+    """
+    Flatten a nested dictionary to a single-level dictionary.
+    
+    :param meta: Nested dictionary to flatten.
+    :return: Flattened dictionary.
+    """
+    def _flatten(d, parent_key=''):
+        items = []
+        for k, v in d.items():
+            new_key = f"{parent_key}_{k}" if parent_key else k
+            if isinstance(v, dict):
+                items.extend(_flatten(v, new_key).items())
+            else:
+                items.append((new_key, str(v) if not isinstance(v, (str, int, float, bool)) else v))
+        return dict(items)
+    
+    return _flatten(meta)
+
+
+def structured_fields(meta):
+    """
+    Extract the typed, filterable index fields from document metadata.
+    
+    :param meta: Metadata of a news article or a filing.
+    :return: Dictionary with symbols, form_type, source, url, created_at and updated_at.
+    """
+    symbols = meta.get('symbols') or []
+    if isinstance(symbols, str):
+        symbols = symbols.split(',')
+    symbol = meta.get('symbol')
+    if symbol:
+        symbols = list(symbols) + str(symbol).split(',')
+    symbols = list(dict.fromkeys(s.strip() for s in symbols if s and s.strip()))
+
+    url = meta.get('url') or meta.get('source_url')
+    source = meta.get('source')
+    if not source and url:
+        source = 'sec' if 'sec.gov' in url else 'benzinga' if 'benzinga.com' in url else None
+
+    return {
+        "symbols": symbols,
+        "form_type": meta.get('form_type'),
+        "source": source,
+        "url": url,
+        "created_at": format_timestamp(meta.get('created_at')),
+        "updated_at": format_timestamp(meta.get('updated_at') or meta.get('created_at')),
+    }
+
+
+def safe_deserialize(data):
+    """
+    Safely deserialize JSON data, handling various formats.
+    
+    :param data: JSON data to deserialize.
+    :return: Deserialized data or None if an error occurs.
+    """
+    try:
+        parsed_data = json.loads(data)
+        if isinstance(parsed_data, list):
+            if len(parsed_data) == 2 and (parsed_data[0] is None or isinstance(parsed_data[0], str)):
+                event = parsed_data[1]
+                # EDGAR filings are keyed by the ticker found for the filer
+                if parsed_data[0] not in (None, 'no_ticker', 'All') and isinstance(event, dict):
+                    event.setdefault('symbol', parsed_data[0])
+                # The Atom feed dates a filing by its `updated` entry, older
+                # archives carry no date and are dated when they are received
+                if isinstance(event, dict) and not event.get('created_at'):
+                    event['created_at'] = event.pop('updated', None) or format_timestamp(datetime.now(timezone.utc))
+            else:
+                logger.info(f"Skipping unexpected list format: {data}")
+                return None
+        elif isinstance(parsed_data, dict):
+            event = parsed_data
+        else:
+            logger.info(f"Skipping unexpected data type: {data}")
+            return None
+        
+        if 'link' in event:
+            event['url'] = event.pop('link')
+        
+        if "url" in event:
+            return event
+        else:
+            logger.info(f"Missing 'url' key in data: {data}")
+            return None
+
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error ({e}) for data: {data}")
+        return None
+    except Exception as e:
+        logger.error(f"Error processing data ({e}): {data}")
+        return None
+
+
+def source_url(event: Dict[str, Any]) -> Optional[str]:
+    """URL of the document of an event, the full text of a filing instead of its index page."""
+    url = event.get("url")
+    if url:
+        url = INDEX_PAGE.sub('.txt', url)
+    return url
+
+
+def event_metadata(event: Dict[str, Any], fields: Iterable[str] = METADATA_FIELDS) -> Dict[str, Any]:
+    """
+    Metadata of an event, the listed fields it has.
+    
+    :param event: A deserialized event.
+    :param fields: Names of the fields to keep.
+    :return: Dictionary with the fields present in the event.
+    """
+    return {field: event.get(field) for field in fields if field in event}
+
+
+def document_record(document: Document) -> Dict:
+    """
+    Convert a Haystack Document object to a record of the index.
+    """
+    # Ensure embedding is converted to a list, if it is a NumPy array
+    embedding = document.embedding
+    if embedding is not None and hasattr(embedding, 'tolist'):
+        embedding = embedding.tolist()
+    
+    flattened_meta = flatten_meta(document.meta)
+    
+    return {
+        "id": document.id,
+        "content": document.content,
+        "title": document.meta.get('title') or document.meta.get('headline'),
+        # Typed fields the index can filter on before ranking vectors
+        **structured_fields(document.meta),
+        "meta": json.dumps(flattened_meta),  # Remaining metadata, searchable as text
+        "vector": embedding
+    }
@@ -24,6 +24,7 @@ from azure.search.documents.indexes.models import (
 )  
 
 import os
+import requests
 from dotenv import load_dotenv  
 load_dotenv(override=True)
 
@@ -52,6 +53,14 @@ fields = [
     # SearchField(name="chunk_id", type=SearchFieldDataType.String, searchable= True,filterable=True,retrievable=True,sortable=True,facetable=True,key=True,analyzer_name="keyword"),  
     SearchField(name="id",type=SearchFieldDataType.String, searchable= True,filterable=True,retrievable=True,sortable=True,facetable=True,key=True), 
     SearchField(name="content", type=SearchFieldDataType.String, searchable= True,filterable=False,retrievable=True,sortable=False,facetable=False,key=False),  
+    SearchField(name="title", type=SearchFieldDataType.String, searchable= True,filterable=False,retrievable=True,sortable=False,facetable=False,key=False),  
+    # Typed fields so queries can pre-filter by symbol, form type, source and time
+    SearchField(name="symbols", type=SearchFieldDataType.Collection(SearchFieldDataType.String), searchable= True,filterable=True,retrievable=True,sortable=False,facetable=True,key=False),  
+    SearchField(name="form_type", type=SearchFieldDataType.String, searchable= False,filterable=True,retrievable=True,sortable=False,facetable=True,key=False),  
+    SearchField(name="source", type=SearchFieldDataType.String, searchable= False,filterable=True,retrievable=True,sortable=False,facetable=True,key=False),  
+    SearchField(name="url", type=SearchFieldDataType.String, searchable= False,filterable=True,retrievable=True,sortable=False,facetable=False,key=False),  
+    SearchField(name="created_at", type=SearchFieldDataType.DateTimeOffset, searchable= False,filterable=True,retrievable=True,sortable=True,facetable=False,key=False),  
+    SearchField(name="updated_at", type=SearchFieldDataType.DateTimeOffset, searchable= False,filterable=True,retrievable=True,sortable=True,facetable=False,key=False),  
     SearchField(name="meta", type=SearchFieldDataType.String,searchable= True,filterable=False,retrievable=True,sortable=False,facetable=False,key=False),    
     SearchField(name="vector", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), searchable=True,filterable=False,retrievable=True,sortable=False,vector_search_dimensions=1536, vector_search_profile="myHnswProfile")
 ] 
@@ -105,7 +114,7 @@ vector_search = VectorSearch(
 semantic_config = SemanticConfiguration(
     name="my-semantic-config",
     prioritized_fields=PrioritizedFields(
-        title_field=SemanticField(field_name="meta"),
+        title_field=SemanticField(field_name="title"),
         # prioritized_keywords_fields=[SemanticField(field_name="Category")],
         # prioritized_content_fields=[SemanticField(field_name="chunk")]
     )
@@ -120,4 +129,47 @@ index = SearchIndex(name="bytewax-index", fields=fields, vector_search=vector_se
 result = index_client.create_or_update_index(index)  
 # print(f"{result.name} created")
 
+# Quantize the stored vectors: "scalar" (int8) or "binary", empty keeps float32
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "")
+
+def enable_vector_compression(kind, index_name="bytewax-index", oversampling=4):
+    """
+    Add a quantization compression to every vector profile of the index.
+    The pinned azure-search-documents wheel predates vector compression, so the
+    definition is updated through the REST API. Candidates are ranked on the
+    quantized vectors and re-scored with the original ones.
+    """
+    url = f"{endpoint}/indexes/{index_name}?api-version=2024-07-01"
+    headers = {'Content-Type': 'application/json', 'api-key': key}
+    definition = requests.get(url, headers=headers).json()
+    definition.pop("@odata.context", None)
+    definition.pop("@odata.etag", None)
+
+    if kind == "scalar":
+        compression = {
+            "name": "myScalarQuantization",
+            "kind": "scalarQuantization",
+            "scalarQuantizationParameters": {"quantizedDataType": "int8"},
+        }
+    elif kind == "binary":
+        compression = {"name": "myBinaryQuantization", "kind": "binaryQuantization"}
+    else:
+        raise ValueError(f"Unknown vector compression: {kind}")
+    compression.update({"rerankWithOriginalVectors": True, "defaultOversampling": oversampling})
+
+    vector_search_definition = definition["vectorSearch"]
+    vector_search_definition["compressions"] = [compression]
+    for profile in vector_search_definition["profiles"]:
+        profile["compression"] = compression["name"]
+    for vectorizer in vector_search_definition.get("vectorizers", []):
+        parameters = vectorizer.get("azureOpenAIParameters") or {}
+        parameters.setdefault("modelName", "text-embedding-ada-002")
+
+    response = requests.put(url, headers=headers, json=definition)
+    response.raise_for_status()
+    print(f"Enabled {kind} quantization on {index_name}")
+
+if VECTOR_COMPRESSION:
+    enable_vector_compression(VECTOR_COMPRESSION)
+
 print(f"Creating bytewax-index search index")
\ No newline at end of file
@@ -1,28 +1,60 @@
+import os
+from datetime import timedelta
+
 from bytewax import operators as op
 from bytewax.dataflow import Dataflow
 from bytewax import operators as op
 from bytewax.testing import run_main
 from bytewax.connectors.kafka import KafkaSource
-from custom_connectors import SimulationSource
+from custom_connectors import SimulationSource, TickSource, AzureSearchSink
 from rag_custom_pipeline import safe_deserialize, JSONLReader
+from source_scheduler import SourcePolicy, SourceScheduler, tag_source
+from filing_router import METADATA, FilingRouter
+from rag_common.step_profiler import profile_components, profiled
+from rag_common.retry_queue import RetryQueue, RetrySource
 
-jsonl_reader = JSONLReader(metadata_fields=['title',
-                                             'form_type',
-                                             'symbol',
-                                               'url'])
-
-def process_event_edgar(event):
-    pass
-
-def process_event_news(event):
-    pass
+jsonl_reader = JSONLReader()
+# Opt-in per-step profiles, see rag_common/step_profiler.py. Steps run on the scheduler
+# threads, so they are profiled by source
+profile_components(jsonl_reader.pipeline, prefix="index")
 
 def process_event(event):
     """Wrapper to handle the processing of each event."""
     if event:
-        dict_document = jsonl_reader.run(event)
-        return dict_document
-    return None
+        return jsonl_reader.run(event)
+    return []
+
+
+def process_filing(event, route):
+    """Index a filing the way its route says."""
+    if route.action == METADATA:
+        return jsonl_reader.index_metadata(event)
+    return jsonl_reader.run(event, max_pages=route.max_pages, strategy=route.strategy)
+
+
+# Filings are routed by form type: annual and current reports are parsed in
+# full, prospectus supplements and fund documents only their first pages,
+# NPORT-P and ownership reports are indexed by their metadata. Set
+# FILING_ROUTES to a JSON file to change the table
+filing_routes = os.environ.get("FILING_ROUTES")
+router = FilingRouter.from_file(filing_routes) if filing_routes else FilingRouter()
+
+# Headlines are short and must be searchable within seconds, filings can
+# take a while to fetch, parse and embed and are fine within minutes. A free
+# thread takes the event with the earliest deadline, so headlines overtake
+# queued filings, and every filing route has its own concurrency budget
+policies = {
+    "news": SourcePolicy(handler=profiled("news", process_event), max_concurrency=4, latency_target=5.0),
+    **router.policies(profiled("edgar", process_filing)),
+}
+
+# A failed event frees its thread at once and is submitted to its source
+# again after a growing delay, events failing five times go to the
+# dead-letter file
+retries = RetryQueue(dead_letter_path="data/dead_letter.jsonl")
+for source, policy in policies.items():
+    policy.handler = retries.guard(policy.handler, key=source)
+scheduler = SourceScheduler(policies, workers=4, report_interval=60.0)
 
 flow = Dataflow("rag-pipeline")
 # edgar_k_input = op.input("input", flow, KafkaSource())
@@ -31,11 +63,20 @@ edgar_input = op.input("edgar_inp", flow, SimulationSource("data/sec_filings_202
 # news__k_input = op.input("input", flow, KafkaSource())
 news_input = op.input("news_inp", flow, SimulationSource("data/news_20240529.jsonl"))
 
-edgar_deser = op.map("deserialize", edgar_input, safe_deserialize)
-edgar_dicts = op.map("extract_html", edgar_deser, process_event_edgar)
+edgar_deser = op.map("edgar_deserialize", edgar_input, profiled("edgar_deserialize", safe_deserialize))
+edgar_events = op.flat_map("edgar_route", edgar_deser, router.tag)
+
+news_deser = op.map("news_deserialize", news_input, profiled("news_deserialize", safe_deserialize))
+news_events = op.map("news_tag", news_deser, tag_source("news"))
+
+# Ticks emit the output of work finished while no events arrive
+ticks = op.input("ticks", flow, TickSource(timedelta(milliseconds=200)))
+tick_events = op.map("tick_tag", ticks, lambda _: (None, None))
 
-news_deser = op.map("deserialize", news_input, safe_deserialize)
-news_dicts = op.map("extract_html", news_deser, process_event_news)
+retry_events = op.map("retry_tag", op.input("retries", flow, RetrySource(retries)), RetryQueue.tag)
 
-merged_stream = op.merge("merge", news_dicts, edgar_dicts)
-op.inspect("out", merged_stream)
+merged_stream = op.merge("merge", news_events, edgar_events, retry_events, tick_events)
+# Events are done for bytewax once submitted, so a crash loses the queued and
+# running ones: at most once delivery, see source_scheduler.py
+dictionaries = op.flat_map("schedule", merged_stream, scheduler.step)
+op.output("output", dictionaries, AzureSearchSink())
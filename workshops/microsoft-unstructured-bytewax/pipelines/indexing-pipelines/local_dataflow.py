@@ -4,26 +4,34 @@ from bytewax import operators as op
 from bytewax.connectors.stdio import StdOutSink
 from custom_connectors import SimulationSource, AzureSearchSink
 from rag_custom_pipeline import safe_deserialize, JSONLReader
+from rag_common.step_profiler import profile_components, profiled
+from rag_common.retry_queue import RetryQueue, RetrySource
 
 
 
-jsonl_reader = JSONLReader(metadata_fields=['title', \
-                                            'form_type', \
-                                            'symbol',
-                                            'url'])
+jsonl_reader = JSONLReader()
+# Opt-in per-step profiles, see rag_common/step_profiler.py
+profile_components(jsonl_reader.pipeline, prefix="build_indeces")
 
 
 def process_event(event):
     """Wrapper to handle the processing of each event."""
     if event:
-        dict_document = jsonl_reader.run(event)
-        return dict_document
-    return None
+        return jsonl_reader.run(event)
+    return []
 
 
+# Events whose fetch, parse or embedding fails are retried with a growing
+# delay while the next ones are processed, and written to the dead-letter
+# file after the last attempt. The retries end two minutes after the last
+# event so the dataflow can finish
+retries = RetryQueue(dead_letter_path="data/dead_letter.jsonl", idle_timeout=120.0)
+
 flow = Dataflow("rag-pipeline")
 input_data = op.input("input", flow, SimulationSource("data/test.jsonl", batch_size=1))
-deserialize_data = op.map("deserialize", input_data, safe_deserialize)
-extract_html = op.filter_map("build_indeces", deserialize_data, process_event)
+deserialize_data = op.map("deserialize", input_data, profiled("deserialize", safe_deserialize))
+retried = op.input("retries", flow, RetrySource(retries))
+events = op.merge("with_retries", deserialize_data, retried)
+extract_html = op.flat_map("build_indeces", events, retries.guard(profiled("build_indeces", process_event)))
 op.output("output", extract_html, AzureSearchSink())
 
@@ -0,0 +1,515 @@
+"""Local stand-in for the `bytewax-index` Azure AI Search index.
+
+Documents carry typed, filterable fields (`symbols`, `form_type`, `source`,
+`created_at`, `updated_at`) next to the content and vector, see
+`index_fields.document_record`. Filters are pushed into the
+vector query so only the matching slice of the index is ranked.
+
+`LocalSearchIndex` implements the subset of `azure.search.documents.SearchClient`
+used by this workshop, so the indexing sink and the retrieval helpers can be
+run and tested offline against it.
+"""
+import re
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+from hnsw import HnswIndex
+
+def parse_timestamp(value: Union[str, datetime, None]) -> Optional[datetime]:
+    """Parse an ISO 8601 timestamp such as `2024-05-29T13:26:51Z`."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def format_timestamp(value: Union[str, datetime, None]) -> Optional[str]:
+    """Format a timestamp the way Azure AI Search expects `Edm.DateTimeOffset` values."""
+    parsed = parse_timestamp(value)
+    if parsed is None:
+        return None
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _quote(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+@dataclass
+class SearchFilter:
+    """Filter on the typed fields of the index, rendered as OData for Azure."""
+
+    symbols: Sequence[str] = ()
+    form_types: Sequence[str] = ()
+    sources: Sequence[str] = ()
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    time_field: str = "updated_at"
+
+    def __bool__(self) -> bool:
+        return bool(self.symbols or self.form_types or self.sources or self.since or self.until)
+
+    def to_odata(self) -> Optional[str]:
+        """Render the filter as an OData `$filter` expression, None if empty."""
+        clauses = []
+        if self.symbols:
+            clauses.append(f"symbols/any(s: search.in(s, {_quote(','.join(self.symbols))}, ','))")
+        if self.form_types:
+            clauses.append(f"search.in(form_type, {_quote(','.join(self.form_types))}, ',')")
+        if self.sources:
+            clauses.append(f"search.in(source, {_quote(','.join(self.sources))}, ',')")
+        if self.since:
+            clauses.append(f"{self.time_field} ge {format_timestamp(self.since)}")
+        if self.until:
+            clauses.append(f"{self.time_field} lt {format_timestamp(self.until)}")
+        return " and ".join(clauses) or None
+
+    _CLAUSE = re.compile(
+        r"symbols/any\(s: search\.in\(s, '(?P<symbols>[^']*)', ','\)\)"
+        r"|search\.in\((?P<field>form_type|source), '(?P<values>[^']*)', ','\)"
+        r"|(?P<time_field>created_at|updated_at) (?P<op>ge|lt) (?P<ts>\S+)"
+    )
+
+    @classmethod
+    def from_odata(cls, expression: Optional[str]) -> "SearchFilter":
+        """Parse an expression produced by `to_odata`."""
+        search_filter = cls()
+        if not expression:
+            return search_filter
+        for clause in expression.split(" and "):
+            match = cls._CLAUSE.fullmatch(clause.strip())
+            if match is None:
+                raise ValueError(f"Unsupported filter clause: {clause}")
+            if match["symbols"] is not None:
+                search_filter.symbols = match["symbols"].split(",")
+            elif match["field"] == "form_type":
+                search_filter.form_types = match["values"].split(",")
+            elif match["field"] == "source":
+                search_filter.sources = match["values"].split(",")
+            else:
+                search_filter.time_field = match["time_field"]
+                if match["op"] == "ge":
+                    search_filter.since = parse_timestamp(match["ts"])
+                else:
+                    search_filter.until = parse_timestamp(match["ts"])
+        return search_filter
+
+
+@dataclass
+class VectorQuery:
+    """Local equivalent of `azure.search.documents.models.VectorizedQuery`."""
+
+    vector: List[float]
+    k_nearest_neighbors: int = 3
+    fields: str = "vector"
+    exhaustive: bool = False
+
+
+# Number of set bits of every byte value, for hamming distances of binary codes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+VECTOR_STORAGES = ("float32", "int8", "binary")
+ALGORITHMS = ("exhaustive", "hnsw")
+DEFAULT_HNSW_PARAMETERS = {"m": 4, "ef_construction": 400, "ef_search": 500}
+
+
+class LocalSearchIndex:
+    """
+    In-memory vector index with typed filterable fields.
+
+    With `vector_storage="int8"` or `"binary"` the candidates are ranked on
+    quantized codes (4x and 32x smaller than float32) and the best
+    `rescore_multiplier * top` of them are re-scored with the full precision
+    vectors. Pass `full_precision_path` to keep those vectors in a memory
+    mapped file, so only the quantized codes stay resident.
+
+    Only vector queries are supported, there is no full text search. Documents
+    without a vector can be filtered and fetched but are never returned by a
+    vector query.
+
+    With `algorithm="hnsw"` unfiltered queries walk an HNSW graph like the
+    `myHnsw` profile of the Azure index. The graph keeps its own float32 copy
+    of the vectors. Filtered and `exhaustive` queries still rank every
+    matching row.
+    """
+
+    def __init__(
+        self,
+        dimensions: int = 1536,
+        key: str = "id",
+        vector_field: str = "vector",
+        vector_storage: str = "float32",
+        rescore_multiplier: int = 4,
+        full_precision_path: Optional[str] = None,
+        algorithm: str = "exhaustive",
+        hnsw_parameters: Optional[Dict[str, int]] = None,
+    ):
+        """
+        :param dimensions: Dimensions of the vectors.
+        :param key: Name of the key field of the documents.
+        :param vector_field: Name of the vector field of the documents.
+        :param vector_storage: `float32`, `int8` (scalar quantization) or
+            `binary` (one bit per dimension).
+        :param rescore_multiplier: How many candidates per requested result
+            are re-scored at full precision when the storage is quantized.
+        :param full_precision_path: File backing the full precision vectors,
+            kept in memory if None.
+        :param algorithm: `exhaustive` or `hnsw`.
+        :param hnsw_parameters: `m`, `ef_construction` and `ef_search` of the
+            HNSW graph, defaults to the values of `init_azure_index.py`.
+            `ef_search` can be changed on a built index.
+        """
+        if vector_storage not in VECTOR_STORAGES:
+            raise ValueError(f"vector_storage must be one of {VECTOR_STORAGES}")
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"algorithm must be one of {ALGORITHMS}")
+        self.dimensions = dimensions
+        self.key = key
+        self.vector_field = vector_field
+        self.vector_storage = vector_storage
+        self.rescore_multiplier = rescore_multiplier
+        self.full_precision_path = full_precision_path
+        self.algorithm = algorithm
+        self.hnsw_parameters = {**DEFAULT_HNSW_PARAMETERS, **(hnsw_parameters or {})}
+        self._graph = HnswIndex(dimensions, **self.hnsw_parameters) if algorithm == "hnsw" else None
+        # Graph node of each row and row of each node
+        self._row_nodes: Dict[int, int] = {}
+        self._node_rows: List[int] = []
+        self._documents: List[Optional[Dict[str, Any]]] = []
+        self._rows: Dict[str, int] = {}
+        self._free: List[int] = []
+        if full_precision_path:
+            open(full_precision_path, "wb").close()
+        self._vectors = self._allocate_full_precision(0)
+        self._codes = self._allocate_codes(0)
+        self._scales = np.zeros(0, dtype=np.float32)
+        # Rows without a vector, e.g. linked near duplicates and metadata
+        # only filings, are filterable but never ranked
+        self._has_vector = np.zeros(0, dtype=bool)
+        self._timestamps = {name: np.zeros(0, dtype=np.float64) for name in ("created_at", "updated_at")}
+        # Postings of the collection and string fields used to pre-filter rows
+        self._postings: Dict[str, Dict[str, set]] = {"symbols": {}, "form_type": {}, "source": {}}
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _allocate_full_precision(self, capacity: int) -> np.ndarray:
+        if not self.full_precision_path:
+            return np.zeros((capacity, self.dimensions), dtype=np.float32)
+        with open(self.full_precision_path, "r+b") as file:
+            file.truncate(max(capacity, 1) * self.dimensions * 4)
+        return np.memmap(self.full_precision_path, dtype=np.float32, mode="r+",
+                         shape=(max(capacity, 1), self.dimensions))[:capacity]
+
+    def _allocate_codes(self, capacity: int) -> np.ndarray:
+        if self.vector_storage == "int8":
+            return np.zeros((capacity, self.dimensions), dtype=np.int8)
+        if self.vector_storage == "binary":
+            return np.zeros((capacity, (self.dimensions + 7) // 8), dtype=np.uint8)
+        return np.zeros((capacity, 0), dtype=np.uint8)
+
+    def _grow(self, rows: int) -> None:
+        capacity = len(self._vectors)
+        if rows <= capacity:
+            return
+        new_capacity = max(rows, capacity * 2, 16)
+        if self.full_precision_path:
+            # The file keeps the existing rows, only the mapping is enlarged
+            self._vectors = self._allocate_full_precision(new_capacity)
+        else:
+            vectors = self._allocate_full_precision(new_capacity)
+            vectors[:capacity] = self._vectors
+            self._vectors = vectors
+        codes = self._allocate_codes(new_capacity)
+        codes[:capacity] = self._codes
+        self._codes = codes
+        scales = np.zeros(new_capacity, dtype=np.float32)
+        scales[:capacity] = self._scales
+        self._scales = scales
+        has_vector = np.zeros(new_capacity, dtype=bool)
+        has_vector[:capacity] = self._has_vector
+        self._has_vector = has_vector
+        for name, values in self._timestamps.items():
+            grown = np.full(new_capacity, np.nan)
+            grown[:capacity] = values
+            self._timestamps[name] = grown
+
+    def _field_values(self, name: str, document: Dict[str, Any]) -> List[str]:
+        value = document.get(name)
+        if value is None:
+            return []
+        return [str(v) for v in value] if isinstance(value, (list, tuple)) else [str(value)]
+
+    def _unindex(self, row: int) -> None:
+        document = self._documents[row]
+        for name, postings in self._postings.items():
+            for value in self._field_values(name, document):
+                rows = postings.get(value)
+                if rows is not None:
+                    rows.discard(row)
+
+    def _link(self, row: int, vector: Optional[np.ndarray]) -> None:
+        node = self._row_nodes.get(row)
+        if node is not None:
+            # Re-uploading an unchanged chunk keeps its node
+            if vector is not None and np.array_equal(self._vectors[row], vector):
+                return
+            self._graph.remove(node)
+            del self._row_nodes[row]
+        if vector is not None:
+            self._row_nodes[row] = self._graph.add(vector)
+            self._node_rows.append(row)
+
+    def _store_vector(self, row: int, vector: Optional[Sequence[float]]) -> None:
+        if vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            # A zero vector has no direction to rank by
+            vector = vector / norm if norm else None
+        if self._graph is not None:
+            self._link(row, vector)
+        self._has_vector[row] = vector is not None
+        if vector is None:
+            vector = np.zeros(self.dimensions, dtype=np.float32)
+        self._vectors[row] = vector
+        if self.vector_storage == "int8":
+            # Symmetric scalar quantization with one scale per vector
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            self._codes[row] = np.round(vector / scale).astype(np.int8)
+            self._scales[row] = scale
+        elif self.vector_storage == "binary":
+            self._codes[row] = np.packbits(vector > 0)
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Bytes used by the vectors, resident in memory or mapped from disk."""
+        full_precision = self._vectors.nbytes
+        return {
+            "quantized_codes": self._codes.nbytes + (self._scales.nbytes if self.vector_storage == "int8" else 0),
+            "full_precision_resident": 0 if self.full_precision_path else full_precision,
+            "full_precision_on_disk": full_precision if self.full_precision_path else 0,
+        }
+
+    def _index(self, row: int, document: Dict[str, Any], vector: Optional[Sequence[float]]) -> None:
+        for name, postings in self._postings.items():
+            for value in self._field_values(name, document):
+                postings.setdefault(value, set()).add(row)
+        for name, values in self._timestamps.items():
+            parsed = parse_timestamp(document.get(name))
+            values[row] = parsed.timestamp() if parsed else np.nan
+        self._store_vector(row, vector)
+
+    def upload_documents(self, documents: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert or replace documents by key."""
+        results = []
+        with self._lock:
+            for document in documents:
+                document = {k: v for k, v in document.items() if not k.startswith("@search.")}
+                # The vector only lives in the matrix, not as a list of floats
+                vector = document.pop(self.vector_field, None)
+                key = str(document[self.key])
+                row = self._rows.get(key)
+                if row is None:
+                    row = self._free.pop() if self._free else len(self._documents)
+                    if row == len(self._documents):
+                        self._documents.append(None)
+                        self._grow(len(self._documents))
+                    self._rows[key] = row
+                else:
+                    self._unindex(row)
+                self._documents[row] = document
+                self._index(row, document, vector)
+                results.append({"key": key, "succeeded": True, "status_code": 200})
+        return results
+
+    def merge_or_upload_documents(self, documents: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Update the given fields of existing documents, insert new ones."""
+        merged = []
+        with self._lock:
+            for document in documents:
+                row = self._rows.get(str(document[self.key]))
+                existing = {}
+                if row is not None:
+                    existing = dict(self._documents[row])
+                    if self._has_vector[row]:
+                        existing[self.vector_field] = np.array(self._vectors[row])
+                merged.append({**existing, **document})
+            return self.upload_documents(merged)
+
+    def delete_documents(self, documents: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        results = []
+        with self._lock:
+            for document in documents:
+                key = str(document[self.key])
+                row = self._rows.pop(key, None)
+                if row is not None:
+                    self._unindex(row)
+                    self._documents[row] = None
+                    self._store_vector(row, None)
+                    self._free.append(row)
+                results.append({"key": key, "succeeded": row is not None, "status_code": 200 if row is not None else 404})
+        return results
+
+    def get_document(self, key: str, selected_fields: Optional[List[str]] = None) -> Dict[str, Any]:
+        with self._lock:
+            row = self._rows.get(str(key))
+            if row is None:
+                raise KeyError(key)
+            return self._select(self._documents[row], selected_fields)
+
+    def _select(self, document: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+        if not fields:
+            return dict(document)
+        return {name: document.get(name) for name in fields}
+
+    def candidate_rows(self, search_filter: Optional[SearchFilter]) -> np.ndarray:
+        """Rows that match a filter, the only rows a filtered query ranks."""
+        with self._lock:
+            live = np.fromiter(self._rows.values(), dtype=np.int64, count=len(self._rows))
+            if not search_filter:
+                return np.sort(live)
+            rows = set(self._rows.values())
+            for name, values in (("symbols", search_filter.symbols),
+                                 ("form_type", search_filter.form_types),
+                                 ("source", search_filter.sources)):
+                if values:
+                    matching = set()
+                    for value in values:
+                        matching |= self._postings[name].get(value, set())
+                    rows &= matching
+            candidates = np.fromiter(rows, dtype=np.int64, count=len(rows))
+            if search_filter.since or search_filter.until:
+                timestamps = self._timestamps[search_filter.time_field][candidates]
+                mask = ~np.isnan(timestamps)
+                if search_filter.since:
+                    mask &= timestamps >= parse_timestamp(search_filter.since).timestamp()
+                if search_filter.until:
+                    mask &= timestamps < parse_timestamp(search_filter.until).timestamp()
+                candidates = candidates[mask]
+            return np.sort(candidates)
+
+    def _score(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        return self._vectors[rows] @ query
+
+    def _approximate_score(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        if self.vector_storage == "int8":
+            return (self._codes[rows].astype(np.float32) @ query) * self._scales[rows]
+        # Fewer differing sign bits means a smaller angle
+        query_bits = np.packbits(query > 0)
+        distances = _POPCOUNT[np.bitwise_xor(self._codes[rows], query_bits)].sum(axis=1)
+        return -distances.astype(np.float32)
+
+    def _rank(self, query: np.ndarray, rows: np.ndarray, top: int, exhaustive: bool):
+        """Positions in `rows` of the best `top` matches and their exact scores."""
+        if self.vector_storage == "float32" or exhaustive:
+            scores = self._score(query, rows)
+            best = np.argpartition(-scores, min(top, len(rows)) - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+            return best, scores[best]
+        candidates = min(len(rows), top * self.rescore_multiplier)
+        approximate = self._approximate_score(query, rows)
+        positions = np.argpartition(-approximate, candidates - 1)[:candidates]
+        scores = self._score(query, rows[positions])
+        best = np.argsort(-scores)[:top]
+        return positions[best], scores[best]
+
+    def search(
+        self,
+        search_text: Optional[str] = None,
+        vector_queries: Optional[List[Any]] = None,
+        filter: Union[str, SearchFilter, None] = None,
+        select: Optional[List[str]] = None,
+        top: Optional[int] = None,
+        **kwargs,
+    ) -> List[Dict[str, Any]]:
+        """
+        Rank the documents that match `filter` by cosine similarity.
+        Filters are always applied before ranking, like `vector_filter_mode="preFilter"`.
+        An `exhaustive` query skips the quantized codes and scores every
+        candidate at full precision.
+
+        :param search_text: Not supported, a query text raises `ValueError`.
+        :param vector_queries: One query with `vector` and `k_nearest_neighbors`.
+        :param filter: OData expression from `SearchFilter.to_odata` or a `SearchFilter`.
+        :param select: Fields to return.
+        :param top: Number of results, defaults to the query's `k_nearest_neighbors`.
+        :return: Documents with their `@search.score`, best first.
+        """
+        if search_text:
+            raise ValueError("LocalSearchIndex only supports vector queries, search_text must be None")
+        if not vector_queries:
+            raise ValueError("A vector query is required")
+        search_filter = filter if isinstance(filter, SearchFilter) else SearchFilter.from_odata(filter)
+        vector_query = vector_queries[0]
+        top = top or vector_query.k_nearest_neighbors
+
+        query = np.asarray(vector_query.vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+
+        exhaustive = getattr(vector_query, "exhaustive", False)
+        with self._lock:
+            if self._graph is not None and not exhaustive and not search_filter:
+                hits = self._graph.search(query, top, self.hnsw_parameters["ef_search"])
+                rows = np.array([self._node_rows[node] for node, _ in hits], dtype=np.int64)
+                positions, scores = np.arange(len(hits)), [score for _, score in hits]
+            else:
+                rows = self.candidate_rows(search_filter)
+                rows = rows[self._has_vector[rows]]
+                if not len(rows):
+                    return []
+                positions, scores = self._rank(query, rows, top, exhaustive)
+            results = []
+            for position, score in zip(positions, scores):
+                result = self._select(self._documents[rows[position]], select)
+                result["@search.score"] = float(score)
+                results.append(result)
+        return results
+
+
+def vector_search(
+    search_client: Any,
+    query_embedding: List[float],
+    top: int = 3,
+    symbols: Sequence[str] = (),
+    form_types: Sequence[str] = (),
+    sources: Sequence[str] = (),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    select: Optional[List[str]] = None,
+    exhaustive: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Vector search restricted to documents matching symbol, form type, source
+    and time filters. The filters are applied before the vector ranking.
+
+    :param search_client: An Azure `SearchClient` or a `LocalSearchIndex`.
+    :param query_embedding: Embedding of the query.
+    :param top: Number of results.
+    :return: The matching documents, best first.
+    """
+    search_filter = SearchFilter(symbols=symbols, form_types=form_types, sources=sources,
+                                 since=since, until=until)
+    select = select or ["id", "content", "symbols", "form_type", "source", "url", "updated_at"]
+    if isinstance(search_client, LocalSearchIndex):
+        query = VectorQuery(vector=query_embedding, k_nearest_neighbors=top, exhaustive=exhaustive)
+        return search_client.search(vector_queries=[query], filter=search_filter, select=select, top=top)
+
+    from azure.search.documents.models import VectorizedQuery
+
+    query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=top, fields="vector",
+                            exhaustive=exhaustive)
+    return list(search_client.search(
+        search_text=None,
+        vector_queries=[query],
+        filter=search_filter.to_odata(),
+        vector_filter_mode="preFilter",
+        select=select,
+        top=top,
+    ))
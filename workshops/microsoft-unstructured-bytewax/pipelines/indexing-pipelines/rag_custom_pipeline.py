@@ -1,11 +1,15 @@
 from haystack import Pipeline
 from haystack.components.embedders import AzureOpenAIDocumentEmbedder
-from haystack.components.preprocessors import DocumentCleaner
 from pathlib import Path
 from haystack.utils import Secret
 
 
-from unstructured_component import UnstructuredParser
+from unstructured_component import UnstructuredParser, chunk_id
+from rag_common.sec_client import LIVE
+from rag_common.token_chunker import TokenChunker
+from rag_common.text_cleaner import DocumentTextCleaner
+from index_fields import METADATA_FIELDS, document_record, event_metadata, safe_deserialize, source_url
+from rag_common.near_duplicates import CanonicalEmbeddings, NearDuplicateFilter
 import logging
 import requests
 from haystack import component, Document
@@ -33,91 +37,59 @@ search_api_key = os.getenv("AZURE_SEARCH_ADMIN_KEY")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def flatten_meta(meta):
+@component
+class DocumentRateLimiter:
     """
-    Flatten a nested dictionary to a single-level dictionary.
-    
-    :param meta: Nested dictionary to flatten.
-    :return: Flattened dictionary.
+    Pass documents through once `rate_limiter` granted a token for each of
+    them, e.g. in front of an embedder so the chunks sent to the embedding
+    API stay within a budget whatever the size of the source documents.
     """
-    def _flatten(d, parent_key=''):
-        items = []
-        for k, v in d.items():
-            new_key = f"{parent_key}_{k}" if parent_key else k
-            if isinstance(v, dict):
-                items.extend(_flatten(v, new_key).items())
-            else:
-                items.append((new_key, str(v) if not isinstance(v, (str, int, float, bool)) else v))
-        return dict(items)
-    
-    return _flatten(meta)
-
 
-def safe_deserialize(data):
-    """
-    Safely deserialize JSON data, handling various formats.
-    
-    :param data: JSON data to deserialize.
-    :return: Deserialized data or None if an error occurs.
-    """
-    try:
-        parsed_data = json.loads(data)
-        if isinstance(parsed_data, list):
-            if len(parsed_data) == 2 and (parsed_data[0] is None or isinstance(parsed_data[0], str)):
-                event = parsed_data[1]
-            else:
-                logger.info(f"Skipping unexpected list format: {data}")
-                return None
-        elif isinstance(parsed_data, dict):
-            event = parsed_data
-        else:
-            logger.info(f"Skipping unexpected data type: {data}")
-            return None
-        
-        if 'link' in event:
-            event['url'] = event.pop('link')
-        
-        if "url" in event:
-            return event
-        else:
-            logger.info(f"Missing 'url' key in data: {data}")
-            return None
+    def __init__(self, rate_limiter: Any, priority: int = LIVE):
+        """
+        :param rate_limiter: Any object with an `acquire(priority)` method,
+            e.g. a `TokenBucket` of documents per second.
+        :param priority: Priority passed to `acquire`.
+        """
+        self.rate_limiter = rate_limiter
+        self.priority = priority
 
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error ({e}) for data: {data}")
-        return None
-    except Exception as e:
-        logger.error(f"Error processing data ({e}): {data}")
-        return None
+    @component.output_types(documents=List[Document])
+    def run(self, documents: List[Document]):
+        for _ in documents:
+            self.rate_limiter.acquire(self.priority)
+        return {"documents": documents}
 
 
 class JSONLReader:
-    def __init__(self, metadata_fields=None):
+    def __init__(self, metadata_fields=None, priority=LIVE, rate_limiter=None):
         """
         Initialize the JSONLReader with optional metadata fields and a link keyword.
         
-        :param metadata_fields: List of fields in the JSONL to retain as metadata.
+        :param metadata_fields: List of fields in the JSONL to retain as metadata, `METADATA_FIELDS` if None.
+        :param priority: Priority of the filing downloads in the sec.gov rate limit, `LIVE` or `BACKFILL`.
+        :param rate_limiter: Optional limiter, any object with an `acquire(priority)` method,
+            taken once per chunk sent to the embedder.
         """
-        self.metadata_fields = metadata_fields or []
+        self.metadata_fields = METADATA_FIELDS if metadata_fields is None else metadata_fields
         
         unstructured_parser = UnstructuredParser(unstructured_key=unstructured_api_key,
                                           chunking_strategy="by_page",
                                           strategy="auto",
-                                          model="yolox")
-        regex_pattern = (
-            r'<.*?>'  # HTML tags
-            r'|\t'  # Tabs
-            r'|\n+'  # Newlines
-            r'|&nbsp;'  # Non-breaking spaces
-            r'|[^a-zA-Z0-9\s]'  # Any non-alphanumeric character (excluding whitespace)
-        )
-        document_cleaner = DocumentCleaner(
-                            remove_empty_lines=True,
-                            remove_extra_whitespaces=True,
-                            remove_repeated_substrings=False,
-                            remove_substrings=None,  
-                            remove_regex=regex_pattern
-                        )
+                                          model="yolox",
+                                          priority=priority)
+        # Pages of a filing can be far over the embedding token limit, or a
+        # few words each, so they are re-packed into token budgeted chunks
+        token_chunker = TokenChunker(max_tokens=512, overlap_tokens=64)
+        # Strips tags, entities and whitespace, and any non-alphanumeric character
+        document_cleaner = DocumentTextCleaner(noise_patterns=[r'[^a-zA-Z0-9\s]'])
+        # Near duplicates of recent chunks are linked to them instead of
+        # embedded, keyed by the id the canonical chunk is indexed under, and
+        # get the vector of that chunk after the embedder
+        canonical_key = lambda document: chunk_id(document.meta.get('source_url'), document.meta.get('split_id', 0),
+                                                  document.content)
+        near_duplicate_filter = NearDuplicateFilter(key=canonical_key)
+        canonical_embeddings = CanonicalEmbeddings(key=canonical_key)
 
         document_embedder = AzureOpenAIDocumentEmbedder(azure_endpoint=AZURE_OPENAI_ENDPOINT,
                                                                 api_key=Secret.from_token(AZURE_OPENAI_KEY),
@@ -129,71 +101,91 @@ class JSONLReader:
 
         # Add components
         self.pipeline.add_component("unstructured", unstructured_parser)
+        self.pipeline.add_component("chunker", token_chunker)
         self.pipeline.add_component("cleaner", document_cleaner)
+        self.pipeline.add_component("dedup", near_duplicate_filter)
         self.pipeline.add_component("embedder", document_embedder)
+        self.pipeline.add_component("canonical", canonical_embeddings)
 
         # Connect components
-        self.pipeline.connect("unstructured", "cleaner")
-        self.pipeline.connect("cleaner", "embedder")
+        self.pipeline.connect("unstructured", "chunker")
+        self.pipeline.connect("chunker", "cleaner")
+        self.pipeline.connect("cleaner", "dedup")
+        if rate_limiter is not None:
+            self.pipeline.add_component("rate_limiter", DocumentRateLimiter(rate_limiter, priority))
+            self.pipeline.connect("dedup.documents", "rate_limiter")
+            self.pipeline.connect("rate_limiter", "embedder")
+        else:
+            self.pipeline.connect("dedup.documents", "embedder")
+        self.pipeline.connect("embedder.documents", "canonical.documents")
+        self.pipeline.connect("dedup.duplicates", "canonical.duplicates")
+
+    source_url = staticmethod(source_url)
 
     @component.output_types(documents=List[Document])
-    def run(self, event: List[Union[str, Path, ByteStream]]):
+    def run(self, event: List[Union[str, Path, ByteStream]], max_pages: Optional[int] = None,
+            strategy: Optional[str] = None):
         """
         Process each source file, read URLs and their associated metadata,
         fetch HTML content using a pipeline, and convert to Haystack Documents.
         :param event: A list of source files, URLs, or ByteStreams.
-        :return: A dictionary containing the processed document and the result of writing to Azure Search.
+        :param max_pages: Pages of the document parsed, all of them if None.
+        :param strategy: Partitioning strategy overriding the one of the parser.
+        :return: A list with the index dictionary of every chunk of the document.
         """
 
         # Extract URL and modify it if necessary
-        url = event.get("url")
-        if url and '-index.html' in url:
-            url = url.replace('-index.html', '.txt')
+        url = self.source_url(event)
 
         # else:
-        metadata = {field: event.get(field) for field in self.metadata_fields if field in event}
-        # Assume a pipeline fetches and processes this URL
-        try:
-            doc = self.pipeline.run({"unstructured": {"sources": [url]}})
-        except Exception as e:
-            logger.error(f"Error running pipeline for URL {url}: {e}")
-            raise
-        document_obj = doc['embedder']['documents'][0]
-        content = document_obj.content
-        additional_metadata = document_obj.meta
-
-        
-        embedding = document_obj.embedding
+        metadata = event_metadata(event, self.metadata_fields)
+        # Errors propagate, a guarded step retries the event later, see rag_common/retry_queue.py
+        doc = self.pipeline.run({"unstructured": {"sources": [url], "max_pages": max_pages,
+                                                  "strategy": strategy}})
         # Safely access the embedding metadata
         embedding_metadata = doc.get('embedder', {}).get('meta', {})
         metadata.update(embedding_metadata) 
-        document = Document(id=document_obj.id, content=content, meta=metadata, embedding=embedding)
-
-        dictionary = self.document_to_dict(document)
 
-        # # write to Azure Search
-        # result = self.write_to_ai_search(dictionary)
-
-        # results = {"document": dictionary, "result": result}
-        return dictionary
+        dictionaries = []
+        # Near duplicates are indexed with the vector of their canonical chunk, linked to it
+        for document_obj in doc['canonical']['documents'] + doc['canonical']['duplicates']:
+            content = document_obj.content
+            # The cleaner assigns fresh ids, so derive the id from the
+            # source, the position of the chunk and its content
+            doc_id = chunk_id(url, document_obj.meta.get('split_id', 0), content)
+            chunk_metadata = {**metadata, 'chunk': document_obj.meta.get('split_id', 0),
+                              'section': document_obj.meta.get('section')}
+            # Tickers the parser found in the filing, next to the one of the filer
+            parsed_symbol = document_obj.meta.get('symbol')
+            if parsed_symbol:
+                chunk_metadata['symbol'] = ','.join(filter(None, [metadata.get('symbol'), parsed_symbol]))
+            if 'duplicate_of' in document_obj.meta:
+                chunk_metadata['duplicate_of'] = document_obj.meta['duplicate_of']
+            document = Document(id=doc_id, content=content, meta=chunk_metadata,
+                                embedding=document_obj.embedding)
+            dictionaries.append(self.document_to_dict(document))
+
+        return dictionaries
+
+    def index_metadata(self, event: Dict[str, Any]) -> List[Dict]:
+        """
+        Index an event by its metadata alone, without fetching, parsing or
+        embedding its document.
+        :param event: A deserialized event.
+        :return: A list with the index dictionary of the event, without a vector.
+        """
+        url = self.source_url(event)
+        metadata = event_metadata(event, self.metadata_fields)
+        content = event.get('title') or f"{event.get('form_type') or 'SEC'} filing {url}"
+        document = Document(id=chunk_id(url, 0, content), content=content,
+                            meta={**metadata, 'chunk': 0, 'metadata_only': True})
+        return [self.document_to_dict(document)]
     
     def document_to_dict(self, document: Document) -> Dict:
         """
         Convert a Haystack Document object to a dictionary.
         """
-        # Ensure embedding is converted to a list, if it is a NumPy array
-        embedding = document.embedding
-        if embedding is not None and hasattr(embedding, 'tolist'):
-            embedding = embedding.tolist()
-        
-        flattened_meta = flatten_meta(document.meta)
-        
-        return {
-            "id": document.id,
-            "content": document.content,
-            "meta": json.dumps(flattened_meta),  # Serialize the flattened meta to a JSON string
-            "vector": embedding
-        }
+        return document_record(document)
 
     # def write_to_ai_search(self, dictionary):
     #     index_name = "bytewax-index"
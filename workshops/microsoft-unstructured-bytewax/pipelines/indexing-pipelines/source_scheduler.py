@@ -0,0 +1,238 @@
+"""Source-aware scheduling of the work of merged streams.
+
+With `op.merge` every event is processed in the order it arrives on the
+dataflow thread, so one SEC filing that takes seconds to fetch, parse and
+embed holds back every headline queued behind it. `SourceScheduler` runs the
+work of each source on a shared pool of threads instead:
+
+- every source has a concurrency budget, the most of its events processed
+  at once, so filings can never take all the threads;
+- every source has a latency target, and a free thread takes the waiting
+  event with the earliest deadline (arrival plus target). A headline with a
+  two second target overtakes filings that arrived before it, and a filing
+  whose deadline has come goes before newer headlines, so filing work
+  continues at a lower priority without starving;
+- the end-to-end latency of every source, from reading the event to
+  handing its output to the sink, is reported against its target.
+
+The dataflow submits events and drains finished output in the same
+`flat_map` step. A `TickSource` merged into the stream keeps draining while
+no events arrive. Running work is not interrupted, so the scheduler bounds
+how long a headline waits for a thread, not how long its own work takes.
+
+Delivery is at most once across a crash. An event leaves the dataflow, as
+far as bytewax knows, when `step` submits it: the next snapshot records the
+input offsets after it, although its work is still waiting or running on a
+scheduler thread. Events queued or running when the process dies are not
+replayed on resume, and neither are the retries waiting in a `RetryQueue`.
+To index them, resume the inputs from an earlier position, e.g. rewind the
+Kafka consumer group by a few latency targets. Replaying is safe, the index
+ids are derived from the source and content and uploads overwrite.
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Latency samples kept per source for the percentiles
+LATENCY_WINDOW = 1000
+
+
+@dataclass
+class SourcePolicy:
+    """
+    How the events of one source are processed.
+
+    :param handler: Called with an event on a scheduler thread, returns the
+        items to emit downstream.
+    :param max_concurrency: Events of this source processed at once.
+    :param latency_target: Seconds from reading an event to emitting its
+        output, sets the priority of the source.
+    """
+
+    handler: Callable[[Any], Iterable[Any]]
+    max_concurrency: int = 1
+    latency_target: float = 10.0
+
+
+@dataclass
+class _Job:
+    source: str
+    event: Any
+    arrived: float
+    deadline: float
+    started: float = 0.0
+    finished: float = 0.0
+    output: Optional[List[Any]] = None
+    error: Optional[BaseException] = None
+
+
+class SourceScheduler:
+    """Earliest-deadline-first scheduler with per-source concurrency budgets."""
+
+    def __init__(self, policies: Dict[str, SourcePolicy], workers: Optional[int] = None,
+                 report_interval: float = 60.0):
+        """
+        :param policies: The policy of every source, by source name.
+        :param workers: Threads shared by all sources, by default the sum of
+            the budgets. Fewer threads make sources compete for them by
+            deadline.
+        :param report_interval: Seconds between latency reports in the log.
+        """
+        self.policies = policies
+        self.workers = workers or sum(policy.max_concurrency for policy in policies.values())
+        self.report_interval = report_interval
+
+        self._condition = threading.Condition()
+        self._waiting: List[Tuple[float, int, _Job]] = []  # heap by deadline
+        self._order = itertools.count()
+        self._running = {source: 0 for source in policies}
+        self._finished: Deque[_Job] = deque()
+        self._latencies = {source: deque(maxlen=LATENCY_WINDOW) for source in policies}
+        self._waits = {source: deque(maxlen=LATENCY_WINDOW) for source in policies}
+        self._counts = {source: {"submitted": 0, "emitted": 0, "failed": 0, "late": 0} for source in policies}
+        self._next_report = time.monotonic() + report_interval
+
+        self._threads = [
+            threading.Thread(target=self._work, daemon=True, name=f"source-scheduler-{i}")
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, source: str, event: Any, arrived: Optional[float] = None) -> None:
+        """Queue an event of a source, `arrived` is when it was read (time.monotonic)."""
+        if source not in self.policies:
+            raise KeyError(f"No scheduling policy for source {source!r}")
+        arrived = time.monotonic() if arrived is None else arrived
+        job = _Job(source, event, arrived, arrived + self.policies[source].latency_target)
+        with self._condition:
+            heapq.heappush(self._waiting, (job.deadline, next(self._order), job))
+            self._counts[source]["submitted"] += 1
+            self._condition.notify()
+
+    def drain(self) -> List[Any]:
+        """
+        Output of the events finished since the last call. An error raised by
+        a handler is raised here, failing the dataflow as it would have
+        without the scheduler.
+        """
+        now = time.monotonic()
+        output, error = [], None
+        with self._condition:
+            finished, self._finished = self._finished, deque()
+            for job in finished:
+                counts = self._counts[job.source]
+                if job.error is not None:
+                    counts["failed"] += 1
+                    error = error or job.error
+                    continue
+                latency = now - job.arrived
+                self._latencies[job.source].append(latency)
+                self._waits[job.source].append(job.started - job.arrived)
+                counts["emitted"] += 1
+                counts["late"] += latency > self.policies[job.source].latency_target
+                output.extend(job.output)
+        if error is not None:
+            raise error
+        if now >= self._next_report:
+            self._next_report = now + self.report_interval
+            self.log_report()
+        return output
+
+    def step(self, item: Tuple[Optional[str], Any]) -> List[Any]:
+        """
+        `flat_map` step over `(source, (arrived, event))` items and ticks
+        with a `None` source, see `tag_source`.
+        """
+        source, value = item
+        if source is not None and value is not None:
+            arrived, event = value
+            if event is not None:
+                self.submit(source, event, arrived)
+        return self.drain()
+
+    @property
+    def idle(self) -> bool:
+        with self._condition:
+            return not self._waiting and not self._finished and not any(self._running.values())
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Counts, queue and latency percentiles in seconds of every source."""
+        with self._condition:
+            waiting = {source: 0 for source in self.policies}
+            for _, _, job in self._waiting:
+                waiting[job.source] += 1
+            running = dict(self._running)
+            counts = {source: dict(self._counts[source]) for source in self.policies}
+            latencies = {source: np.array(self._latencies[source]) for source in self.policies}
+            waits = {source: np.array(self._waits[source]) for source in self.policies}
+        report = {}
+        for source, policy in self.policies.items():
+            row = {**counts[source], "waiting": waiting[source], "running": running[source],
+                   "target_s": policy.latency_target}
+            if len(latencies[source]):
+                row.update(zip(("p50_s", "p95_s", "p99_s"),
+                               np.percentile(latencies[source], [50, 95, 99]).tolist()))
+                row["wait_p95_s"] = float(np.percentile(waits[source], 95))
+            report[source] = row
+        return report
+
+    def log_report(self) -> None:
+        for source, row in self.report().items():
+            latency = (f"p50 {row['p50_s']:.2f}s p95 {row['p95_s']:.2f}s p99 {row['p99_s']:.2f}s "
+                       f"queue wait p95 {row['wait_p95_s']:.2f}s" if "p50_s" in row else "no output yet")
+            logger.info(f"{source}: {row['emitted']}/{row['submitted']} emitted, {row['late']} over the "
+                        f"{row['target_s']:g}s target, {row['waiting']} waiting, {row['running']} running, "
+                        f"{latency}")
+
+    def _next_job(self) -> _Job:
+        """Earliest deadline among the sources under their budget, called with the lock held."""
+        while True:
+            skipped = []
+            job = None
+            while self._waiting:
+                entry = heapq.heappop(self._waiting)
+                candidate = entry[2]
+                if self._running[candidate.source] < self.policies[candidate.source].max_concurrency:
+                    job = candidate
+                    break
+                skipped.append(entry)
+            for entry in skipped:
+                heapq.heappush(self._waiting, entry)
+            if job is not None:
+                return job
+            self._condition.wait()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                job = self._next_job()
+                self._running[job.source] += 1
+            job.started = time.monotonic()
+            try:
+                job.output = list(self.policies[job.source].handler(job.event) or [])
+            except Exception as e:
+                logger.error(f"Error processing {job.source} event: {e}")
+                job.error = e
+            job.finished = time.monotonic()
+            with self._condition:
+                self._running[job.source] -= 1
+                self._finished.append(job)
+                # A slot of this source is free, a skipped job may now run
+                self._condition.notify_all()
+
+
+def tag_source(source: str) -> Callable[[Any], Tuple[str, Tuple[float, Any]]]:
+    """`map` step stamping events with their source and the time they were read."""
+    def tag(event: Any) -> Tuple[str, Tuple[float, Any]]:
+        return source, (time.monotonic(), event)
+    return tag
@@ -0,0 +1,39 @@
+import gzip
+
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSink, run_main
+
+from custom_connectors import MultiFileSource
+
+
+def write_archive(tmp_path):
+    (tmp_path / "news_2024-05-28.jsonl").write_text("a\nb\n")
+    with gzip.open(tmp_path / "news_2024-05-29.jsonl.gz", "wt") as file:
+        file.write("c\nd\ne\n")
+    (tmp_path / "notes.txt").write_text("skipped\n")
+
+
+def test_every_file_of_a_directory_is_read(tmp_path):
+    write_archive(tmp_path)
+    output = []
+    flow = Dataflow("backfill")
+    op.output("output", op.input("input", flow, MultiFileSource(tmp_path, batch_size=2)), TestingSink(output))
+    run_main(flow)
+
+    assert sorted(output) == ["a", "b", "c", "d", "e"]
+
+
+def test_partitions_resume_from_their_snapshot(tmp_path):
+    write_archive(tmp_path)
+    source = MultiFileSource(tmp_path, batch_size=2)
+    [part] = [part for part in source.list_parts() if part.endswith(".gz")]
+
+    partition = source.build_part("input", part, None)
+    assert partition.next_batch() == ["c", "d"]
+    snapshot = partition.snapshot()
+    partition.close()
+
+    resumed = source.build_part("input", part, snapshot)
+    assert resumed.next_batch() == ["e"]
+    resumed.close()
@@ -0,0 +1,30 @@
+"""Filings of the sample feed are routed by form type and fetched as full text."""
+import os
+
+from filing_router import FULL, METADATA, FilingRouter
+from index_fields import safe_deserialize, source_url
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def sample_filings():
+    with open(os.path.join(DATA, "sec_out.jsonl")) as f:
+        return [safe_deserialize(line) for line in f if line.strip()]
+
+
+def test_feed_urls_are_fetched_as_full_text():
+    filing = next(event for event in sample_filings() if event["form_type"] == "6-K")
+
+    assert filing["url"].endswith("/0001213900-24-047283-index.htm")
+    assert source_url(filing) == ("https://www.sec.gov/Archives/edgar/data/1985337/000121390024047283/"
+                                  "0001213900-24-047283.txt")
+    assert source_url({"url": filing["url"] + "l"}) == source_url(filing)
+    assert source_url({"url": "https://www.benzinga.com/news/24/05/39063802/a"}).endswith("/39063802/a")
+
+
+def test_sample_filings_are_routed_by_form_type():
+    filings = {event["form_type"]: event for event in sample_filings()}
+
+    assert FilingRouter().route(filings["6-K"]) == FULL
+    assert FilingRouter().route(filings["NPORT-P"]) == METADATA
+    assert FilingRouter().lookup("10-K/A") == FULL
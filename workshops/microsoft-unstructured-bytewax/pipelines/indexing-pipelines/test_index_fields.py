@@ -0,0 +1,47 @@
+"""Records built from the sample events carry the typed fields the index filters on."""
+import json
+import os
+
+from haystack import Document
+
+from index_fields import document_record, event_metadata, safe_deserialize
+from local_search_index import parse_timestamp
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+
+def first_line(name, predicate):
+    with open(os.path.join(DATA, name)) as f:
+        return next(line for line in f if predicate(line))
+
+
+def record(line):
+    event = safe_deserialize(line)
+    return document_record(Document(content="chunk", meta=event_metadata(event)))
+
+
+def test_news_record():
+    fields = record(first_line("news_out.jsonl", lambda line: json.loads(line)["symbols"]))
+
+    assert fields["symbols"] == ["VRTS"]
+    assert fields["source"] == "benzinga"
+    assert fields["created_at"] == "2024-05-29T13:26:51Z"
+    assert fields["updated_at"] == "2024-05-29T13:26:52Z"
+
+
+def test_edgar_record():
+    fields = record(first_line("sec_out.jsonl", lambda line: json.loads(line)[0] != "no_ticker"))
+
+    assert fields["symbols"] == ["YYGH"]
+    assert fields["form_type"] == "6-K"
+    assert fields["source"] == "sec"
+    # The archived feed has no filing date, the record is dated when received
+    assert parse_timestamp(fields["created_at"]) is not None
+    assert fields["updated_at"] == fields["created_at"]
+
+
+def test_edgar_record_dated_by_feed():
+    line = json.dumps(["YYGH", {"id": "1", "title": "6-K", "form_type": "6-K", "updated": "2024-05-29T09:25:53-04:00",
+                                "link": "https://www.sec.gov/Archives/edgar/data/1/1/1-index.htm"}])
+
+    assert record(line)["created_at"] == "2024-05-29T13:25:53Z"
@@ -0,0 +1,56 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from local_search_index import LocalSearchIndex, SearchFilter, VectorQuery, vector_search
+
+DOCUMENTS = [
+    {"id": "vrts", "content": "Virtus price target raised", "symbols": ["VRTS"], "form_type": None,
+     "source": "benzinga", "updated_at": "2024-05-29T13:26:52Z", "vector": [1.0, 0.0, 0.0, 0.0]},
+    {"id": "ffie", "content": "Faraday Future Nasdaq grant", "symbols": ["FFIE"], "form_type": None,
+     "source": "benzinga", "updated_at": "2024-05-29T13:27:17Z", "vector": [0.9, 0.1, 0.0, 0.0]},
+    {"id": "yygh", "content": "YY Group 6-K", "symbols": ["YYGH"], "form_type": "6-K",
+     "source": "sec", "updated_at": "2024-05-28T09:00:00Z", "vector": [0.8, 0.2, 0.0, 0.0]},
+    {"id": "nport", "content": "NPORT-P Managed Portfolio Series", "symbols": [], "form_type": "NPORT-P",
+     "source": "sec", "updated_at": "2024-05-29T14:00:00Z", "vector": None},
+]
+
+
+@pytest.fixture(params=[("exhaustive", "float32"), ("exhaustive", "int8"), ("hnsw", "float32")])
+def index(request):
+    algorithm, storage = request.param
+    index = LocalSearchIndex(dimensions=4, algorithm=algorithm, vector_storage=storage)
+    index.upload_documents(DOCUMENTS)
+    return index
+
+
+def ids(results):
+    return [result["id"] for result in results]
+
+
+def test_filters_are_applied_before_ranking(index):
+    query = [1.0, 0.0, 0.0, 0.0]
+
+    assert ids(vector_search(index, query, top=3)) == ["vrts", "ffie", "yygh"]
+    assert ids(vector_search(index, query, top=3, symbols=["FFIE", "YYGH"])) == ["ffie", "yygh"]
+    assert ids(vector_search(index, query, top=3, sources=["sec"])) == ["yygh"]
+    assert ids(vector_search(index, query, top=3, form_types=["6-K"])) == ["yygh"]
+    since = datetime(2024, 5, 29, 13, 27, tzinfo=timezone.utc)
+    assert ids(vector_search(index, query, top=3, since=since)) == ["ffie"]
+
+
+def test_documents_without_a_vector_are_filtered_but_not_ranked(index):
+    assert index.get_document("nport")["form_type"] == "NPORT-P"
+    assert vector_search(index, [0.0, 0.0, 1.0, 0.0], top=3, form_types=["NPORT-P"]) == []
+
+
+def test_odata_round_trip():
+    search_filter = SearchFilter(symbols=["VRTS"], sources=["benzinga"],
+                                 since=datetime(2024, 5, 29, tzinfo=timezone.utc))
+
+    assert SearchFilter.from_odata(search_filter.to_odata()) == search_filter
+
+
+def test_text_queries_are_rejected(index):
+    with pytest.raises(ValueError):
+        index.search(search_text="Virtus", vector_queries=[VectorQuery(vector=[1.0, 0.0, 0.0, 0.0])])
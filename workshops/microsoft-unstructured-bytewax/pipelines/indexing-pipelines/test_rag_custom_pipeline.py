@@ -0,0 +1,25 @@
+import pytest
+from haystack import Document
+
+from rag_common.sec_client import BACKFILL
+
+# Needs the Unstructured client the pipeline parses filings with
+rag_custom_pipeline = pytest.importorskip("rag_custom_pipeline")
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.priorities = []
+
+    def acquire(self, priority):
+        self.priorities.append(priority)
+
+
+def test_the_embedding_budget_is_taken_per_chunk():
+    limiter = CountingLimiter()
+    chunks = [Document(content=f"page {i}") for i in range(5)]
+
+    result = rag_custom_pipeline.DocumentRateLimiter(limiter, priority=BACKFILL).run(documents=chunks)
+
+    assert result["documents"] == chunks
+    assert limiter.priorities == [BACKFILL] * 5
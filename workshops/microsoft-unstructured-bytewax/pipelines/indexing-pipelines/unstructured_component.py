@@ -1,15 +1,19 @@
+import hashlib
 import re
-from typing import Any, Dict, List, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Optional, Union
 from pathlib import Path
-import requests
 import time
-import uuid
 from dotenv import load_dotenv
 from haystack import Document, component
 from unstructured_client import UnstructuredClient
 from unstructured_client.models import shared
 from unstructured_client.models.errors import SDKError
 from unstructured.staging.base import dict_to_elements
+from rag_common.fetch_cache import get_cache
+from rag_common.sec_client import LIVE, get_client
+from rag_common.text_cleaner import TextCleaner
 # Setup logging
 import logging
 
@@ -17,61 +21,94 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 load_dotenv(".env")
 
+# Elements left without letters or digits once markup and punctuation other
+# than dashes are removed are skipped
+ELEMENT_CLEANER = TextCleaner(noise_patterns=[r'[^a-zA-Z0-9\s-]'])
+
+# A page cap keeps this many bytes of markup per page of a download, and
+# elements without a page number are counted in pages of this many characters
+PAGE_BYTES = 20_000
+PAGE_CHARACTERS = 3_000
+
+
+def chunk_id(source_url: Union[str, Path], position: int, content: str) -> str:
+    """
+    Derive a deterministic id for a chunk of a source document.
+    The same source, element position and content always produce the same id,
+    so re-processing a filing overwrites the existing index entries instead of
+    adding a new copy of them.
+    :param source_url: URL or path the chunk was extracted from.
+    :param position: Position of the chunk within the source.
+    :param content: Text content of the chunk.
+    :return: A hex digest usable as an Azure Search document key.
+    """
+    content_hash = hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+    key = f"{source_url}|{position}|{content_hash}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
 @component
 class UnstructuredParser:
     """
     A component generating personal welcome message and making it upper case
     """
-    def __init__(self, unstructured_key: str, chunking_strategy, strategy, model):
+    def __init__(self, unstructured_key: str, chunking_strategy, strategy, model,
+                 priority: int = LIVE, max_downloads: int = 4):
         """
         Initialize the UnstructuredParser with an API key.
         :param unstructured_key: The API key for the Unstructured API.
         :param chunking_strategy: The chunking strategy to use. https://docs.unstructured.io/api-reference/api-services/chunking
         :param strategy: The strategy to use. https://docs.unstructured.io/api-reference/api-services/partitioning
         :param model: The model to use. 
+        :param priority: Priority of the downloads in the shared sec.gov rate limit, `LIVE` or `BACKFILL`.
+        :param max_downloads: Number of sources downloaded concurrently.
         """
         self.unstructured_key = unstructured_key
         self.chunking_strategy = chunking_strategy
         self.strategy = strategy
         self.model = model
+        self.priority = priority
+        self.max_downloads = max_downloads
 
     @component.output_types(documents=List[Document])
-    def run(self, sources: List[Union[str, Path]]):
+    def run(self, sources: List[Union[str, Path]], max_pages: Optional[int] = None, strategy: Optional[str] = None):
         """
         Process each source file, read URLs and their associated metadata,
         fetch any unstructured content using a pipeline, and convert to Haystack Documents.
         :param sources: File paths or URLs to process.
+        :param max_pages: Pages of every source partitioned, all of them if None.
+            The download is cut to `PAGE_BYTES` per page before partitioning.
+        :param strategy: Partitioning strategy overriding the one of the component.
         :return: A list of Haystack Documents.
         """
-        
-        regex_pattern = (
-        r'<.*?>'  # HTML tags
-        r'|\t'  # Tabs
-        r'|\n+'  # Newlines
-        r'|&nbsp;'  # Non-breaking spaces
-        r'|[^a-zA-Z0-9\s-]'  # Any non-alphanumeric character (excluding whitespace)
-        )
-        
         client = UnstructuredClient(api_key_auth=self.unstructured_key)
         documents = []
         all_symbols = set()
-        for source in sources:
-            file_content = self.download_file(source)
+        # The shared client keeps concurrent downloads within the sec.gov rate limit
+        with ThreadPoolExecutor(max_workers=self.max_downloads) as pool:
+            downloads = list(pool.map(self.download_file, sources))
+        for source, file_content in zip(sources, downloads):
+            if file_content and max_pages is not None:
+                file_content = file_content[:max_pages * PAGE_BYTES]
             if file_content:  # Check if download was successful
                 req = shared.PartitionParameters(
                     files=shared.Files(
                         content=file_content,
                         file_name=str(source),
                     ),
-                    strategy=self.strategy,
+                    strategy=strategy or self.strategy,
                     hi_res_model_name=self.model,
                     chunking_strategy=self.chunking_strategy,
                 )
                 try:
                     resp = client.general.partition(req)
                     elements = dict_to_elements(resp.elements)
-                    for item in elements:
-                        doc_id = str(uuid.uuid4())
+                    characters = 0
+                    for position, item in enumerate(elements):
+                        page = item.metadata.page_number or 1 + characters // PAGE_CHARACTERS
+                        characters += len(item.text)
+                        if max_pages is not None and page > max_pages:
+                            break
+                        doc_id = chunk_id(source, position, item.text)
                         metadata = item.metadata.to_dict()
                         
                         # Extract CLASS-CONTRACT-TICKER-SYMBOL if present
@@ -82,8 +119,7 @@ class UnstructuredParser:
                             metadata['symbol'] = symbols
 
 
-                        cleaned_text = re.sub(regex_pattern, '', item.text)
-                        if cleaned_text=="":  # Skip empty documents
+                        if not ELEMENT_CLEANER.clean(item.text):  # Skip empty documents
                             continue
 
                         metadata.pop('orig_elements', None)
@@ -114,10 +150,12 @@ class UnstructuredParser:
             'Upgrade-Insecure-Requests': '1',
         }
         try:
-            response = requests.get(source, headers=headers)
+            # Archived filings are immutable, so repeated runs read them from disk
+            fetch = partial(get_client().get, priority=self.priority)
+            response = get_cache().get(source, headers=headers, fetch=fetch)
             
             if response.status_code == 200:
-                print("Download succeeded")
+                print("Download succeeded" if not response.from_cache else "Download served from cache")
                 return response.content
             else:
                 print(f"Download failed with status code: {response.status_code}")
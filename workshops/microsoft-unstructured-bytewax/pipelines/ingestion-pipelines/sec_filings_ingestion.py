@@ -6,16 +6,20 @@ import json
 from typing import Dict
 
 from pandas import read_json
-import requests
 from bytewax import operators as op
 from bytewax.connectors.files import FileSink
 from bytewax.dataflow import Dataflow
 from bytewax.inputs import SimplePollingSource
 from bytewax.connectors.kafka import operators as kop
 from bytewax.connectors.kafka import KafkaSinkMessage
+from rag_common.fetch_cache import get_cache
+from rag_common.sec_client import get_client
+from rag_common.state_telemetry import get_telemetry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Entries, memory and snapshot size of the state, see rag_common/state_telemetry.py
+telemetry = get_telemetry()
 
 class SECSource(SimplePollingSource):
     def next_item(self):
@@ -44,8 +48,8 @@ class SECSource(SimplePollingSource):
             'output':'atom'    # Number of results to return
         }
 
-        # Making the GET request
-        response = requests.get(base_url, headers=headers, params=params)
+        # Making the GET request, shares the sec.gov rate limit with enrich
+        response = get_client().get(base_url, headers=headers, params=params)
         
         if response.status_code == 200:
             logger.info("Successfully retrieved filings")
@@ -75,6 +79,7 @@ def parse_atom(xml_data):
         cik_match = re.search(r'\((\d+)\)', title)
         cik = cik_match.group(1) if cik_match else "No CIK found"
         form_type = entry.find('atom:category', namespace).attrib['term']
+        updated = entry.find("atom:updated", namespace)
 
         data.append(
             ("All",
@@ -83,7 +88,8 @@ def parse_atom(xml_data):
                 "title":title,
                 "link":link,
                 "cik":cik,
-                "form_type":form_type
+                "form_type":form_type,
+                "updated":updated.text if updated is not None else None
 
             })
         )
@@ -102,7 +108,7 @@ def dedupe(filings, filing):
         filings.append(filing["id"])
         return (filings, filing)
 
-deduped_stream = op.stateful_map("dedupe", processed_stream, dedupe)
+deduped_stream = telemetry.stateful_map("dedupe", processed_stream, dedupe)
 # op.inspect("dedupe_stream", deduped_stream)
 
 deduped_filtered_stream = op.filter_map("remove key", deduped_stream, lambda x: x[1])
@@ -111,6 +117,7 @@ op.inspect("filt", deduped_filtered_stream)
 
 cik_to_ticker = read_json("company_tickers.json", orient='index')
 cik_to_ticker.set_index(cik_to_ticker['cik_str'], inplace=True)
+telemetry.watch("company_tickers", cik_to_ticker)
 
 def enrich(data, cik_to_tickers):
     cik = int(data["cik"])
@@ -128,7 +135,7 @@ def enrich(data, cik_to_tickers):
             # Extract the relevant parts
             cik = parts[6]
             accession_number = parts[7]
-            formatted_accession_number = parts[-1].replace('-index.htm', '.txt')
+            formatted_accession_number = re.sub(r'-index\.html?$', '.txt', parts[-1])
 
             # Construct the new URL
             new_url = f"https://www.sec.gov/Archives/edgar/data/{cik}/{accession_number}/{formatted_accession_number}"
@@ -143,7 +150,8 @@ def enrich(data, cik_to_tickers):
                 'Host': 'www.sec.gov'
             }
 
-            response = requests.get(new_url, headers=headers)
+            # Filing documents never change, repeated lookups are read from disk
+            response = get_cache().get(new_url, headers=headers, fetch=get_client().get)
         
             if response.status_code == 200:
                 logger.info("Successfully retrieved filing text")
@@ -0,0 +1,91 @@
+"""Speed of TextCleaner against the cleaning chain it replaced.
+
+The old chain ran `BenzingaNews.clean_text` (a BeautifulSoup parse and a
+whitespace `re.sub`) on every string field of every event, then
+DocumentCleaner on the content. TextCleaner makes one pass over the text
+fields only. Both run over `data/news_out.jsonl`; the report also counts the
+contents on which they disagree.
+
+    python bench_cleaning.py --repeat 5
+"""
+import argparse
+import json
+import re
+import time
+
+from bs4 import BeautifulSoup
+from haystack import Document
+from haystack.components.preprocessors import DocumentCleaner
+
+from rag_common.text_cleaner import TextCleaner
+
+
+def legacy_clean_text(text):
+    soup = BeautifulSoup(text, "html.parser")
+    text = soup.get_text()
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+def legacy_chain(events, document_cleaner):
+    documents = []
+    for source in events:
+        source = dict(source)
+        for key in source:
+            if type(source[key]) == str:
+                source[key] = legacy_clean_text(source[key])
+        if source["content"] == "":
+            continue
+        documents.append(Document(content=source["content"], meta=source))
+    return document_cleaner.run(documents=documents)["documents"]
+
+
+def single_pass(events, cleaner):
+    documents = []
+    for source in events:
+        if not source.get("content"):
+            continue
+        source = cleaner.clean_fields(dict(source))
+        if source["content"]:
+            documents.append(Document(content=source["content"], meta=source))
+    return documents
+
+
+def best_of(repeat, function, *args):
+    timings, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--path", default="data/news_out.jsonl")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with open(args.path, "r", encoding="utf-8") as file:
+        events = [json.loads(line) for line in file]
+    characters = sum(len(value) for event in events for value in event.values() if isinstance(value, str))
+
+    document_cleaner = DocumentCleaner(remove_empty_lines=True, remove_extra_whitespaces=True,
+                                       remove_repeated_substrings=False)
+    cleaner = TextCleaner()
+    legacy_seconds, legacy_documents = best_of(args.repeat, legacy_chain, events, document_cleaner)
+    fast_seconds, fast_documents = best_of(args.repeat, single_pass, events, cleaner)
+
+    legacy_contents = {doc.meta["url"]: doc.content for doc in legacy_documents}
+    differing = sum(legacy_contents.get(doc.meta["url"]) != doc.content for doc in fast_documents)
+
+    print(f"{len(events)} events, {characters / 1e6:.2f}M characters of string fields, best of {args.repeat}")
+    print(f"{'cleaner':<26} {'seconds':>8} {'events/s':>10} {'documents':>10}")
+    for name, seconds, documents in (("BeautifulSoup + regex", legacy_seconds, legacy_documents),
+                                     ("TextCleaner", fast_seconds, fast_documents)):
+        print(f"{name:<26} {seconds:>8.3f} {len(events) / seconds:>10.0f} {len(documents):>10}")
+    print(f"speedup {legacy_seconds / fast_seconds:.1f}x, {differing} contents differ")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,11 @@ from bytewax import operators as op
 from bytewax.dataflow import Dataflow
 from bytewax import operators as op
 from bytewax.connectors.stdio import StdOutSink
-from bytewax.connectors.files import FileSource
+from rag_common.compressed_jsonl import CompressedFileSource
 
-from haystack.components.preprocessors import DocumentCleaner
 from haystack.components.embedders import OpenAIDocumentEmbedder
 from haystack import Pipeline
 from haystack.components.embedders import OpenAIDocumentEmbedder
-from haystack.components.preprocessors import DocumentCleaner
-from haystack.components.preprocessors import DocumentSplitter
-from haystack.components.writers import DocumentWriter
 from haystack.document_stores.types import DuplicatePolicy
 from haystack.document_stores.in_memory import InMemoryDocumentStore
 from haystack_integrations.document_stores.elasticsearch import ElasticsearchDocumentStore
@@ -26,11 +22,17 @@ from dotenv import load_dotenv
 import os
 
 import re
-from bs4 import BeautifulSoup
 from pathlib import Path
 
 import logging
 
+from lexical_index import InvertedIndex, LexicalIndexSink
+from rag_common.token_chunker import TokenChunker
+from rag_common.text_cleaner import DocumentTextCleaner
+from document_store_sink import DocumentStoreSink
+from rag_common.step_profiler import profile_components, profiled
+from rag_common.state_telemetry import get_telemetry
+
 
 load_dotenv(".env")
 open_ai_key = os.environ.get("OPENAI_API_KEY")
@@ -84,12 +86,8 @@ class BenzingaNews:
              
         documents = []
         for source in sources:
-        
-            for key in source:
-                if type(source[key]) == str:
-                    source[key] = self.clean_text(source[key])
-                    
-            if source['content'] == "":
+            # Markup and entities are removed by the document cleaner
+            if not source.get('content'):
                 continue
 
             #drop content from source dictionary
@@ -99,29 +97,16 @@ class BenzingaNews:
             documents.append(document)
          
         return {"documents": documents}
-               
-    def clean_text(self, text):
-        # Remove HTML tags using BeautifulSoup
-        soup = BeautifulSoup(text, "html.parser")
-        text = soup.get_text()
-        # Remove extra whitespace
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text
     
 @component
 class BenzingaEmbeder:
     
     def __init__(self):
         get_news = BenzingaNews()
-        document_store = ElasticsearchDocumentStore(embedding_similarity_function="cosine", hosts = "http://localhost:9200")
-        document_cleaner = DocumentCleaner(
-                            remove_empty_lines=True,
-                            remove_extra_whitespaces=True,
-                            remove_repeated_substrings=False
-                        )
-        document_splitter = DocumentSplitter(split_by="passage", split_length=5)
-        document_writer = DocumentWriter(document_store=document_store,
-                                        policy = DuplicatePolicy.OVERWRITE)
+        # One pass over the content, headline and summary, other fields are kept as is.
+        # Paragraph breaks are kept for the chunker to cut at
+        document_cleaner = DocumentTextCleaner(meta_fields=("headline", "summary"), keep_paragraphs=True)
+        document_splitter = TokenChunker(max_tokens=512, overlap_tokens=64)
         embedding = OpenAIDocumentEmbedder(api_key=Secret.from_token(open_ai_key))
 
         self.pipeline = Pipeline()
@@ -129,37 +114,52 @@ class BenzingaEmbeder:
         self.pipeline.add_component("document_cleaner", document_cleaner)
         self.pipeline.add_component("document_splitter", document_splitter)
         #self.pipeline.add_component("embedding", embedding)
-        self.pipeline.add_component("document_writer", document_writer)
 
         self.pipeline.connect("get_news", "document_cleaner")
         self.pipeline.connect("document_cleaner", "document_splitter")
-        self.pipeline.connect("document_splitter", "document_writer")
-        #self.pipeline.connect("embedding", "document_writer")
+        #self.pipeline.connect("document_splitter", "embedding")
         
         
     @component.output_types(documents=List[Document])
     def run(self, event: List[Union[str, Path, ByteStream]]):
         
-        documents = self.pipeline.run({"get_news": {"sources": [event]}})
+        documents = self.pipeline.run({"get_news": {"sources": [event]}},
+                                      include_outputs_from={"document_splitter"})
         
         self.pipeline.draw("benzinga_pipeline.png")
         return documents
     
     
 embed_benzinga = BenzingaEmbeder()
+# Opt-in per-step profiles, see rag_common/step_profiler.py
+profile_components(embed_benzinga.pipeline, prefix="embed_content")
+
+# Documents are written in bulk by the sink at the end of the dataflow
+document_store = ElasticsearchDocumentStore(embedding_similarity_function="cosine", hosts = "http://localhost:9200")
+
+# Lexical index over content, headline and symbols for the hybrid retriever
+LEXICAL_INDEX_PATH = os.environ.get("LEXICAL_INDEX_PATH", "lexical_index.json")
+# Loaded at startup so a restart keeps the documents indexed before it
+lexical_index = InvertedIndex.open(LEXICAL_INDEX_PATH)
+# Documents and memory of the index, see rag_common/state_telemetry.py
+get_telemetry().watch("lexical_index", lexical_index)
 
 def process_event(event):
-    """Wrapper to handle the processing of each event."""
+    """Wrapper to handle the processing of each event, returns the documents to write."""
     if event:
         document = embed_benzinga.run(event)
-        return document
-    return None
+        return document.get("document_splitter", {}).get("documents", [])
+    return []
 
 
 flow = Dataflow("rag-pipeline")
-input_data = op.input("input", flow, FileSource("data/news_out.jsonl"))
-deserialize_data = op.map("deserialize", input_data, safe_deserialize)
-get_content = op.map("embed_content", deserialize_data, process_event)
-op.output("output", get_content, StdOutSink())
+input_data = op.input("input", flow, CompressedFileSource("data/news_out.jsonl"))
+deserialize_data = op.map("deserialize", input_data, profiled("deserialize", safe_deserialize))
+get_content = op.flat_map("embed_content", deserialize_data, profiled("embed_content", process_event))
+op.output("output", get_content, DocumentStoreSink(document_store, batch_size=200, flush_interval=2.0,
+                                                   max_outstanding=2, failure_policy="dead_letter",
+                                                   dead_letter_path="data/failed_documents.jsonl"))
+# Indexed and saved off the processing step, see LexicalIndexSink
+op.output("lexical_index", get_content, LexicalIndexSink(lexical_index, LEXICAL_INDEX_PATH, interval=30))
 
 
@@ -0,0 +1,282 @@
+"""Bulk, asynchronous bytewax sink for Haystack document stores.
+
+Writing with a DocumentWriter inside the per-event pipeline sends one request
+per article and blocks the dataflow on every one of them. `DocumentStoreSink`
+takes the documents out of the pipeline: each worker buffers them, flushes
+in bulk once `batch_size` documents are buffered or the oldest one waited
+`flush_interval` seconds, and writes on a thread pool with at most
+`max_outstanding` requests in flight. When that many are in flight the
+dataflow waits, so a slow store slows the flow down instead of growing the
+buffer without bound.
+
+Works with any store that has `write_documents`, e.g. ElasticsearchDocumentStore
+or InMemoryDocumentStore, and with the `merge_or_upload_documents` API of
+`LocalSearchIndex` and Azure AI Search.
+
+Documents buffered or in flight when a worker crashes are not written. Their
+ids are derived from their content, so replaying the input writes them again
+without duplicates.
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from bytewax.outputs import DynamicSink, StatelessSinkPartition
+from haystack import Document
+from haystack.document_stores.types import DuplicatePolicy
+from typing_extensions import override
+
+logger = logging.getLogger(__name__)
+
+FAILURE_POLICIES = ("raise", "skip", "dead_letter")
+
+
+def document_record(document: Document) -> Dict[str, Any]:
+    """Flat record of a document for stores that take dictionaries."""
+    embedding = document.embedding
+    if embedding is not None and hasattr(embedding, "tolist"):
+        embedding = embedding.tolist()
+    return {**document.meta, "id": document.id, "content": document.content, "vector": embedding}
+
+
+def _store_writer(store: Any, policy: DuplicatePolicy) -> Callable[[List[Document]], List[str]]:
+    """Function writing a batch to `store` and returning the ids it rejected."""
+    if hasattr(store, "write_documents"):
+        def write(documents: List[Document]) -> List[str]:
+            store.write_documents(documents, policy=policy)
+            return []
+        return write
+    if hasattr(store, "merge_or_upload_documents"):
+        def write(documents: List[Document]) -> List[str]:
+            results = store.merge_or_upload_documents([document_record(doc) for doc in documents])
+            return [_result_key(result) for result in results or [] if not _result_succeeded(result)]
+        return write
+    raise TypeError(f"{type(store).__name__} has neither write_documents nor merge_or_upload_documents")
+
+
+def _result_key(result: Any) -> str:
+    return result["key"] if isinstance(result, dict) else result.key
+
+
+def _result_succeeded(result: Any) -> bool:
+    return result["succeeded"] if isinstance(result, dict) else result.succeeded
+
+
+class _DocumentStorePartition(StatelessSinkPartition[Any]):
+    def __init__(self, write, batch_size, flush_interval, max_outstanding, max_retries, backoff,
+                 failure_policy, dead_letter_path, worker_index):
+        self._write = write
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._failure_policy = failure_policy
+        self._dead_letter_path = dead_letter_path
+        self._worker_index = worker_index
+
+        self._buffer: Dict[str, Document] = {}
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_outstanding)
+        self._pool = ThreadPoolExecutor(max_workers=max_outstanding,
+                                        thread_name_prefix=f"store-sink-{worker_index}")
+        self._in_flight: Set[Future] = set()
+        self._failures: List[Exception] = []
+        self.stats = {"written": 0, "failed": 0, "flushes": 0, "retries": 0, "waited_s": 0.0}
+
+        # Flushes a buffer that stopped growing, write_batch only runs when
+        # new items arrive
+        self._closed = threading.Event()
+        self._timer = threading.Thread(target=self._flush_when_stale, daemon=True,
+                                       name=f"store-sink-timer-{worker_index}")
+        self._timer.start()
+
+    @override
+    def write_batch(self, items: List[Any]) -> None:
+        self._raise_failures()
+        batches = []
+        with self._lock:
+            for document in _documents(items):
+                # The last version of a document in the buffer wins
+                self._buffer.pop(document.id, None)
+                self._buffer[document.id] = document
+            if self._buffer and self._oldest is None:
+                self._oldest = time.monotonic()
+            while len(self._buffer) >= self._batch_size:
+                batches.append(self._take(self._batch_size))
+        for batch in batches:
+            self._submit(batch)
+
+    @override
+    def close(self) -> None:
+        self._closed.set()
+        with self._lock:
+            batch = self._take(len(self._buffer))
+        if batch:
+            self._submit(batch)
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            stats = dict(self.stats)
+        logger.info(f"Document store sink {self._worker_index} closed: {stats}")
+        self._raise_failures()
+
+    def _take(self, count: int) -> List[Document]:
+        keys = list(self._buffer)[:count]
+        batch = [self._buffer.pop(key) for key in keys]
+        self._oldest = time.monotonic() if self._buffer else None
+        return batch
+
+    def _flush_when_stale(self) -> None:
+        while not self._closed.wait(self._flush_interval / 2):
+            with self._lock:
+                stale = self._oldest is not None and time.monotonic() - self._oldest >= self._flush_interval
+                batch = self._take(len(self._buffer)) if stale else []
+            if batch:
+                self._submit(batch)
+
+    def _submit(self, batch: List[Document]) -> None:
+        start = time.monotonic()
+        # Blocks the dataflow while max_outstanding writes are in flight
+        self._slots.acquire()
+        # The stats are also updated by the timer and the writer threads
+        with self._lock:
+            self.stats["waited_s"] += time.monotonic() - start
+            self.stats["flushes"] += 1
+        future = self._pool.submit(self._write_batch, batch)
+        self._in_flight.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future: Future) -> None:
+        self._in_flight.discard(future)
+        self._slots.release()
+        error = future.exception()
+        if error is not None:
+            self._failures.append(error)
+
+    def _write_batch(self, batch: List[Document]) -> None:
+        failed = self._write_with_retries(batch)
+        with self._lock:
+            self.stats["written"] += len(batch) - len(failed)
+            self.stats["failed"] += len(failed)
+        if failed:
+            self._handle_failed(failed)
+
+    def _write_with_retries(self, batch: List[Document]) -> List[Document]:
+        """Write a batch, retrying transient errors, and return the documents that failed."""
+        error = None
+        for attempt in range(self._max_retries + 1):
+            if attempt:
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+            try:
+                rejected = set(self._write(batch))
+                return [doc for doc in batch if doc.id in rejected]
+            except Exception as e:
+                error = e
+        if len(batch) == 1:
+            logger.warning(f"Failed to write document {batch[0].id}: {error}")
+            return batch
+        return self._bisect(batch)
+
+    def _bisect(self, batch: List[Document]) -> List[Document]:
+        """
+        A bulk request failing as a whole can be caused by a few documents,
+        halving the batch isolates them in log2(batch size) rounds.
+        """
+        failed = []
+        for half in (batch[:len(batch) // 2], batch[len(batch) // 2:]):
+            try:
+                rejected = set(self._write(half))
+                failed += [doc for doc in half if doc.id in rejected]
+            except Exception as e:
+                if len(half) == 1:
+                    logger.warning(f"Failed to write document {half[0].id}: {e}")
+                    failed += half
+                else:
+                    failed += self._bisect(half)
+        return failed
+
+    def _handle_failed(self, failed: List[Document]) -> None:
+        if self._failure_policy == "raise":
+            raise RuntimeError(f"Failed to write {len(failed)} documents: {[doc.id for doc in failed][:10]}")
+        if self._failure_policy == "dead_letter":
+            with self._lock, open(self._dead_letter_path, "a", encoding="utf-8") as file:
+                for document in failed:
+                    file.write(json.dumps(document.to_dict(flatten=False), default=str) + "\n")
+        logger.warning(f"Skipped {len(failed)} documents that could not be written")
+
+    def _raise_failures(self) -> None:
+        if self._failures:
+            error = self._failures.pop(0)
+            raise RuntimeError("Writing to the document store failed") from error
+
+
+def _documents(items: Iterable[Any]) -> Iterable[Document]:
+    for item in items:
+        if isinstance(item, Document):
+            yield item
+        elif isinstance(item, (list, tuple)):
+            yield from _documents(item)
+        elif item is not None:
+            raise TypeError(f"Expected Haystack Documents, got {type(item).__name__}")
+
+
+class DocumentStoreSink(DynamicSink[Any]):
+    """Write documents, or lists of documents, to a document store in bulk."""
+
+    def __init__(
+        self,
+        document_store: Any,
+        batch_size: int = 200,
+        flush_interval: float = 2.0,
+        max_outstanding: int = 2,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        failure_policy: str = "raise",
+        dead_letter_path: Optional[str] = None,
+        policy: DuplicatePolicy = DuplicatePolicy.OVERWRITE,
+    ):
+        """Init.
+
+        :arg document_store: Store with `write_documents`, or with
+            `merge_or_upload_documents` like LocalSearchIndex.
+        :arg batch_size: Documents per bulk request.
+        :arg flush_interval: Seconds the oldest buffered document waits
+            before a smaller batch is flushed.
+        :arg max_outstanding: Bulk requests in flight per worker. With more
+            than one, two versions of a document with the same id in
+            different batches can be written out of order.
+        :arg max_retries: Retries of a failed bulk request, with exponential
+            backoff. A batch that still fails is halved until the failing
+            documents are isolated.
+        :arg backoff: Seconds before the first retry.
+        :arg failure_policy: What to do with documents that could not be
+            written: `raise` stops the dataflow, `skip` logs and drops them,
+            `dead_letter` appends them to `dead_letter_path`.
+        :arg dead_letter_path: JSON lines file for the `dead_letter` policy.
+        :arg policy: DuplicatePolicy passed to `write_documents`.
+
+        """
+        if failure_policy not in FAILURE_POLICIES:
+            raise ValueError(f"failure_policy must be one of {FAILURE_POLICIES}")
+        if failure_policy == "dead_letter" and not dead_letter_path:
+            raise ValueError("The dead_letter policy needs a dead_letter_path")
+        self._write = _store_writer(document_store, policy)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_outstanding = max_outstanding
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._failure_policy = failure_policy
+        self._dead_letter_path = dead_letter_path
+
+    @override
+    def build(self, _step_id: str, worker_index: int, _worker_count: int) -> _DocumentStorePartition:
+        return _DocumentStorePartition(
+            self._write, self._batch_size, self._flush_interval, self._max_outstanding, self._max_retries,
+            self._backoff, self._failure_policy, self._dead_letter_path, worker_index,
+        )
@@ -0,0 +1,346 @@
+"""Local inverted index and hybrid BM25 + vector retrieval over news documents.
+
+Embedding retrieval alone handles symbol and keyword heavy questions such as
+"NVDA guidance" or "8-K" badly: it needs a query embedding call and a vector
+scan and can still miss the exact match. `InvertedIndex` is a BM25 index over
+the `content`, `headline` and `symbols` of each document that the indexing
+dataflow updates as documents arrive. `HybridRetriever` fuses its scores with
+the scores of an embedding retriever, and answers purely lexical queries from
+the inverted index alone, without calling the embedding API.
+
+`LexicalIndexSink` adds the documents of a dataflow to an index and saves it
+from a background thread of the process, and once more when the input ends.
+The index is shared by the workers of a process, run several processes with
+one `LEXICAL_INDEX_PATH` each.
+"""
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from bytewax.outputs import DynamicSink, StatelessSinkPartition
+from haystack import Document, component
+from typing_extensions import override
+
+logger = logging.getLogger(__name__)
+
+# Keeps tickers like BRK.B and form types like 8-K or 10-K/A in one token
+TOKEN_PATTERN = re.compile(r"[A-Za-z0-9]+(?:[-./][A-Za-z0-9]+)*")
+# Tickers and SEC form types, queries made only of these are lexical
+KEYWORD_PATTERN = re.compile(r"^(?:[A-Z]{1,5}(?:\.[A-Z])?|\d{1,2}-[A-Z]{1,2}(?:/A)?|[A-Z]+-[A-Z0-9]+)$")
+
+DEFAULT_FIELD_WEIGHTS = {"content": 1.0, "headline": 2.0, "symbols": 3.0}
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lower-cased terms."""
+    return [token.lower() for token in TOKEN_PATTERN.findall(text or "")]
+
+
+class InvertedIndex:
+    """Incrementally maintained BM25 index over the fields of news documents."""
+
+    def __init__(self, field_weights: Optional[Dict[str, float]] = None, k1: float = 1.2, b: float = 0.75):
+        """
+        :param field_weights: Weight of the term frequencies of each field.
+            `content` is the document content, the other fields are read
+            from the document metadata.
+        :param k1: BM25 term frequency saturation.
+        :param b: BM25 length normalization.
+        """
+        self.field_weights = field_weights or dict(DEFAULT_FIELD_WEIGHTS)
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self.doc_lengths: Dict[str, float] = {}
+        self.documents: Dict[str, Document] = {}
+        self._total_length = 0.0
+        self._lock = threading.RLock()
+        self._version = 0
+
+    def _field_text(self, document: Document, field: str) -> str:
+        value = document.content if field == "content" else document.meta.get(field)
+        if isinstance(value, (list, tuple)):
+            return " ".join(str(v) for v in value)
+        return str(value) if value is not None else ""
+
+    def _term_frequencies(self, document: Document) -> Counter:
+        frequencies = Counter()
+        for field, weight in self.field_weights.items():
+            for term in tokenize(self._field_text(document, field)):
+                frequencies[term] += weight
+        return frequencies
+
+    def add(self, document: Document) -> None:
+        """Add a document, replacing the entry of a document with the same id."""
+        frequencies = self._term_frequencies(document)
+        with self._lock:
+            self.remove(document.id)
+            for term, frequency in frequencies.items():
+                self.postings[term][document.id] = frequency
+            length = sum(frequencies.values())
+            self.doc_lengths[document.id] = length
+            self._total_length += length
+            # The index answers lexical queries alone, so it keeps the
+            # document without its embedding
+            self.documents[document.id] = Document(id=document.id, content=document.content,
+                                                   meta=document.meta)
+            self._version += 1
+
+    def add_all(self, documents: List[Document]) -> None:
+        for document in documents:
+            self.add(document)
+
+    def remove(self, doc_id: str) -> None:
+        with self._lock:
+            document = self.documents.pop(doc_id, None)
+            if document is None:
+                return
+            for term in self._term_frequencies(document):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self.postings[term]
+            self._total_length -= self.doc_lengths.pop(doc_id, 0.0)
+            self._version += 1
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Score the documents against a query with BM25.
+
+        :param query: Query text.
+        :param top_k: Number of results.
+        :return: `(document id, score)` pairs, best first.
+        """
+        with self._lock:
+            n = len(self.documents)
+            if not n:
+                return []
+            average_length = self._total_length / n
+            scores: Dict[str, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / average_length)
+                    scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+    @property
+    def version(self) -> int:
+        """Changes made to the index, to tell whether it needs saving."""
+        return self._version
+
+    def save(self, path: Union[str, Path]) -> int:
+        """
+        Write the indexed documents to a JSON file, the postings are rebuilt
+        on load. Returns the version saved.
+        """
+        with self._lock:
+            payload = {
+                "field_weights": self.field_weights,
+                "documents": [doc.to_dict(flatten=False) for doc in self.documents.values()],
+            }
+            version = self._version
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as file:
+            json.dump(payload, file, default=str)
+        os.replace(tmp, path)
+        return version
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "InvertedIndex":
+        with open(path, "r", encoding="utf-8") as file:
+            payload = json.load(file)
+        index = cls(field_weights=payload["field_weights"])
+        index.add_all([Document.from_dict(doc) for doc in payload["documents"]])
+        index._version = 0
+        return index
+
+    @classmethod
+    def open(cls, path: Union[str, Path], **kwargs: Any) -> "InvertedIndex":
+        """Load the index saved at `path`, or create an empty one if there is none."""
+        if os.path.exists(path):
+            index = cls.load(path)
+            logger.info(f"Loaded {len(index)} documents from {path}")
+            return index
+        return cls(**kwargs)
+
+
+class _LexicalIndexPartition(StatelessSinkPartition[Any]):
+    def __init__(self, sink: "LexicalIndexSink"):
+        self._sink = sink
+
+    @override
+    def write_batch(self, items: List[Any]) -> None:
+        self._sink.index.add_all([item for item in items if isinstance(item, Document)])
+
+    @override
+    def close(self) -> None:
+        self._sink.release()
+
+
+class LexicalIndexSink(DynamicSink[Any]):
+    """Add documents to an `InvertedIndex` and keep its file up to date.
+
+    The index is saved by a thread of the process every `interval` seconds
+    when it changed, so the JSON dump does not hold up the workers, and
+    when the last partition of the process closes.
+    """
+
+    def __init__(self, index: InvertedIndex, path: Union[str, Path], interval: float = 30.0):
+        """Init.
+
+        :arg index: Index the documents are added to, usually loaded with
+            `InvertedIndex.open(path)` so a restart keeps the documents
+            indexed before it.
+        :arg path: JSON file the index is saved to.
+        :arg interval: Seconds between two saves.
+
+        """
+        self.index = index
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._open = 0
+        self._saved = index.version
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def save(self) -> None:
+        """Save the index if it changed since the last save."""
+        with self._save_lock:
+            if self.index.version == self._saved:
+                return
+            started = time.monotonic()
+            self._saved = self.index.save(self.path)
+            logger.debug(f"Saved {len(self.index)} documents to {self.path} "
+                         f"in {time.monotonic() - started:.2f}s")
+
+    def release(self) -> None:
+        with self._lock:
+            self._open -= 1
+            last = self._open == 0
+        if last:
+            self._stop.set()
+            self.save()
+
+    def _save_periodically(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except OSError:
+                logger.exception(f"Saving the lexical index to {self.path} failed")
+
+    @override
+    def build(self, _step_id: str, _worker_index: int, _worker_count: int) -> _LexicalIndexPartition:
+        with self._lock:
+            self._open += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._save_periodically, daemon=True,
+                                                 name="lexical-index-saver")
+                self._thread.start()
+        return _LexicalIndexPartition(self)
+
+
+def is_lexical_query(query: str, max_terms: int = 4) -> bool:
+    """True for short queries made only of tickers and form types, e.g. "NVDA 8-K"."""
+    terms = query.split()
+    return 0 < len(terms) <= max_terms and all(KEYWORD_PATTERN.match(term) for term in terms)
+
+
+def _min_max(scores: Dict[str, float]) -> Dict[str, float]:
+    if not scores:
+        return {}
+    low, high = min(scores.values()), max(scores.values())
+    if high == low:
+        return {key: 1.0 for key in scores}
+    return {key: (value - low) / (high - low) for key, value in scores.items()}
+
+
+@component
+class HybridRetriever:
+    """
+    Retrieve documents by fusing BM25 scores of an `InvertedIndex` with the
+    scores of an embedding retriever.
+    """
+
+    def __init__(
+        self,
+        inverted_index: InvertedIndex,
+        embedding_retriever: Any,
+        text_embedder: Any,
+        top_k: int = 10,
+        alpha: float = 0.5,
+        mode: str = "auto",
+    ):
+        """
+        :param inverted_index: Lexical index maintained by the indexing dataflow.
+        :param embedding_retriever: Retriever with a `run(query_embedding, top_k)`
+            method, e.g. ElasticsearchEmbeddingRetriever.
+        :param text_embedder: Embedder for the query text, ideally a CachedTextEmbedder.
+        :param top_k: Number of documents to return.
+        :param alpha: Weight of the vector scores, `1 - alpha` is the weight of
+            the BM25 scores.
+        :param mode: `auto` answers lexical queries from the inverted index
+            alone and fuses both otherwise, `hybrid` always fuses, `lexical`
+            and `vector` use a single retriever.
+        """
+        self.inverted_index = inverted_index
+        self.embedding_retriever = embedding_retriever
+        self.text_embedder = text_embedder
+        self.top_k = top_k
+        self.alpha = alpha
+        self.mode = mode
+        self.lexical_only_queries = 0
+        self.hybrid_queries = 0
+
+    @component.output_types(documents=List[Document])
+    def run(self, query: str, top_k: Optional[int] = None):
+        top_k = top_k or self.top_k
+        mode = self.mode
+        lexical = []
+        if mode != "vector":
+            lexical = self.inverted_index.search(query, top_k=top_k * 2)
+            if mode == "lexical" or (mode == "auto" and lexical and is_lexical_query(query)):
+                self.lexical_only_queries += 1
+                return {"documents": self._documents(lexical[:top_k], {})}
+
+        self.hybrid_queries += 1
+        embedding = self.text_embedder.run(text=query)["embedding"]
+        vector_docs = self.embedding_retriever.run(query_embedding=embedding, top_k=top_k * 2)["documents"]
+        if mode == "vector":
+            return {"documents": vector_docs[:top_k]}
+
+        lexical_scores = _min_max(dict(lexical))
+        vector_scores = _min_max({doc.id: doc.score or 0.0 for doc in vector_docs})
+        fused = {
+            doc_id: self.alpha * vector_scores.get(doc_id, 0.0) + (1 - self.alpha) * lexical_scores.get(doc_id, 0.0)
+            for doc_id in set(lexical_scores) | set(vector_scores)
+        }
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return {"documents": self._documents(ranked, {doc.id: doc for doc in vector_docs})}
+
+    def _documents(self, ranked: List[Tuple[str, float]], retrieved: Dict[str, Document]) -> List[Document]:
+        documents = []
+        for doc_id, score in ranked:
+            document = retrieved.get(doc_id) or self.inverted_index.documents.get(doc_id)
+            if document is None:
+                continue
+            documents.append(Document(id=document.id, content=document.content, meta=document.meta,
+                                      score=score))
+        return documents
@@ -0,0 +1,63 @@
+import json
+
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSource, run_main
+from haystack import Document
+from haystack.document_stores.in_memory import InMemoryDocumentStore
+
+from document_store_sink import DocumentStoreSink
+
+
+def news(count):
+    return [Document(content=f"story {i}", meta={"symbols": ["VRTS"]}) for i in range(count)]
+
+
+def write(sink, documents, batches=1):
+    partition = sink.build("store", 0, 1)
+    size = len(documents) // batches
+    for start in range(0, len(documents), size):
+        partition.write_batch(documents[start:start + size])
+    partition.close()
+    return partition
+
+
+def test_every_flush_and_document_is_counted():
+    store = InMemoryDocumentStore()
+    sink = DocumentStoreSink(store, batch_size=7, flush_interval=0.01, max_outstanding=4)
+
+    partition = write(sink, news(200), batches=20)
+
+    assert store.count_documents() == 200
+    assert partition.stats["written"] == 200 and partition.stats["failed"] == 0
+    assert partition.stats["flushes"] >= 200 // 7
+
+
+class RejectingStore(InMemoryDocumentStore):
+    def write_documents(self, documents, policy=None):
+        if any(doc.content == "story 3" for doc in documents):
+            raise ConnectionError("rejected")
+        return super().write_documents(documents, policy=policy)
+
+
+def test_documents_that_cannot_be_written_are_dead_lettered(tmp_path):
+    path = tmp_path / "failed_documents.jsonl"
+    store = RejectingStore()
+    sink = DocumentStoreSink(store, batch_size=8, max_retries=1, backoff=0,
+                             failure_policy="dead_letter", dead_letter_path=str(path))
+
+    partition = write(sink, news(8))
+
+    assert store.count_documents() == 7
+    assert partition.stats["failed"] == 1 and partition.stats["retries"] == 1
+    assert [json.loads(line)["content"] for line in path.read_text().splitlines()] == ["story 3"]
+
+
+def test_lists_of_documents_from_a_dataflow():
+    store = InMemoryDocumentStore()
+    flow = Dataflow("store")
+    batches = op.input("news", flow, TestingSource([news(3), news(5)[3:], None]))
+    op.output("store", batches, DocumentStoreSink(store, batch_size=2))
+    run_main(flow)
+
+    assert store.count_documents() == 5
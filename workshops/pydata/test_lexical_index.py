@@ -0,0 +1,44 @@
+import bytewax.operators as op
+from bytewax.dataflow import Dataflow
+from bytewax.testing import TestingSource, run_main
+from haystack import Document
+
+from lexical_index import InvertedIndex, LexicalIndexSink
+
+NEWS = [
+    Document(content="Virtus Inv price target raised to $267 by Piper Sandler", meta={"symbols": ["VRTS"]}),
+    Document(content="Faraday Future receives a Nasdaq minimum bid price grant", meta={"symbols": ["FFIE"]}),
+]
+
+
+def index_news(documents, path):
+    index = InvertedIndex.open(path)
+    flow = Dataflow("lexical")
+    op.output("index", op.input("news", flow, TestingSource(documents)), LexicalIndexSink(index, path, interval=60))
+    run_main(flow)
+    return index
+
+
+def test_documents_indexed_before_a_restart_are_kept(tmp_path):
+    path = tmp_path / "lexical_index.json"
+    index_news(NEWS[:1], path)
+    assert path.exists()
+
+    index = index_news(NEWS[1:], path)
+
+    assert len(index) == 2
+    [(doc_id, _)] = index.search("Virtus price target", top_k=1)
+    assert index.documents[doc_id].meta["symbols"] == ["VRTS"]
+    assert len(InvertedIndex.load(path)) == 2
+
+
+def test_an_unchanged_index_is_not_saved_again(tmp_path):
+    path = tmp_path / "lexical_index.json"
+    index_news(NEWS, path)
+    saved = path.stat().st_mtime_ns
+
+    index = InvertedIndex.open(path)
+    sink = LexicalIndexSink(index, path)
+    sink.build("index", 0, 1).close()
+
+    assert path.stat().st_mtime_ns == saved and len(index) == 2
@@ -6,14 +6,17 @@ import re
 
 import bytewax.operators as op
 import pandas as pd
-from bytewax.connectors.files import FileSource
+from rag_common.compressed_jsonl import CompressedFileSource
 from bytewax.connectors.stdio import StdOutSink
 from bytewax.dataflow import Dataflow
 from bytewax.operators import windowing as wop
 from bytewax.operators.windowing import EventClock, TumblingWindower
+from rag_common.state_telemetry import get_telemetry
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# Events held by the window per key, see rag_common/state_telemetry.py
+telemetry = get_telemetry()
 
 def safe_deserialize(data):
         """
@@ -66,7 +69,7 @@ def parse_time(parsed_data):
             
     
 flow = Dataflow("rag-pipeline")
-input_data = op.input("input", flow, FileSource("data/news_out.jsonl"))
+input_data = op.input("input", flow, CompressedFileSource("data/news_out.jsonl"))
 deserialize_data = op.filter_map("deserialize", input_data, safe_deserialize)
 transform_data_time = op.map("timeconversion", deserialize_data, parse_time)
 
@@ -89,9 +92,11 @@ align_to = datetime(2024, 5, 29, 1,  tzinfo=timezone.utc)
 clock_config = TumblingWindower(align_to=align_to, length=timedelta(seconds=19))
 
 # Collect the windowed data
+counted = telemetry.count_window("windowed_data", map_tuple)
 window = wop.collect_window(
-    "windowed_data", map_tuple, clock=event_time_config, windower=clock_config
+    "windowed_data", counted, clock=event_time_config, windower=clock_config
 )
+telemetry.window_closed("windowed_data", window)
 
 def find_duplicate_ids_in_window(window):
     """Identify duplicate news ID entries given a specific window"""